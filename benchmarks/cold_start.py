@@ -0,0 +1,83 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+# Wall clock time of one shot command execution in a new interpreter
+#
+# python benchmarks/cold_start.py [runs]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from nessaid_cli.cmd import NessaidCmd
+from nessaid_cli.tokens import StringToken, RangedIntToken
+
+
+class ColdStartBenchmarkCmd(NessaidCmd):
+    r"""
+    token NAME StringToken();
+    token COUNT RangedIntToken(1, 100);
+    """
+
+    def get_token_classes(self):
+        return [StringToken, RangedIntToken]
+
+    def do_hello(self, name, count):
+        r"""
+        "hello" << $name = "world"; $count = 1; >> { NAME << $name = $1; >> } { "count" COUNT << $count = $2; >> }
+        """
+        pass
+
+
+INTERACTIVE = """
+import sys
+from cold_start import ColdStartBenchmarkCmd
+cmd = ColdStartBenchmarkCmd(prompt="# ", show_grammar=False, disable_default_hooks=True, use_base_grammar=False)
+sys.exit(cmd.exec_args(*sys.argv[1:]))
+"""
+
+ONE_SHOT = """
+import sys
+from cold_start import ColdStartBenchmarkCmd
+sys.exit(ColdStartBenchmarkCmd.execute_args(*sys.argv[1:]))
+"""
+
+
+def run(code, runs, env, clear_cache_dir=None):
+    elapsed = 0.0
+    for _ in range(runs):
+        if clear_cache_dir:
+            shutil.rmtree(clear_cache_dir, ignore_errors=True)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code, "hello", "bob", "count", "2"], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        elapsed += time.perf_counter() - start
+    return elapsed / runs
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ)
+        env["NESSAID_CLI_CACHE_DIR"] = cache_dir
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__)), os.getcwd(), env.get("PYTHONPATH", "")])
+
+        baseline = run("pass", runs, env)
+        print("{:40s} {:8.1f} ms".format("python startup", baseline * 1000))
+
+        for name, code, clear_cache_dir in (
+                ("interactive Cmd, exec_args", INTERACTIVE, None),
+                ("execute_args, cold grammar cache", ONE_SHOT, cache_dir),
+                ("execute_args, warm grammar cache", ONE_SHOT, None)):
+            elapsed = run(code, runs, env, clear_cache_dir)
+            print("{:40s} {:8.1f} ms  (+{:.1f} ms over startup)".format(
+                name, elapsed * 1000, (elapsed - baseline) * 1000))
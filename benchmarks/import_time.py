@@ -0,0 +1,65 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+# Import time of the nessaid_cli modules measured with python -X importtime
+#
+# python benchmarks/import_time.py [runs] [module]
+
+import os
+import sys
+import statistics
+import subprocess
+
+
+# Modules which should be loaded only when the interactive, profiling or path completion features are used
+DEFERRED_MODULES = [
+    "cProfile", "pstats", "tracemalloc", "datetime", "nessaid_readline",
+    "pathlib", "fnmatch", "platform", "tempfile", "nessaid_cli.compiler",
+]
+
+
+def get_env():
+    env = dict(os.environ)
+    # Measure the imports from the bytecode cache, not the compilation of the sources
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPATH"] = os.pathsep.join([os.getcwd(), env.get("PYTHONPATH", "")])
+    return env
+
+
+def import_times(module, env):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          env=env, check=True, capture_output=True, text=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if not self_time.strip().isdigit():
+            continue
+        times[name.strip()] = (int(self_time), int(cumulative))
+    return times
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    module = sys.argv[2] if len(sys.argv) > 2 else "nessaid_cli.cmd"
+
+    env = get_env()
+    import_times(module, env) # Write the bytecode cache
+
+    samples = [import_times(module, env) for _ in range(runs)]
+
+    print("Median import time of {} over {} runs (us)\n".format(module, runs))
+    print("{:45s} {:>10s} {:>12s}".format("module", "self", "cumulative"))
+    for name in sorted(n for n in samples[-1] if n.startswith("nessaid_cli")):
+        self_time = statistics.median(s[name][0] for s in samples)
+        cumulative = statistics.median(s[name][1] for s in samples)
+        print("{:45s} {:10.0f} {:12.0f}".format(name, self_time, cumulative))
+
+    print()
+    loaded = [m for m in DEFERRED_MODULES if m in samples[-1]]
+    print("Deferred modules loaded by the import:", ", ".join(loaded) if loaded else "none")
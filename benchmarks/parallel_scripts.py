@@ -0,0 +1,59 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+# Throughput of ScriptPool with the orderless set benchmark grammar
+#
+# python benchmarks/parallel_scripts.py [scripts] [lines per script]
+
+import os
+import sys
+import time
+
+from nessaid_cli.cmd import NessaidCmd
+from nessaid_cli.parallel import ScriptPool
+
+
+BENCHMARK_LINE = "o 1 2 3 a b c a b c 1 2 3 o c b a 3 2 1 3 2 1 c b a"
+
+
+class OrderlessBenchmarkCmd(NessaidCmd):
+
+    async def do_orderless(self):
+        r"""
+        (
+        "orderless"
+        (("1", {"2"}, "3"), ("a", {"b"}, "c")) * 2
+        {("1", {"2"}, "3"), ("a", {"b"}, "c")} * 4
+        ) * (1: 50)
+        """
+        pass
+
+
+def run(workers, scripts):
+    start = time.perf_counter()
+    with ScriptPool(OrderlessBenchmarkCmd, workers=workers) as pool:
+        results = list(pool.map(scripts))
+    elapsed = time.perf_counter() - start
+    assert all(r.success for r in results)
+    return elapsed
+
+
+if __name__ == '__main__':
+    script_count = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    line_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    scripts = [[BENCHMARK_LINE] * line_count for _ in range(script_count)]
+    total_lines = script_count * line_count
+
+    base = None
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        elapsed = run(workers, scripts)
+        base = base or elapsed
+        print("workers: {:3d}  time: {:8.3f}s  lines/s: {:10.1f}  speedup: {:5.2f}".format(
+            workers, elapsed, total_lines / elapsed, base / elapsed))
+        workers *= 2
@@ -0,0 +1,41 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+# Match and completion time of RangedIntToken for growing ranges
+#
+# python benchmarks/ranged_int.py [iterations]
+
+import sys
+import time
+import asyncio
+
+from nessaid_cli.tokens import RangedIntToken
+
+
+RANGES = [(0, 10), (1, 1000), (-50000, 50000), (0, 10 ** 6), (1, 2 ** 32)]
+INPUTS = ["", "1", "12", "-", "-4", "429496729", "9"]
+
+
+async def measure(token, method, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for token_input in INPUTS:
+            await method(token_input)
+    return (time.perf_counter() - start) / (iterations * len(INPUTS))
+
+
+async def main(iterations):
+    print("{:>28s} {:>12s} {:>12s}".format("range", "match (us)", "complete (us)"))
+    for start, end in RANGES:
+        token = RangedIntToken("NUMBER", start, end)
+        match_time = await measure(token, token.match, iterations)
+        complete_time = await measure(token, token.complete, iterations)
+        print("{:>28s} {:12.2f} {:12.2f}".format(
+            "{}..{}".format(start, end), match_time * 1e6, complete_time * 1e6))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,191 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import array
+import weakref
+import collections
+
+from nessaid_cli import metrics
+
+
+# Phases of an executed line the allocations are attributed to
+ALLOCATION_PHASES = (metrics.PHASE_TOKENIZE, metrics.PHASE_MATCH, metrics.PHASE_BINDING)
+
+
+class AllocationSample():
+    """Memory allocated by the phases of one executed line, from the tracemalloc counters
+
+    Each mark attributes the memory allocated since the previous mark to a phase. Marking a phase
+    again adds to its net allocation. The counters and the peak are those of the whole process,
+    so the sample is only right if no other line runs at the same time.
+    """
+
+    def __init__(self, snapshot=None):
+        import tracemalloc
+
+        self._tracemalloc = tracemalloc
+        self.snapshot = snapshot
+        # Another line ran during the sample, its figures include the allocations of that line
+        self.overlapped = False
+        # Net and peak of each phase, then the traced memory at the last mark. They are stored in
+        # place, so the figures of the sample are not counted as memory retained by the line
+        self._figures = array.array("q", bytes(8 * (2 * len(ALLOCATION_PHASES) + 1)))
+        self._reset_peak()
+        self.start = self._figures[-1] = tracemalloc.get_traced_memory()[0]
+
+    def _reset_peak(self):
+        # tracemalloc.reset_peak is available from python 3.9, the peak is since the start otherwise
+        reset_peak = getattr(self._tracemalloc, "reset_peak", None)
+        if reset_peak:
+            reset_peak()
+
+    @property
+    def net(self):
+        return {phase: self._figures[i] for i, phase in enumerate(ALLOCATION_PHASES)}
+
+    @property
+    def peak(self):
+        count = len(ALLOCATION_PHASES)
+        return {phase: self._figures[count + i] for i, phase in enumerate(ALLOCATION_PHASES)}
+
+    def mark(self, phase):
+        current, peak = self._tracemalloc.get_traced_memory()
+        net, last = ALLOCATION_PHASES.index(phase), self._figures[-1]
+        peak_index = len(ALLOCATION_PHASES) + net
+        self._figures[net] += current - last
+        self._figures[peak_index] = max(self._figures[peak_index], peak - last)
+        self._figures[-1] = current
+        self._reset_peak()
+
+
+AllocationRecord = collections.namedtuple("AllocationRecord", ["command", "net", "peak", "retained", "top_lines"])
+
+
+class AllocationTracker():
+    """Ring buffer of the allocations of the latest executed lines, attributed to their commands
+
+    tracemalloc only counts the memory of the whole process. The lines executed at the same time,
+    like those of the concurrent server sessions or scripts, cannot be told apart, so a line
+    overlapping another one is not recorded. They are counted in overlapped instead.
+    """
+
+    def __init__(self, size=256, snapshots=False, growth_runs=5, growth_bytes=1024):
+        """Creates the tracker, starting tracemalloc if it is not tracing
+
+        :param size: Number of the latest executed lines kept
+        :param snapshots: Take tracemalloc snapshots around the lines to find the lines retaining memory
+        :param growth_runs: A command is growing if it retained memory in each of these many latest runs
+        :param growth_bytes: and the memory retained by the runs adds up to at least these many bytes
+        """
+
+        import tracemalloc
+
+        self.records = collections.deque(maxlen=size)
+        self.top_lines = 5
+        # (command, sample) of the lines matched since the last line started
+        self._pending = []
+        # Samples of the lines started and not recorded yet
+        self._active = weakref.WeakSet()
+        # Number of the lines not recorded as they overlapped other lines
+        self.overlapped = 0
+        self.snapshots = snapshots
+        self.growth_runs = growth_runs
+        self.growth_bytes = growth_bytes
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def start(self):
+        """Starts the sample of a line, completing the record of the previous line
+
+        The memory retained by a line is measured when the next line starts, after the frames and
+        the temporaries of the line are released.
+        """
+
+        import tracemalloc
+
+        if self._active:
+            # The memory retained by the pending lines is measured once no line is running
+            sample = AllocationSample()
+            sample.overlapped = True
+            for other in self._active:
+                other.overlapped = True
+            self._active.add(sample)
+            return sample
+
+        current = tracemalloc.get_traced_memory()[0]
+        snapshot = tracemalloc.take_snapshot() if self.snapshots else None
+        if self._pending:
+            self._complete_pending(current, snapshot)
+        # The snapshot after a line is the one before the next
+        sample = AllocationSample(snapshot)
+        self._active.add(sample)
+        return sample
+
+    def _complete_pending(self, current, snapshot):
+        # The pending samples and their snapshots are released before the next sample starts
+        pending, self._pending = self._pending, []
+        for command, sample in pending:
+            top_lines = None
+            if snapshot is not None and sample.snapshot is not None:
+                stats = snapshot.compare_to(sample.snapshot, "lineno")
+                top_lines = [str(stat) for stat in stats[:self.top_lines] if stat.size_diff > 0]
+            self.records.append(AllocationRecord(command, sample.net, sample.peak, current - sample.start, top_lines))
+
+    def record(self, command, sample):
+        """Records the sample of the line executing the command, completed when the next line starts"""
+        self._active.discard(sample)
+        if sample.overlapped:
+            self.overlapped += 1
+            return
+        self._pending.append((command, sample))
+
+    def discard(self, sample):
+        """Drops the sample of a line which is not matched, like an empty line"""
+        self._active.discard(sample)
+
+    def reset(self):
+        self.records.clear()
+        self._pending.clear()
+        self.overlapped = 0
+
+    def close(self):
+        """Stops tracemalloc if the tracker started it"""
+        import tracemalloc
+
+        if self._started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracing = False
+
+    def command_records(self, command):
+        return [r for r in self.records if r.command == command]
+
+    def is_growing(self, command):
+        """Whether the command retained memory in each of its growth_runs latest runs"""
+        records = self.command_records(command)[-self.growth_runs:]
+        if len(records) < self.growth_runs or any(r.retained <= 0 for r in records):
+            return False
+        return sum(r.retained for r in records) >= self.growth_bytes
+
+    def summary(self):
+        """Returns a dict of the commands to the summary of their recorded runs"""
+        summary = {}
+        for record in self.records:
+            entry = summary.get(record.command)
+            if entry is None:
+                entry = summary[record.command] = {
+                    "runs": 0, "net": dict.fromkeys(ALLOCATION_PHASES, 0), "peak": 0, "retained": 0}
+            entry["runs"] += 1
+            for phase, net in record.net.items():
+                entry["net"][phase] = entry["net"].get(phase, 0) + net
+            entry["peak"] = max([entry["peak"]] + list(record.peak.values()))
+            entry["retained"] += record.retained
+            entry["last_retained"] = record.retained
+            entry["top_lines"] = record.top_lines
+        for command, entry in summary.items():
+            entry["growing"] = self.is_growing(command)
+        return summary
@@ -0,0 +1,314 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+# Static complexity analysis of the compiled grammars
+#
+# python -m nessaid_cli.analyzer <grammar file | package.module:CmdClass> [grammar names]
+
+import os
+import sys
+import argparse
+import collections
+
+from nessaid_cli.elements import (
+    ConstantInputElement,
+    KeywordInputElement,
+    InputElementCollection,
+    SequenceInputElement,
+    OrderlessSetInputElement,
+    OptionalInputElement,
+    AlternativeInputElement,
+    NamedGrammar,
+    GrammarRefElement,
+    UnresolvedInputElement,
+)
+
+
+# Limits beyond which a grammar is reported as costly to match
+MAX_EXPANDED_NODES = 10000
+MAX_FRONTIER = 16
+MAX_REPEAT = 20
+MAX_ORDERLESS_DEPTH = 1
+
+# Number of the largest repeats listed in the report
+REPORT_REPEATS = 5
+
+
+# Nodes: number of walk tree nodes when the element is fully expanded
+# First: dict of the labels of the tokens the element can start with, to the number of tree nodes offering them
+# Nullable: whether the element can match no input
+# Orderless depth: nesting depth of the orderless sets in the element
+_ElementInfo = collections.namedtuple("_ElementInfo", ["nodes", "first", "nullable", "orderless_depth"])
+
+
+def _element_repr(element, limit=60):
+    text = repr(element)
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def _label_repr(label):
+    kind, value = label
+    return '"{}"'.format(value) if kind == "keyword" else value
+
+
+class GrammarStats():
+    """Complexity figures and the cost warnings of one named grammar"""
+
+    def __init__(self, name):
+        self.name = name
+        self.expanded_nodes = 0
+        self.max_first_width = 0
+        self.max_frontier = 0
+        self.orderless_depth = 0
+        # (repeat count, element) of the repeated elements
+        self.repeats = []
+        # (element kind, labels, element) of the siblings starting with the same tokens
+        self.overlaps = []
+        # Orderless sets with optional members to the times they are repeated
+        self.repeated_orderless_sets = {}
+        self.recursive = False
+        self.warnings = []
+
+    @property
+    def max_repeat(self):
+        return max([count for count, _ in self.repeats], default=1)
+
+    def warn(self, message):
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "expanded_nodes": self.expanded_nodes,
+            "max_first_width": self.max_first_width,
+            "max_frontier": self.max_frontier,
+            "orderless_depth": self.orderless_depth,
+            "max_repeat": self.max_repeat,
+            "recursive": self.recursive,
+            "overlaps": [(kind, [_label_repr(label) for label in labels], element)
+                         for kind, labels, element in self.overlaps],
+            "warnings": list(self.warnings),
+        }
+
+
+class GrammarAnalyzer():
+    """Estimates the cost of matching the named grammars of a GrammarSpecification
+
+    The figures are computed from the grammar elements, without building the walk trees:
+
+    - expanded_nodes: Walk tree nodes of the grammar with the repeats expanded.
+    - max_first_width: Most tokens evaluated at a point, from the FIRST sets of the elements.
+    - max_frontier: Most tree nodes accepting the same token at a point. Each of them is a candidate
+      sequence the matcher carries on.
+    - orderless_depth: Nesting depth of the orderless sets.
+    - repeats: The repeated elements. A repeat range (m: n) compiles to n - m optional copies.
+    - overlaps: Sibling alternatives or orderless set members starting with the same token.
+    """
+
+    def __init__(self, grammar_spec, max_nodes=MAX_EXPANDED_NODES, max_frontier=MAX_FRONTIER,
+                 max_repeat=MAX_REPEAT, max_orderless_depth=MAX_ORDERLESS_DEPTH):
+        self._spec = grammar_spec
+        self.max_nodes = max_nodes
+        self.max_frontier = max_frontier
+        self.max_repeat = max_repeat
+        self.max_orderless_depth = max_orderless_depth
+
+    def analyze_all(self):
+        return [self.analyze(grammar.name) for grammar in self._spec.grammars]
+
+    def analyze(self, name):
+        """Returns the GrammarStats of the named grammar"""
+
+        grammar = self._spec.get_grammar(name)
+        if grammar is None:
+            raise KeyError("No grammar named: {}".format(name))
+
+        stats = GrammarStats(name)
+        info = self._analyze(stats, grammar, 1, [])
+        stats.expanded_nodes = info.nodes
+        stats.orderless_depth = info.orderless_depth
+        stats.repeats = sorted(set(stats.repeats), key=lambda r: (-r[0], r[1]))
+
+        if stats.expanded_nodes > self.max_nodes:
+            stats.warn("{} walk tree nodes when expanded, more than {}".format(stats.expanded_nodes, self.max_nodes))
+        if stats.max_frontier > self.max_frontier:
+            stats.warn("Up to {} candidate sequences can match the same token, more than {}".format(
+                stats.max_frontier, self.max_frontier))
+        if stats.orderless_depth > self.max_orderless_depth:
+            stats.warn("Orderless sets nested {} deep".format(stats.orderless_depth))
+        for element, multiplier in stats.repeated_orderless_sets.items():
+            # Like the benchmark.py grammar, each optional member can be matched in any round of
+            # the repeats, so the candidate sequences multiply with the input
+            stats.warn("Orderless set with optional members repeated {} times: {}".format(multiplier, element))
+        for count, element in stats.repeats:
+            if count > self.max_repeat:
+                stats.warn("Repeat of {} copies: {}".format(count, element))
+        for kind, labels, element in stats.overlaps:
+            stats.warn("{} members start with the same tokens {}: {}".format(
+                kind, ", ".join(_label_repr(label) for label in labels), element))
+        if stats.recursive:
+            stats.warn("Recursive grammar reference, the walk tree grows with the input")
+        return stats
+
+    def _resolve(self, element):
+        if isinstance(element, UnresolvedInputElement):
+            grammar = self._spec.get_grammar(element.value)
+            if grammar is not None:
+                return grammar
+        elif isinstance(element, GrammarRefElement):
+            return element.value
+        return element
+
+    def _record_first(self, stats, first):
+        if first:
+            stats.max_first_width = max(stats.max_first_width, sum(first.values()))
+            stats.max_frontier = max(stats.max_frontier, max(first.values()))
+
+    def _record_overlaps(self, stats, kind, element, children):
+        seen = {}
+        for child in children:
+            for label in child.first:
+                seen[label] = seen.get(label, 0) + 1
+        shared = sorted(label for label, count in seen.items() if count > 1)
+        if shared and (kind, shared, _element_repr(element)) not in stats.overlaps:
+            stats.overlaps.append((kind, shared, _element_repr(element)))
+
+    def _analyze(self, stats, element, multiplier, grammar_stack):
+        """Returns the _ElementInfo of the element
+
+        :param multiplier: Product of the repeat counts of the enclosing elements
+        :param grammar_stack: Names of the grammars being analyzed, to find the recursive references
+        """
+
+        element = self._resolve(element)
+
+        if isinstance(element, NamedGrammar):
+            if element.name in grammar_stack:
+                stats.recursive = True
+                return _ElementInfo(1, {}, True, 0)
+            info = self._analyze(stats, element.value, multiplier, grammar_stack + [element.name])
+            return info._replace(nodes=info.nodes + 1)
+
+        if isinstance(element, ConstantInputElement):
+            return _ElementInfo(1, {("keyword", element.value): 1}, False, 0)
+
+        if isinstance(element, (KeywordInputElement, UnresolvedInputElement)):
+            return _ElementInfo(1, {("token", element.value): 1}, False, 0)
+
+        if not isinstance(element, InputElementCollection):
+            return _ElementInfo(1, {}, True, 0)
+
+        repeat = element.repeat_count
+        if isinstance(element, SequenceInputElement) and repeat > 1:
+            stats.repeats.append((repeat, _element_repr(element)))
+            child = self._analyze(stats, element.value[0], multiplier * repeat, grammar_stack)
+            # The copies of a nullable element all offer its first tokens
+            copies = repeat if child.nullable else 1
+            first = {label: count * copies for label, count in child.first.items()}
+            self._record_first(stats, first)
+            return _ElementInfo(1 + repeat * child.nodes, first, child.nullable, child.orderless_depth)
+
+        children = [self._analyze(stats, child, multiplier, grammar_stack) for child in element.value]
+        nodes = 1 + sum(child.nodes for child in children)
+        orderless_depth = max([child.orderless_depth for child in children], default=0)
+        first = {}
+
+        if isinstance(element, (AlternativeInputElement, OrderlessSetInputElement)):
+            for child in children:
+                for label, count in child.first.items():
+                    first[label] = first.get(label, 0) + count
+            if isinstance(element, AlternativeInputElement):
+                nullable = any(child.nullable for child in children)
+                self._record_overlaps(stats, "Alternative", element, children)
+            else:
+                nullable = all(child.nullable for child in children)
+                orderless_depth += 1
+                self._record_overlaps(stats, "Orderless set", element, children)
+                if multiplier > 1 and any(child.nullable for child in children):
+                    key = _element_repr(element)
+                    stats.repeated_orderless_sets[key] = max(stats.repeated_orderless_sets.get(key, 0), multiplier)
+        else:
+            nullable = True
+            for child in children:
+                for label, count in child.first.items():
+                    first[label] = first.get(label, 0) + count
+                if not child.nullable:
+                    nullable = False
+                    break
+            if isinstance(element, OptionalInputElement):
+                nullable = True
+
+        self._record_first(stats, first)
+        return _ElementInfo(nodes, first, nullable, orderless_depth)
+
+
+def analyze_grammar(grammar, names=None, **limits):
+    """Analyzes the named grammars
+
+    :param grammar: The grammar specification text or the compiled GrammarSpecification
+    :param names: Names of the grammars to analyze, all of them if None
+    :param limits: max_nodes, max_frontier, max_repeat and max_orderless_depth to warn beyond
+    :returns: list of GrammarStats objects
+    :rtype: list
+    """
+
+    if isinstance(grammar, str):
+        from nessaid_cli.compiler import compile_grammar
+        grammar = compile_grammar(grammar)
+
+    analyzer = GrammarAnalyzer(grammar, **limits)
+    if names is None:
+        return analyzer.analyze_all()
+    return [analyzer.analyze(name) for name in names]
+
+
+def format_report(stats_list):
+    lines = []
+    for stats in stats_list:
+        lines.append("{}:".format(stats.name))
+        lines.append("    expanded nodes:  {}".format(stats.expanded_nodes))
+        lines.append("    max first width: {}".format(stats.max_first_width))
+        lines.append("    max frontier:    {}".format(stats.max_frontier))
+        lines.append("    orderless depth: {}".format(stats.orderless_depth))
+        if stats.repeats:
+            lines.append("    largest repeats: {}".format(", ".join(
+                "{} x {}".format(count, element) for count, element in stats.repeats[:REPORT_REPEATS])))
+        for warning in stats.warnings:
+            lines.append("    WARNING: {}".format(warning))
+    return "\n".join(lines)
+
+
+def _load_cmd_grammar(target):
+    import importlib
+
+    module_name, class_name = target.split(":", 1)
+    cmd_class = getattr(importlib.import_module(module_name), class_name)
+    cmd = cmd_class(interactive=False)
+    return cmd._grammars
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nessaid_cli.analyzer",
+        description="Report the cost of matching the grammars, exits with 1 if any grammar has warnings")
+    parser.add_argument("target", help="The grammar file, or the Cmd class as module:ClassName")
+    parser.add_argument("names", nargs="*", help="Names of the grammars to analyze, all of them if none")
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.target) or ":" not in args.target:
+        with open(args.target) as fd:
+            grammar = fd.read()
+    else:
+        grammar = _load_cmd_grammar(args.target)
+
+    stats_list = analyze_grammar(grammar, args.names or None)
+    print(format_report(stats_list))
+    return 1 if any(stats.warnings for stats in stats_list) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
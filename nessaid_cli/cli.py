@@ -7,16 +7,20 @@
 
 import os
 import time
+import heapq
+import inspect
 import asyncio
 import traceback
+import collections
 
 from nessaid_cli.elements import EndOfInpuToken
-from nessaid_cli.interface import CliInterface, TokenCompletion
-from nessaid_cli.tokens import MATCH_SUCCESS, MATCH_PARTIAL, MATCH_AMBIGUOUS
+from nessaid_cli import metrics
+from nessaid_cli.interface import CliInterface, TokenCompletion, ParsingResult
+from nessaid_cli.tokens import MATCH_SUCCESS, MATCH_FAILURE, MATCH_PARTIAL, MATCH_AMBIGUOUS
+from nessaid_cli.utils import iter_logical_lines, MappedFileReader
 from nessaid_cli.tokenizer.tokenizer import NessaidCliTokenizer, TokenizerException
 
-import nessaid_readline.key as key
-from nessaid_readline.async_readline import NessaidAsyncReadline, NessaidReadlineEOF, NessaidReadlineKeyboadInterrupt
+# nessaid_readline is imported only by the interactive code paths
 
 
 class ChildCliExitException(Exception):
@@ -32,15 +36,58 @@ class CliAlreadyRunning(Exception):
     pass
 
 
+class CliScriptError(Exception):
+
+    def __init__(self, msg, line_number=None, line=None, result=None):
+        self.line_number = line_number
+        self.line = line
+        self.result = result
+        super().__init__(msg)
+
+
+class ScriptLineResult():
+
+    def __init__(self, line_number, line, result):
+        self.line_number = line_number
+        self.line = line
+        self.result = result
+
+    def __repr__(self):
+        return "{}: {}: {}".format(self.line_number, self.line, self.result.result)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class CompletionCacheEntry():
+
+    def __init__(self, match_output, expires=None, key=None):
+        self.match_output = match_output
+        self.expires = expires
+        # (grammar name, line) completed
+        self.key = key
+        self.completions = None
+        # Formatted completions of the pages shown
+        self.completion_pages = {}
+        # Page shown by the next completion request of the line
+        self.next_page = 0
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
 class ParentBackup():
 
     def __init__(self, cli, readline):
         self._cli = cli
         self._parent = cli.parent
         self._readline = readline
-        self._enable_bell = readline._enable_bell
+        self._enable_bell = readline._enable_bell if readline else False
 
     async def restore(self):
+        if self._readline is None:
+            return
         self._readline.set_prepare_history_entry(lambda entry: entry.strip())
         self._readline.set_history_size(self._parent._history_size)
         self._readline.enable_bell(self._enable_bell)
@@ -51,26 +98,39 @@ class NessaidCli(CliInterface):
 
     def __init__(self, grammarset, loop=None, parent=None,
                  prompt=None, stdin=None, stdout=None, stderr=None, filename=None,
-                 completekey='tab', use_rawinput=True, history_size=100, enable_bell=False, str_cache_size=128):
+                 completekey='tab', use_rawinput=True, history_size=100, enable_bell=False, str_cache_size=128,
+                 max_match_candidates=None, max_token_evaluations=None, match_yield_interval=64, readline=None,
+                 interactive=True, completion_cache_size=64, completion_page_size=100):
 
         self._loop = loop if loop else asyncio.get_event_loop()
         self.validate_token_classes()
 
-        super().__init__(self._loop, grammarset, stdin=stdin, stdout=stdout, stderr=stderr, str_cache_size=str_cache_size)
+        super().__init__(self._loop, grammarset, stdin=stdin, stdout=stdout, stderr=stderr, str_cache_size=str_cache_size,
+                         max_match_candidates=max_match_candidates, max_token_evaluations=max_token_evaluations,
+                         match_yield_interval=match_yield_interval)
 
         enable_bell = False if enable_bell is not True else True
 
         self._history_size = history_size
 
         if not parent:
-            self._readline = NessaidAsyncReadline(loop=self.loop, stdin=self.stdin, stdout=self.stdout, stderr=self.stderr)
-            self._readline.set_prepare_history_entry(lambda entry: entry.strip())
-            self._readline.set_history_size(self._history_size)
+            if readline is not None:
+                self._readline = readline
+            elif interactive:
+                from nessaid_readline.async_readline import NessaidAsyncReadline
+                self._readline = NessaidAsyncReadline(loop=self.loop, stdin=self.stdin, stdout=self.stdout, stderr=self.stderr)
+            else:
+                # Non interactive Cli only executes lines and scripts, it never reads from the terminal
+                self._readline = None
+            if self._readline is not None:
+                self._readline.set_prepare_history_entry(lambda entry: entry.strip())
+                self._readline.set_history_size(self._history_size)
         else:
             self._parent_backup = ParentBackup(self, parent.readline)
             self._readline = parent.readline
 
-        self._readline.enable_bell(enable_bell)
+        if self._readline is not None:
+            self._readline.enable_bell(enable_bell)
 
         self._complete_tokens_processor =  self.process_completion_tokens
 
@@ -79,6 +139,11 @@ class NessaidCli(CliInterface):
         self._completekey = completekey
         self._use_rawinput = use_rawinput
         self._completion_matches = []
+        self._completion_cache = collections.OrderedDict()
+        self._completion_cache_size = completion_cache_size
+        self._completion_page_size = completion_page_size
+        # Completion entry of the last completion request of the line being read
+        self._completion_entry = None
         self._exit_loop = False
         self._exec_inited = False
         self._current_line = None
@@ -122,15 +187,21 @@ class NessaidCli(CliInterface):
     def file_line(self):
         if self.parent:
             return self.parent.file_line
-        if self._file_data:
-            file_content = self._file_data[-1]
-            if file_content:
-                file_line = file_content.pop(0)
-                if not file_content:
-                    self._file_data.pop()
+        while self._file_data:
+            reader, lines = self._file_data[-1]
+            file_line = next(lines, None)
+            if file_line is not None:
                 return file_line
+            reader.close()
+            self._file_data.pop()
         return None
 
+    def close_files(self):
+        """Closes the input files which are not read to the end"""
+        while self._file_data:
+            reader, _ = self._file_data.pop()
+            reader.close()
+
     @property
     def prompt(self):
         return self._prompt
@@ -168,13 +239,52 @@ class NessaidCli(CliInterface):
     def readline(self):
         return self._readline
 
+    def get_cached_completion(self, line):
+        if not self._completion_cache_size or not self.current_grammar:
+            return None
+        key = (self.current_grammar.name, line)
+        entry = self._completion_cache.get(key)
+        if entry is None:
+            return None
+        if entry.expired:
+            del self._completion_cache[key]
+            return None
+        self._completion_cache.move_to_end(key)
+        return entry
+
+    def cache_completion(self, line, match_output):
+        state = self._last_match_state
+        if not self._completion_cache_size or not self.current_grammar or not state or not state.cacheable:
+            return None
+        expires = None if state.completion_ttl is None else time.monotonic() + state.completion_ttl
+        key = (self.current_grammar.name, line)
+        entry = CompletionCacheEntry(match_output.copy(), expires, key)
+        self._completion_cache[key] = entry
+        while len(self._completion_cache) > self._completion_cache_size:
+            self._completion_cache.popitem(last=False)
+        return entry
+
+    def invalidate_completion_cache(self):
+        """Drop the cached completions, executing a command can change what the tokens complete to"""
+        self._completion_cache.clear()
+        self._completion_entry = None
+
     def tokenize(self, line):
+        # The executing callers start the measures of the line before tokenizing it
+        measures = self.line_measures
+        if measures is None or measures.tokenize_ns is not None:
+            measures = self.start_line_measures()
+        start = time.perf_counter_ns()
         try:
             if line == '\n':
                 line = ""
 
             try:
                 tokens = self._nessaid_tokenizer.parse(line)
+                # Recorded as a phase of the match of the tokens
+                measures.tokenize_ns = time.perf_counter_ns() - start
+                if measures.allocations is not None:
+                    measures.allocations.mark(metrics.PHASE_TOKENIZE)
                 return True, None, tokens
             except TokenizerException as e:
                 return False, "Invalid input: {}".format(line), []
@@ -183,6 +293,8 @@ class NessaidCli(CliInterface):
 
     async def get_next_line(self, prompt, show_prompt_for_file_lines=True, from_stdin=False):
 
+        # The completion pages of a new line start from the first one, even if its text is the same
+        self._completion_entry = None
         line = None if from_stdin else self.file_line
         if line is not None:
             if show_prompt_for_file_lines:
@@ -209,6 +321,7 @@ class NessaidCli(CliInterface):
             current_line = self._effective_line or ""
             current_line += line
 
+            import nessaid_readline.key as key
             while self._readline.get_line_buffer():
                 await self._readline.insert_text(key.BACKSPACE)
             await self._readline.insert_text(current_line)
@@ -231,14 +344,18 @@ class NessaidCli(CliInterface):
 
         line = self._readline.get_line_buffer()
 
-        try:
-            success, error, tokens = self.tokenize(line)
-            if not success:
-                self.set_completion_tokens(["Failure tokenizing input line: {} error: {}".format(line, error)])
-                return self._completion_matches[state]
-        except Exception as e:
-            self.set_completion_tokens(["Exception tokenizing input line: {}: {}".format(type(e), e)])
-            return None
+        # Repeated completion requests on the same line reuse the result of the dry run match
+        cache_entry = self.get_cached_completion(line)
+
+        if cache_entry is None:
+            try:
+                success, error, tokens = self.tokenize(line)
+                if not success:
+                    self.set_completion_tokens(["Failure tokenizing input line: {} error: {}".format(line, error)])
+                    return self._completion_matches[state]
+            except Exception as e:
+                self.set_completion_tokens(["Exception tokenizing input line: {}: {}".format(type(e), e)])
+                return None
 
         if line and line[-1] in TOKEN_SEPARATORS:
             last_token_complete = True
@@ -246,9 +363,12 @@ class NessaidCli(CliInterface):
             last_token_complete = False
 
         try:
-            input_tokens = [str(t) for t in tokens]
-
-            match_output = await self.match(input_tokens, dry_run=True, last_token_complete=last_token_complete)
+            if cache_entry is None:
+                input_tokens = [str(t) for t in tokens]
+                match_output = await self.match(input_tokens, dry_run=True, last_token_complete=last_token_complete)
+                cache_entry = self.cache_completion(line, match_output)
+            else:
+                match_output = cache_entry.match_output.copy()
 
             completions = []
 
@@ -314,7 +434,30 @@ class NessaidCli(CliInterface):
                 self._readline.play_bell()
                 return self._completion_matches[state]
 
-            self.set_completion_tokens(completions)
+            # Repeated completion requests on a line with more completions than a page show the next
+            # page. The page is kept on the completion entry of the line, a line which is not cached
+            # keeps the entry of its previous request while it completes to the same tokens
+            previous = self._completion_entry
+            key = (self.current_grammar.name if self.current_grammar else None, line)
+            if cache_entry is None and previous is not None and previous.key == key and previous.completions == completions:
+                entry = previous
+            else:
+                entry = cache_entry or CompletionCacheEntry(match_output, key=key)
+            page = entry.next_page if entry is previous and entry.completions == completions else 0
+            total = sum(1 for c in completions if c != "NEWLINE: Complete command")
+            page_size = self._completion_page_size
+            entry.next_page = page + 1 if page_size and total > (page + 1) * page_size else 0
+            self._completion_entry = entry
+
+            if entry.completions == completions and page in entry.completion_pages:
+                self._completion_matches = entry.completion_pages[page].copy()
+            else:
+                tokens = list(completions)
+                self.set_completion_tokens(completions, page)
+                if entry.completions != tokens:
+                    entry.completions = tokens
+                    entry.completion_pages = {}
+                entry.completion_pages[page] = self._completion_matches.copy()
             if completions and match_output.last_token:
                 self._suggestion_shown = True
 
@@ -332,9 +475,18 @@ class NessaidCli(CliInterface):
 
         return None
 
-    def process_completion_tokens(self, tokens):
-        comps = []
-        helps = []
+    def process_completion_tokens(self, tokens, page=0):
+        """Format a page of the completions for display
+
+        Only the completions of the page are selected, in sorted order, and formatted. The last
+        line tells how many completions are left for the next pages.
+
+        :param tokens: The completions, TokenCompletion objects or strings
+        :param page: Number of the page to display, the pages are completion_page_size long
+        :returns: The lines to display
+        :rtype: list
+        """
+
         completions = []
         add_completion_token = False
 
@@ -344,31 +496,32 @@ class NessaidCli(CliInterface):
             if not tokens:
                 return ["NEWLINE: Complete command"]
 
-        for t in tokens:
+        def completion_entry(t):
             if isinstance(t, TokenCompletion):
-                if not t.completion:
-                    comps.append("")
-                else:
-                    comps.append(t.completion)
-                helps.append(t.helpstring)
-            else:
-                comps.append(str(t))
-                helps.append("")
+                return (t.completion or "", t.helpstring or "")
+            return (str(t), "")
+
+        page_size = self._completion_page_size
+        if page_size and len(tokens) > page_size:
+            # Selected in the order of the full sorted list below
+            start = page * page_size
+            entries = heapq.nsmallest(start + page_size, map(completion_entry, tokens))[start:]
+        else:
+            start = 0
+            entries = sorted(map(completion_entry, tokens))
+        remaining = len(tokens) - start - len(entries)
 
-        max_len = min(max([len(c) for c in comps]), 40)
+        max_len = min(max([len(c) for c, _ in entries] or [0]), 40)
         if add_completion_token:
             max_len = min(max(max_len, len('NEWLINE')), 40)
 
-        for i in range(len(comps)):
-            comp = comps[i]
+        for comp, helpstring in entries:
             if len(comp) <= max_len:
                 comp += " " * (max_len - len(comp))
-            if helps[i]:
-                comp += (" :    " + helps[i])
+            if helpstring:
+                comp += (" :    " + helpstring)
             completions.append(comp)
 
-        completions = sorted(completions)
-
         if add_completion_token:
             comp = 'NEWLINE'
             if len(comp) <= max_len:
@@ -376,10 +529,18 @@ class NessaidCli(CliInterface):
                 comp += (" :    " + "Complete command")
                 completions.append(comp)
 
+        if remaining > 0:
+            completions.append("... {} more, complete again for the next page".format(remaining))
+
         return completions
 
-    def set_completion_tokens(self, tokens):
-        self._completion_matches = self._complete_tokens_processor(tokens)
+    def set_completion_tokens(self, tokens, page=0):
+        processor = self._complete_tokens_processor
+        # The processors taking the tokens only display the first page
+        if "page" in inspect.signature(processor).parameters:
+            self._completion_matches = processor(tokens, page=page)
+        else:
+            self._completion_matches = processor(tokens)
 
     async def input(self, prompt="", show_char=True, show_prompt_for_file_lines=True, from_stdin=False):
 
@@ -416,10 +577,12 @@ class NessaidCli(CliInterface):
 
     async def exec_line(self, line):
         try:
+            self.start_line_measures(execute=True)
             success, error, tokens = self.tokenize(line)
             if not success:
                 self.error("Failure tokenizing input line:", error)
         except Exception as e:
+            self.discard_line_measures()
             self.error("Exception tokenizing input line:", type(e), e)
             self.error("\n")
             traceback.print_tb(e.__traceback__, file=self.stderr)
@@ -430,6 +593,7 @@ class NessaidCli(CliInterface):
             arglist = []
             input_tokens = [str(t) for t in tokens]
             match_output = await self.match(input_tokens, dry_run=False, last_token_complete=True, arglist=arglist)
+            self.invalidate_completion_cache()
             self.process_cli_response(tokens, match_output)
             if match_output.result == MATCH_SUCCESS:
                 return 0
@@ -441,8 +605,67 @@ class NessaidCli(CliInterface):
             self.error("\n")
             return 13
 
+    async def execute_script(self, lines, grammarname=None, stop_on_error=True, on_result=None):
+        """Execute the command lines from an iterable without the interactive loop
+
+        The lines are streamed, continuation lines ending with backslash are joined and
+        the comment lines are skipped. No prompts are printed and no line is echoed.
+
+        :param lines: An iterable of lines, like a list of str or a file object opened in text mode
+        :param grammarname: The grammar to match the lines against. Current grammar is used if None
+        :param stop_on_error: Raise CliScriptError on the first line which does not match successfully
+        :param on_result: Callable to which each ScriptLineResult is passed instead of collecting them
+        :returns: list of ScriptLineResult objects, one for each executed line. Empty if on_result is given
+        :rtype: list
+        """
+
+        if grammarname is not None:
+            self.enter_grammar(grammarname)
+
+        try:
+            results = []
+            for line_number, line in iter_logical_lines(lines):
+                self.start_line_measures(execute=True)
+                success, error, tokens = self.tokenize(line)
+                if not success or not tokens:
+                    self.discard_line_measures()
+                if not success:
+                    res = ParsingResult()
+                    res.result = MATCH_FAILURE
+                    res.error = error
+                elif not tokens:
+                    continue
+                else:
+                    input_tokens = [str(t) for t in tokens]
+                    res = await self.match(input_tokens, dry_run=False, last_token_complete=True, arglist=[])
+                    self.invalidate_completion_cache()
+
+                if on_result is not None:
+                    on_result(ScriptLineResult(line_number, line, res))
+                else:
+                    results.append(ScriptLineResult(line_number, line, res))
+
+                if stop_on_error and res.result != MATCH_SUCCESS:
+                    raise CliScriptError(
+                        "Line {}: {}: {}".format(line_number, res.result, res.error),
+                        line_number=line_number, line=line, result=res)
+            return results
+        finally:
+            if grammarname is not None:
+                self.exit_grammar()
+
+    async def execute_file(self, filename, grammarname=None, stop_on_error=True, on_result=None):
+        """Execute the command lines of a file without the interactive loop
+
+        The file is memory mapped and read lazily line by line. Refer execute_script for the parameters.
+        """
+
+        with MappedFileReader(filename) as reader:
+            return await NessaidCli.execute_script(
+                self, reader, grammarname=grammarname, stop_on_error=stop_on_error, on_result=on_result)
+
     async def cli_exec_init(self):
-        if not self._exec_inited:
+        if not self._exec_inited and self._readline is not None:
             self._readline.set_completer(self.complete)
             self._readline.parse_and_bind(self._completekey+": complete")
             self._exec_inited = True
@@ -458,9 +681,9 @@ class NessaidCli(CliInterface):
 
     def add_file_to_execute(self, filename):
         try:
-            with open(filename) as fd:
-                lines = [l.rstrip() for l in fd.readlines()]
-                self.file_data.append(lines)
+            reader = MappedFileReader(filename)
+            # The continuation lines are joined and the comment lines skipped as the file is read
+            self.file_data.append((reader, (line for _, line in iter_logical_lines(reader))))
         except Exception as e:
             self.error("Exception processing input file:", filename, type(e), e)
 
@@ -482,6 +705,8 @@ class NessaidCli(CliInterface):
 
     async def cmdloop(self, grammarname, intro=None):
 
+        from nessaid_readline.async_readline import NessaidReadlineEOF, NessaidReadlineKeyboadInterrupt
+
         if self._filename:
             self.add_file_to_execute(self._filename)
 
@@ -545,6 +770,7 @@ class NessaidCli(CliInterface):
                 self._effective_line = ""
 
                 try:
+                    self.start_line_measures(execute=True)
                     success, error, tokens = self.tokenize(self._current_line)
                     if not success:
                         self.error("Failure tokenizing input line:", error)
@@ -575,6 +801,7 @@ class NessaidCli(CliInterface):
                             pass
 
                     self._current_line = None
+                    self.invalidate_completion_cache()
                     self.process_cli_response(tokens, match_output)
                 except ChildCliExitException as e:
                     raise e
@@ -584,6 +811,8 @@ class NessaidCli(CliInterface):
                     traceback.print_tb(e.__traceback__, file=self.stderr)
                     self.error("\n")
         finally:
+            if not self.parent:
+                self.close_files()
             await self.on_exit()
             self._exit_loop = False
             self.exit_grammar()
@@ -600,7 +829,8 @@ class NessaidCli(CliInterface):
         if tokens and cli_response.result != MATCH_SUCCESS:
             self.error("Result:", cli_response.result)
             self.error("Error:", cli_response.error)
-            self._readline.play_bell()
+            if self._readline is not None:
+                self._readline.play_bell()
 
     async def monitor_loop(self):
         while self._running:
@@ -609,7 +839,7 @@ class NessaidCli(CliInterface):
     def handle_external_keyboard_interrupt(self):
         if self.child_cli:
             self.child_cli.handle_external_keyboard_interrupt()
-        else:
+        elif self._readline is not None:
             self._readline.handle_external_keyboard_interrupt()
 
     def run(self, grammarname, intro=None):
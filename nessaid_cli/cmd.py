@@ -9,17 +9,10 @@
 
 import os
 import time
-import pstats
-import cProfile
-
 import asyncio
-import inspect
-import textwrap
-import linecache
-import tracemalloc
-from datetime import datetime
+import collections
 
-from nessaid_cli.compiler import compile_grammar
+from nessaid_cli.grammar_cache import load_grammar, configured_cache_dir
 from nessaid_cli.cli import NessaidCli, ChildCliExitException, CliAlreadyRunning
 from nessaid_cli.tokens import RangedIntToken, StringToken, MATCH_SUCCESS, MATCH_FAILURE, MATCH_PARTIAL, MATCH_AMBIGUOUS
 
@@ -27,6 +20,8 @@ from nessaid_cli.tokens import RangedIntToken, StringToken, MATCH_SUCCESS, MATCH
 class NessaidCmd(NessaidCli):
     """
     token TRACEMALLOC_LIMIT RangedIntToken(1, 100);
+    token TRACE_DIR StringToken();
+    token EXPLAIN_LINE StringToken();
     """
     """
     Base Cmd class
@@ -37,6 +32,19 @@ class NessaidCmd(NessaidCli):
     the function. The global grammar definitions should go as the derived class's docstring
     """
 
+    # Compiled grammars are read only, they are shared by the instances with the same grammar text.
+    # The latest used GRAMMAR_CACHE_SIZE grammars are kept.
+    GRAMMAR_CACHE_SIZE = 32
+    _compiled_grammars = collections.OrderedDict()
+    _grammar_texts = collections.OrderedDict()
+
+    @classmethod
+    def _cache_grammar(cls, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > cls.GRAMMAR_CACHE_SIZE:
+            cache.popitem(last=False)
+
     def get_token_classes(self):
         return [RangedIntToken, StringToken]
 
@@ -64,6 +72,8 @@ class NessaidCmd(NessaidCli):
         return self.__class__.__name__.split(".")[0]
 
     def format_grammar(self, grammar_text):
+        import textwrap
+
         formatted = ""
         if grammar_text:
             grammar_text = grammar_text.replace("\r\n", "\n")
@@ -84,7 +94,10 @@ class NessaidCmd(NessaidCli):
     def __init__(self, loop=None, parent=None, prompt=None, cli_hook_prefix="do_", cli_nargs=3,
                  stdin=None, stdout=None, stderr=None, enable_bell=False, do_tracemalloc=False, filename=None,
                  disable_default_hooks=False, use_base_grammar=True, use_parent_grammar=True, completekey='tab',
-                 use_rawinput=True, show_grammar=False, str_cache_size=128, match_parent_grammar=False):
+                 use_rawinput=True, show_grammar=False, str_cache_size=128, match_parent_grammar=False,
+                 max_match_candidates=None, max_token_evaluations=None, match_yield_interval=64, readline=None,
+                 interactive=True, grammar_cache_dir=None, completion_cache_size=64, completion_page_size=100,
+                 trace_dir=None):
         """Creates a Cmd instance
 
         :param loop: the event loop used to run the Cmd loop.
@@ -92,9 +105,19 @@ class NessaidCmd(NessaidCli):
         :param cli_hook_prefix: The prefix of the methods in the class to be converted to Cmd commands
         :param cli_nargs: Number of arguments the generated Cmd handlers should have.
         :param show_grammar: print the generated grammar before the Cmd prompt.
+        :param max_match_candidates: Abort matching a line with more live candidate sequences than this.
+        :param max_token_evaluations: Abort matching a line after these many token evaluations.
+        :param match_yield_interval: Yield to the event loop after these many token evaluations.
+        :param readline: The line reader object to use instead of creating a NessaidAsyncReadline.
+        :param interactive: Create the Cmd without a line reader, only to execute lines and scripts.
+        :param grammar_cache_dir: Directory to cache the compiled grammar across processes, None to disable.
+        :param completion_cache_size: Number of input lines whose completions are cached, 0 to disable.
+        :param completion_page_size: Number of completions displayed at a time, 0 to display all.
+        :param trace_dir: Directory of the cmd-tracing trace files, a directory under the temp directory if None.
         """
 
         if do_tracemalloc:
+            import tracemalloc
             if not tracemalloc.is_tracing():
                 tracemalloc.start()
         else:
@@ -112,6 +135,7 @@ class NessaidCmd(NessaidCli):
         self._enable_timing = False
         self._enable_profiling = False
         self._timing_command = False
+        self._trace_dir = trace_dir
         self._match_parent_grammar = match_parent_grammar
         self._use_base_grammar = use_base_grammar
         self._use_parent_grammar = use_parent_grammar
@@ -122,10 +146,53 @@ class NessaidCmd(NessaidCli):
             self.do__exit = None
             self.do__timing = None
             self.do__profile = None
+            self.do__stats = None
+            self.do__tracing = None
+            self.do__allocations = None
+            self.do__explain = None
             self.do__system_info = None
 
         self.execute_line = self.exec_line
         self.execute_args = self.exec_args
+
+        # The generated grammar depends only on the class and these arguments, so it is generated once
+        grammar_key = (type(self), cli_hook_prefix, cli_nargs, self._use_base_grammar, disable_default_hooks is True,
+                       bool(do_tracemalloc), parent.global_grammar if self._use_parent_grammar and parent else None)
+
+        grammar_text = NessaidCmd._grammar_texts.get(grammar_key)
+        if grammar_text is None:
+            grammar_text = self.generate_grammar(cli_hook_prefix, cli_nargs)
+        NessaidCmd._cache_grammar(NessaidCmd._grammar_texts, grammar_key, grammar_text)
+
+        if show_grammar:
+            self.print("# Generated CLI grammar:")
+            self.print(grammar_text)
+
+        grammar_set = NessaidCmd._compiled_grammars.get(grammar_text)
+        if grammar_set is None:
+            grammar_set = load_grammar(grammar_text, cache_dir=grammar_cache_dir)
+        NessaidCmd._cache_grammar(NessaidCmd._compiled_grammars, grammar_text, grammar_set)
+
+        super().__init__(
+            grammar_set, prompt=prompt, parent=parent, loop=loop, enable_bell=enable_bell,
+            stdin=stdin, stdout=stdout, stderr=stderr, filename=filename,
+            completekey=completekey, use_rawinput=use_rawinput, str_cache_size=str_cache_size,
+            max_match_candidates=max_match_candidates, max_token_evaluations=max_token_evaluations,
+            match_yield_interval=match_yield_interval, readline=readline, interactive=interactive,
+            completion_cache_size=completion_cache_size, completion_page_size=completion_page_size
+        )
+
+    def generate_grammar(self, cli_hook_prefix, cli_nargs):
+        """Generate the grammar text of the Cmd from the class docstrings and the command handlers
+
+        :param cli_hook_prefix: The prefix of the methods in the class to be converted to Cmd commands
+        :param cli_nargs: Number of arguments the generated Cmd handlers should have.
+        :returns: The grammar specification text
+        :rtype: str
+        """
+
+        import inspect
+
         if self._use_base_grammar and type(self) != NessaidCmd:
             grammar_text = NessaidCmd.__doc__
         else:
@@ -174,18 +241,7 @@ class NessaidCmd(NessaidCli):
         root_grammar += "\n      ;\n"
 
         grammar_text += root_grammar
-        grammar_text = self.format_grammar(grammar_text)
-
-        if show_grammar:
-            self.print("# Generated CLI grammar:")
-            self.print(grammar_text)
-
-        grammar_set = compile_grammar(grammar_text)
-        super().__init__(
-            grammar_set, prompt=prompt, parent=parent, loop=loop, enable_bell=enable_bell,
-            stdin=stdin, stdout=stdout, stderr=stderr, filename=filename,
-            completekey=completekey, use_rawinput=use_rawinput, str_cache_size=str_cache_size
-        )
+        return self.format_grammar(grammar_text)
 
     @property
     def global_grammar(self):
@@ -231,6 +287,9 @@ class NessaidCmd(NessaidCli):
             }
         }
         """
+        import linecache
+        import tracemalloc
+
         key_type='lineno'
         lines = []
 
@@ -337,6 +396,9 @@ class NessaidCmd(NessaidCli):
             show_grammar=False,
             str_cache_size=self._str_cache_size,
             do_tracemalloc=self._do_tracemalloc,
+            max_match_candidates=self._max_match_candidates,
+            max_token_evaluations=self._max_token_evaluations,
+            match_yield_interval=self._match_yield_interval,
             match_parent_grammar=match_parent_grammar, **kwargs
         )
 
@@ -366,7 +428,15 @@ class NessaidCmd(NessaidCli):
 
     @classmethod
     def execute_args(cls, *args):
-        cmd = cls(prompt="# ", show_grammar=False, disable_default_hooks=True, use_base_grammar=False)
+        """Execute one command given as command line arguments and return the exit code
+
+        This is the one shot path for calling a Cmd from shell scripts. The Cmd is created
+        without a line reader and the default hooks. The compiled grammar is cached in the
+        directory set in NESSAID_CLI_CACHE_DIR, it is compiled every time if that is not set.
+        """
+
+        cmd = cls(prompt="# ", show_grammar=False, disable_default_hooks=True, use_base_grammar=False,
+                  interactive=False, grammar_cache_dir=configured_cache_dir())
         return cmd.exec_args(*args)
 
     @classmethod
@@ -420,6 +490,36 @@ class NessaidCmd(NessaidCli):
         finally:
             self.exit_grammar()
 
+    async def execute_script(self, lines, stop_on_error=True, on_result=None):
+        """Execute the command lines from an iterable against the Cmd grammar
+
+        :param lines: An iterable of lines, like a list of str or a file object opened in text mode
+        :param stop_on_error: Raise CliScriptError on the first line which does not match successfully
+        :param on_result: Callable to which each ScriptLineResult is passed instead of collecting them
+        :returns: list of ScriptLineResult objects, one for each executed line. Empty if on_result is given
+        :rtype: list
+        """
+
+        return await super().execute_script(
+            lines, grammarname=self.generate_root_grammar_name(),
+            stop_on_error=stop_on_error, on_result=on_result)
+
+    async def execute_file(self, filename, stop_on_error=True, on_result=None):
+        """Execute the command lines of a file against the Cmd grammar
+
+        The file is memory mapped and read lazily line by line.
+
+        :param filename: The file with the command lines
+        :param stop_on_error: Raise CliScriptError on the first line which does not match successfully
+        :param on_result: Callable to which each ScriptLineResult is passed instead of collecting them
+        :returns: list of ScriptLineResult objects, one for each executed line. Empty if on_result is given
+        :rtype: list
+        """
+
+        return await super().execute_file(
+            filename, grammarname=self.generate_root_grammar_name(),
+            stop_on_error=stop_on_error, on_result=on_result)
+
     async def _match(self, tok_list, dry_run=False, last_token_complete=False, arglist=None):
 
         self._timing_command = False
@@ -430,26 +530,30 @@ class NessaidCmd(NessaidCli):
             return await super().match(tok_list=tok_list, dry_run=dry_run,
                                        last_token_complete=last_token_complete, arglist=arglist)
 
-        start = time.time()
         if self._enable_profiling:
+            import pstats
+            import cProfile
             with cProfile.Profile() as pr:
                 res = await super().match(tok_list, dry_run, last_token_complete, arglist)
             if self._enable_profiling and enable_profiling:
                 stats = pstats.Stats(pr)
                 stats.sort_stats('cumtime')
                 stats.print_stats()
-                print("Token Hit:", self._token_hit)
-                print("Token Miss:", self._token_miss)
-                print("Token Value Hit:", self._token_value_hit)
-                print("Token Value Miss:", self._token_value_miss)
+                state = self._last_match_state
+                print("Token Hit:", state.token_hit)
+                print("Token Miss:", state.token_miss)
+                print("Token Value Hit:", state.token_value_hit)
+                print("Token Value Miss:", state.token_value_miss)
         else:
             res = await super().match(tok_list, dry_run, last_token_complete, arglist)
-        end = time.time()
 
         if not self._timing_command and self._enable_timing:
-            print("start:", start, file=self.stdout)
-            print("end:", end, file=self.stdout)
-            print("Time taken:", end - start, file=self.stdout)
+            from nessaid_cli.metrics import format_duration
+            state = self._last_match_state
+            print("Time taken: {} ms".format(format_duration(state.match_ns)), file=self.stdout)
+            for phase, duration in state.phase_durations.items():
+                if duration is not None:
+                    print("    {}: {} ms".format(phase, format_duration(duration)), file=self.stdout)
 
         self._timing_command = False
         self._profiling_command = False
@@ -507,6 +611,143 @@ class NessaidCmd(NessaidCli):
         self._timing_command = True
         self._enable_timing = enable_timing
 
+    def do__tracing(self, enable_tracing, directory):
+        """
+        << $directory = ""; >>
+        "cmd-tracing"
+        (
+            "on" << $enable_tracing = True; >>
+            {
+                TRACE_DIR << $directory = $1; >>
+            }
+            |
+            "off" << $enable_tracing = False; >>
+        )
+        """
+        if not enable_tracing:
+            self.disable_tracing()
+            return
+
+        if not directory:
+            directory = self._trace_dir
+        if not directory:
+            import tempfile
+            directory = os.path.join(tempfile.gettempdir(), "nessaid_cli_traces")
+        self.enable_tracing(directory)
+        print("Writing traces to", directory, file=self.stdout)
+
+    def do__allocations(self, action, snapshots):
+        """
+        << $action = ""; $snapshots = False; >>
+        "cmd-allocations"
+        {
+            (
+                "on" << $action = $1; >>
+                {
+                    "snapshots" << $snapshots = True; >>
+                }
+                |
+                "off" << $action = $1; >>
+                |
+                "reset" << $action = $1; >>
+            )
+        }
+        """
+        if action == "on":
+            self.enable_allocation_tracking(snapshots=snapshots)
+            return
+        elif action == "off":
+            self.disable_allocation_tracking()
+            return
+
+        tracker = self.allocation_tracker
+        if tracker is None:
+            print("Allocation tracking is off", file=self.stdout)
+            return
+        if action == "reset":
+            tracker.reset()
+            return
+
+        print("{:30s} {:>6s} {:>12s} {:>12s} {:>12s} {:>12s} {:>12s}".format(
+            "command", "runs", "tokenize KiB", "match KiB", "binding KiB", "peak KiB", "retained KiB"),
+            file=self.stdout)
+        for command, entry in sorted(tracker.summary().items()):
+            net = entry["net"]
+            print("{:30s} {:6d} {:12.1f} {:12.1f} {:12.1f} {:12.1f} {:12.1f}{}".format(
+                command, entry["runs"], net["tokenize"] / 1024, net["match"] / 1024, net["binding"] / 1024,
+                entry["peak"] / 1024, entry["retained"] / 1024, "  GROWING" if entry["growing"] else ""),
+                file=self.stdout)
+            if entry["growing"] and entry["top_lines"]:
+                for line in entry["top_lines"]:
+                    print("    " + line, file=self.stdout)
+        if tracker.overlapped:
+            print("{} lines overlapping other lines were not recorded".format(tracker.overlapped), file=self.stdout)
+
+    async def do__explain(self, line, execute):
+        """
+        << $execute = False; >>
+        "cmd-explain"
+        EXPLAIN_LINE << $line = $2; >>
+        {
+            "execute" << $execute = True; >>
+        }
+        """
+        from nessaid_cli.metrics import PositionCollector, format_duration
+
+        success, error, tokens = self.tokenize(line)
+        if not success:
+            print(error, file=self.stdout)
+            return
+
+        collector = PositionCollector()
+        self.add_match_observer(collector)
+        try:
+            # Without execute the line is matched as for completion, the handler is not called
+            await self.match([str(t) for t in tokens], dry_run=not execute, last_token_complete=True, arglist=[])
+        finally:
+            self.remove_match_observer(collector)
+
+        print("{:>4s} {:24s} {:>10s} {:>8s} {:>8s} {:>8s} {:>11s} {:>10s}".format(
+            "pos", "token", "candidates", "choices", "lookups", "nodes", "token calls", "ms"), file=self.stdout)
+        for p in collector.positions:
+            token = str(p.token) if len(str(p.token)) <= 24 else str(p.token)[:21] + "..."
+            print("{:4d} {:24s} {:10d} {:8d} {:8d} {:8d} {:11d} {:>10s}".format(
+                p.position, token, p.candidates, p.prompt_choices, p.lookup_tokens, p.tree_nodes,
+                p.token_calls, format_duration(p.duration_ns)), file=self.stdout)
+
+        state, result = collector.state, collector.result
+        if state is None:
+            return
+        print("Result: {}{}".format(result.result, ": " + result.error if result.error else ""), file=self.stdout)
+        print("Command: {}".format(state.command or "-"), file=self.stdout)
+        print("Time taken: {} ms".format(format_duration(state.match_ns)), file=self.stdout)
+
+    def do__stats(self, reset):
+        """
+        << $reset = False; >>
+        "cmd-stats"
+        {
+            "reset" << $reset = True; >>
+        }
+        """
+        from nessaid_cli.metrics import format_duration
+
+        if self.metrics is None:
+            print("Metrics are not recorded", file=self.stdout)
+            return
+
+        if reset:
+            self.metrics.reset()
+            return
+
+        print("{:30s} {:12s} {:>8s} {:>10s} {:>10s} {:>10s}".format(
+            "command", "phase", "count", "p50 ms", "p95 ms", "p99 ms"), file=self.stdout)
+        for command, phases in self.metrics.snapshot().items():
+            for phase, summary in phases.items():
+                print("{:30s} {:12s} {:8d} {:>10s} {:>10s} {:>10s}".format(
+                    command, phase, summary["count"], format_duration(summary["p50"]),
+                    format_duration(summary["p95"]), format_duration(summary["p99"])), file=self.stdout)
+
     def do__system_info(self):
         """
         "system-info"
@@ -517,6 +758,8 @@ class NessaidCmd(NessaidCli):
             self.print("need psutil for this")
             return
 
+        from datetime import datetime
+
         self.print("="*40, "Boot Time", "="*40)
         boot_time_timestamp = psutil.boot_time()
         bt = datetime.fromtimestamp(boot_time_timestamp)
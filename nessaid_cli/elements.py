@@ -5,6 +5,8 @@
 # file included as part of this package.
 #
 
+import contextvars
+
 from nessaid_cli.tokens import CliToken, MATCH_FAILURE, NullTokenValue
 from nessaid_cli.lex_yacc_common import DollarVariable
 from nessaid_cli.utils import ExtendedString
@@ -557,9 +559,35 @@ class GrammarSpecification:
         return None
 
 
+class CreationCounts():
+    """Lookup tokens and walk tree nodes created by the match running in a task
+
+    The constructors count them only while a match counting them is running in the process,
+    else they pay one attribute check.
+    """
+
+    # Number of the running matches counting the creations
+    active = 0
+
+    def __init__(self):
+        self.lookup_tokens = 0
+        self.tree_nodes = 0
+
+
+creation_counts = contextvars.ContextVar("nessaid_cli_creation_counts", default=None)
+
+
+def _count_creation(name):
+    counts = creation_counts.get()
+    if counts is not None:
+        setattr(counts, name, getattr(counts, name) + 1)
+
+
 class LookupToken():
 
     def __init__(self, node):
+        if CreationCounts.active:
+            _count_creation("lookup_tokens")
         self._lookup_path = {}
         self._node = node
         self._name = self._node.element.value
@@ -685,13 +713,12 @@ class TreeNode():
         self._path = parent.path + (position,) if parent else (position, )
         self._element = element
         self._children = {}
-        self.reset()
-
-    def reset(self):
-        self._input_sequence = []
-        self._named_vars = {}
-        self._numbered_vars = {}
-        self._parents = []
+        # The nodes from this one up to, but excluding the root. The walk tree holds no per match
+        # or per execution state, so a tree can be shared by concurrent matches.
+        self._parents = (self, ) + parent.parents if parent else ()
+        tree.node_count += 1
+        if CreationCounts.active:
+            _count_creation("tree_nodes")
 
     @property
     def child_count(self):
@@ -702,29 +729,12 @@ class TreeNode():
 
     @property
     def parents(self):
-        if not self._parents:
-            node = self
-            while node.parent:
-                self._parents.append(node)
-                node = node.parent
         return self._parents
 
     @property
     def tree(self):
         return self._tree
 
-    @property
-    def input_sequence(self):
-        return self._input_sequence
-
-    @property
-    def named_variables(self):
-        return self._named_vars
-
-    @property
-    def token_variables(self):
-        return self._numbered_vars
-
     @property
     def parent(self):
         return self._parent
@@ -749,12 +759,6 @@ class TreeNode():
     def repeat_count(self):
         return self._element.repeat_count
 
-    def add_named_variable(self, var):
-        self._named_vars[var.var_id] = var
-
-    def add_numbered_variable(self, var):
-        self._numbered_vars[var.var_id] = var
-
     def get(self, position):
 
         if position in self._children:
@@ -769,9 +773,9 @@ class TreeNode():
         elif isinstance(self._element, InputElementCollection):
             self._children[position] = TreeNode(self.tree, self, position, self._element.value[position])
         elif isinstance(self._element, NamedGrammar) or isinstance(self._element, GrammarRefElement):
-            self._children = [TreeNode(self.tree, self, 0, self._element.value)]
+            self._children[position] = TreeNode(self.tree, self, 0, self._element.value)
         else:
-            self._children = [TreeNode(self.tree, self, 0, self._element)]
+            self._children[position] = TreeNode(self.tree, self, 0, self._element)
         return self._children[position]
 
     def first(self):
@@ -802,7 +806,17 @@ class TreeNode():
 class GrammarWalkTree(TreeNode):
 
     def __init__(self, grammar):
+        self.node_count = 0
+        # Nodes already added to the tree_nodes_created counters
+        self.counted_nodes = 0
         super().__init__(self, None, 0, grammar)
+        self._firsts = None
+
+    def first(self):
+        # The start tokens of a grammar do not change, lookup tokens are not modified once created
+        if self._firsts is None:
+            self._firsts = super().first()
+        return self._firsts
 
 
 class _EndOfInpuToken(LookupToken, CliToken):
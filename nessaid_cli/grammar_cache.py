@@ -0,0 +1,141 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import os
+import sys
+import stat
+import pickle
+import hashlib
+
+
+# Bump this when the pickled form of the grammar elements changes
+GRAMMAR_CACHE_VERSION = 2
+
+# The modules whose classes are pickled, and the ones producing them. The cache key is computed
+# from their contents, so a changed or reinstalled module does not load the stale grammars.
+_PICKLED_MODULES = (
+    "nessaid_cli.elements",
+    "nessaid_cli.lex_yacc_common",
+    "nessaid_cli.binding_parser.binding_objects",
+)
+_SOURCE_FILES = (
+    "elements.py",
+    "lex_yacc_common.py",
+    "compiler.py",
+    os.path.join("binding_parser", "binding_objects.py"),
+    os.path.join("binding_parser", "binding_text_parser.py"),
+)
+
+_source_signature = None
+
+
+class _GrammarUnpickler(pickle.Unpickler):
+    """Unpickler loading only the classes of the grammar elements"""
+
+    def find_class(self, module, name):
+        if module not in _PICKLED_MODULES:
+            raise pickle.UnpicklingError("Unexpected class in the grammar cache: {}.{}".format(module, name))
+        return super().find_class(module, name)
+
+
+def default_cache_dir():
+    """Returns the directory used to cache the compiled grammars across processes
+
+    NESSAID_CLI_CACHE_DIR overrides the default which is nessaid_cli in the user cache directory.
+    The cache is not used unless the directory is passed as grammar_cache_dir, see configured_cache_dir.
+    """
+
+    cache_dir = os.environ.get("NESSAID_CLI_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "nessaid_cli")
+
+
+def configured_cache_dir():
+    """Returns the cache directory set in NESSAID_CLI_CACHE_DIR, None if the cache is not enabled"""
+    return os.environ.get("NESSAID_CLI_CACHE_DIR") or None
+
+
+def _is_private(st):
+    # Only the cache written by this user can be loaded, anything else could run code when unpickled
+    if hasattr(os, "geteuid") and st.st_uid != os.geteuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _get_source_signature():
+    global _source_signature
+
+    if _source_signature is None:
+        signature = [str(GRAMMAR_CACHE_VERSION), sys.version]
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for filename in _SOURCE_FILES:
+            try:
+                with open(os.path.join(package_dir, filename), "rb") as fd:
+                    signature.append("{}:{}".format(filename, hashlib.sha256(fd.read()).hexdigest()))
+            except OSError:
+                signature.append(filename)
+        _source_signature = "\n".join(signature)
+    return _source_signature
+
+
+def grammar_cache_key(grammar_text):
+    digest = hashlib.sha256(_get_source_signature().encode("utf-8"))
+    digest.update(grammar_text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_grammar(grammar_text, cache_dir=None):
+    """Returns the GrammarSpecification for the grammar text, compiling it only when not cached
+
+    :param grammar_text: The grammar specification as string
+    :param cache_dir: Directory of the compiled grammar cache. The grammar is compiled every time if None.
+        The directory and the cached files are used only if they are owned by the current user and
+        are not group or world writable.
+    :returns: a GrammarSpecification object
+    :rtype: GrammarSpecification
+    """
+
+    if cache_dir is None:
+        from nessaid_cli.compiler import compile_grammar
+        return compile_grammar(grammar_text)
+
+    filename = os.path.join(cache_dir, grammar_cache_key(grammar_text) + ".pickle")
+    try:
+        if _is_private(os.stat(cache_dir)):
+            fd = os.open(filename, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+            with os.fdopen(fd, "rb") as f:
+                if _is_private(os.fstat(f.fileno())):
+                    from nessaid_cli.elements import GrammarSpecification
+                    grammar_set = _GrammarUnpickler(f).load()
+                    if isinstance(grammar_set, GrammarSpecification):
+                        return grammar_set
+    except Exception:
+        pass
+
+    from nessaid_cli.compiler import compile_grammar
+    grammar_set = compile_grammar(grammar_text)
+
+    try:
+        import tempfile
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if not _is_private(os.stat(cache_dir)):
+            return grammar_set
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(grammar_set, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, filename)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+    except Exception:
+        # The cache is an optimization, a read only or full disk should not fail the Cmd
+        pass
+
+    return grammar_set
@@ -6,8 +6,12 @@
 #
 
 import asyncio
+import contextvars
+from time import perf_counter_ns
 
 from nessaid_cli.utils import StdStreamsHolder, convert_to_python_string
+from nessaid_cli import metrics
+from nessaid_cli import tracing
 
 
 from nessaid_cli.tokens import (
@@ -29,7 +33,9 @@ from nessaid_cli.elements import (
     AlternativeInputElement,
     GrammarSpecification,
     map_grammar_arguments,
-    OrderlessSetInputElement
+    OrderlessSetInputElement,
+    CreationCounts,
+    creation_counts,
 )
 
 
@@ -48,6 +54,13 @@ from nessaid_cli.lex_yacc_common import (
 )
 
 
+class MatchLimitExceeded(Exception):
+
+    def __init__(self, msg, limit=None):
+        self.limit = limit
+        super().__init__(msg)
+
+
 class TokenCompletion(str):
 
     def __new__(cls, completion, helpstring):
@@ -71,6 +84,15 @@ class ParsingResult():
         self.next_constant_token = None
         self.matched_values = []
         self.case_insensitive = False
+        self.limit_exceeded = None
+
+    def copy(self):
+        cp = ParsingResult()
+        cp.__dict__.update(self.__dict__)
+        cp.matched_sequence = self.matched_sequence.copy()
+        cp.next_tokens = self.next_tokens.copy()
+        cp.matched_values = self.matched_values.copy()
+        return cp
 
     def as_dict(self):
         return {
@@ -84,6 +106,7 @@ class ParsingResult():
             'last_token': self.last_token,
             'next_constant_token': self.next_constant_token,
             'case_insensitive': self.case_insensitive,
+            'limit_exceeded': self.limit_exceeded,
         }
 
     def __repr__(self):
@@ -128,9 +151,10 @@ class ParsingResult():
 
         for t in tokens:
             if t:
-                helpstring = await t.get_helpstring(cur_input if cur_input else "", cli=cli)
                 if t.completable:
                     _, completions = await cli.complete_token(t, cur_input if cur_input else "")
+                    # After the completion, the help can tell about the completion in progress
+                    helpstring = await t.get_helpstring(cur_input if cur_input else "", cli=cli)
                     if not completions:
                         next_tokens.add(TokenCompletion(None, helpstring))
                     else:
@@ -140,6 +164,7 @@ class ParsingResult():
                             h = await t.get_helpstring(str(c), cli=cli)
                             next_tokens.add(TokenCompletion(str(c), h))
                 else:
+                    helpstring = await t.get_helpstring(cur_input if cur_input else "", cli=cli)
                     next_tokens.add(TokenCompletion(None, helpstring))
             else:
                 add_EOI = True
@@ -165,6 +190,206 @@ class ParsingResult():
                         self.next_constant_token = str(completion[0])
 
 
+class NodeContext():
+    """Execution state of a walk tree node, the tree nodes themselves are not modified while executing"""
+
+    def __init__(self, node):
+        self._node = node
+        self._input_sequence = []
+        self._named_vars = {}
+        self._numbered_vars = {}
+
+    @property
+    def node(self):
+        return self._node
+
+    @property
+    def element(self):
+        return self._node.element
+
+    @property
+    def position(self):
+        return self._node.position
+
+    @property
+    def path(self):
+        return self._node.path
+
+    @property
+    def input_sequence(self):
+        return self._input_sequence
+
+    @property
+    def named_variables(self):
+        return self._named_vars
+
+    @property
+    def token_variables(self):
+        return self._numbered_vars
+
+    def add_named_variable(self, var):
+        self._named_vars[var.var_id] = var
+
+    def add_numbered_variable(self, var):
+        self._numbered_vars[var.var_id] = var
+
+
+class MatchPositions():
+    """Collects the TokenPosition figures of a match, for the match observers
+
+    The lookup tokens and the walk tree nodes are counted for the task of the match, from its
+    creation until finish is called, so the concurrent matches are not counted against its tokens.
+    """
+
+    def __init__(self, state):
+        self._state = state
+        self._current = None
+        self.positions = []
+        self.created = CreationCounts()
+        self._created_token = creation_counts.set(self.created)
+        CreationCounts.active += 1
+
+    def _counts(self):
+        return (self.created.lookup_tokens, self.created.tree_nodes,
+                self._state.token_evaluations, perf_counter_ns())
+
+    def begin(self, token_input):
+        self.end(0, 0)
+        self._current = (len(self.positions), token_input, self._counts())
+
+    def end(self, candidates, prompt_choices):
+        if self._current is None:
+            return
+        position, token_input, start = self._current
+        self._current = None
+        lookup_tokens, tree_nodes, token_calls, duration_ns = [
+            now - before for now, before in zip(self._counts(), start)]
+        self.positions.append(metrics.TokenPosition(
+            position, token_input, candidates, prompt_choices, lookup_tokens, tree_nodes, token_calls, duration_ns))
+
+    def finish(self):
+        # A match failing on a token ends before the choices of the next tokens
+        self.end(0, 0)
+        if self._created_token is not None:
+            creation_counts.reset(self._created_token)
+            self._created_token = None
+            CreationCounts.active -= 1
+        return self.positions
+
+
+class MatchState():
+    """State of one match call, kept apart from the interface so that matches can overlap"""
+
+    def __init__(self, grammar, parse_tree, dry_run=False):
+        self.grammar = grammar
+        self.parse_tree = parse_tree
+        self.dry_run = dry_run
+        self.matched_values = []
+        self.executing = False
+        self.token_hit = 0
+        self.token_miss = 0
+        self.token_value_hit = 0
+        self.token_value_miss = 0
+        self.token_evaluations = 0
+        self.str_cache_hit = 0
+        self.str_cache_miss = 0
+        self.candidate_sequences = 0
+        self.ambiguity_resolutions = 0
+        # Whether the result depends only on cacheable tokens and for how long it can be reused
+        self.cacheable = True
+        self.completion_ttl = None
+        self.tokens = set()
+        # The Trace of the match if tracing is enabled
+        self.trace = None
+        # The AllocationSample of the line if allocation tracking is enabled
+        self.allocations = None
+        # The MatchPositions of the match if the interface has match observers
+        self.positions = None
+        # Durations of the phases in ns, None for the phases not run
+        self.command = None
+        self.tokenize_ns = None
+        self.match_ns = None
+        self.token_eval_ns = 0
+        self.binding_ns = None
+        self.handler_ns = None
+
+    @property
+    def phase_durations(self):
+        return {
+            metrics.PHASE_TOKENIZE: self.tokenize_ns,
+            metrics.PHASE_DRY_RUN if self.dry_run else metrics.PHASE_MATCH: self.match_ns,
+            metrics.PHASE_TOKEN_EVAL: self.token_eval_ns,
+            metrics.PHASE_BINDING: self.binding_ns,
+            metrics.PHASE_HANDLER: self.handler_ns,
+        }
+
+    def add_token(self, token):
+        if token in self.tokens:
+            return
+        self.tokens.add(token)
+        if not token.cacheable:
+            self.cacheable = False
+        ttl = token.completion_ttl
+        if ttl is not None and (self.completion_ttl is None or ttl < self.completion_ttl):
+            self.completion_ttl = ttl
+
+
+_match_state = contextvars.ContextVar("nessaid_cli_match_state", default=None)
+
+
+class LineMeasures():
+    """Measures of an input line taken before its match, like the duration of tokenizing it
+
+    They are handed to the match of the line in the context of the task, so the lines tokenized
+    and matched concurrently in other tasks do not see them.
+    """
+
+    def __init__(self, allocations=None):
+        self.tokenize_ns = None
+        # The AllocationSample of the line if it is executed with allocation tracking enabled
+        self.allocations = allocations
+
+
+_line_measures = contextvars.ContextVar("nessaid_cli_line_measures", default=None)
+
+
+class SingleFlight():
+    """Shares one in flight call among the concurrent calls with the same key"""
+
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    @property
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._flights)}
+
+    def _flight_done(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # The waiters may all have been cancelled
+        if not flight.cancelled():
+            flight.exception()
+
+    async def call(self, key, coro_func, *args):
+        key = (asyncio.get_running_loop(), key)
+        flight = self._flights.get(key)
+        if flight is None:
+            self.calls += 1
+            flight = asyncio.ensure_future(coro_func(*args))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda f: self._flight_done(key, f))
+        else:
+            self.shared += 1
+        # Cancelling one waiter does not cancel the call shared with the others
+        return await asyncio.shield(flight)
+
+
+# Shared by the CLI objects of the process, the sessions of a server complete concurrently
+token_single_flight = SingleFlight()
+
+
 class ExecContext():
 
     def __init__(self, interface, root_grammar, arglist, stop_index = 0):
@@ -258,13 +483,14 @@ class ExecContext():
                     arglist = [await self.evaluate(arg) for arg in block.arglist]
                     _ = await self._interface.execute_binding_call(ext_fn, True, *arglist)
 
-    async def enter(self, element_node: TreeNode, token_value: str):
+    async def enter(self, node: TreeNode, token_value: str):
 
-        if element_node.path in self._element_stack_cache:
-            element_node = self._element_stack_cache[element_node.path]
+        if node.path in self._element_stack_cache:
+            element_node = self._element_stack_cache[node.path]
             element_node.input_sequence.append(token_value)
             return
 
+        element_node = NodeContext(node)
         element_node.input_sequence.append(token_value)
 
         element = element_node.element
@@ -343,14 +569,61 @@ class ExecContext():
         if type(element) == NamedGrammar:
             self._grammar_stack.pop()
 
-        element_node.reset()
+
+class TracedExecContext(ExecContext):
+    """ExecContext recording the spans of the executed bindings and elements in the Trace of the match
+
+    It is chosen for the matches being traced, the others do not pass through the wrappers.
+    """
+
+    def __init__(self, interface, root_grammar, arglist, stop_index=0, trace=None):
+        super().__init__(interface, root_grammar, arglist, stop_index)
+        self._trace = trace
+
+    async def execute_binding(self, binding_code):
+        start = perf_counter_ns()
+        try:
+            return await super().execute_binding(binding_code)
+        finally:
+            self._trace.add_span("binding", tracing.CATEGORY_BINDING, start)
+
+    async def enter(self, node: TreeNode, token_value: str):
+        start = perf_counter_ns()
+        try:
+            return await super().enter(node, token_value)
+        finally:
+            self._trace.add_span("enter", tracing.CATEGORY_EXEC, start,
+                                 args={"element": type(node.element).__name__, "path": str(node.path)})
+
+    async def exit(self, element_node: TreeNode):
+        start = perf_counter_ns()
+        try:
+            return await super().exit(element_node)
+        finally:
+            self._trace.add_span("exit", tracing.CATEGORY_EXEC, start,
+                                 args={"element": type(element_node.element).__name__, "path": str(element_node.path)})
+
+
+MATCH_LIMIT_CANDIDATES = 'candidates'
+MATCH_LIMIT_EVALUATIONS = 'evaluations'
+
+
+_coroutine_methods = {}
+
+
+def is_coroutine_method(obj, method_name):
+    key = (type(obj), method_name)
+    if key not in _coroutine_methods:
+        _coroutine_methods[key] = asyncio.iscoroutinefunction(getattr(obj, method_name))
+    return _coroutine_methods[key]
 
 
 class CliInterface(StdStreamsHolder):
 
     def __init__(self, loop, grammarset,
                  stdin=None, stdout=None, stderr=None,
-                 str_cache_size=128, token_value_cache_size=128):
+                 str_cache_size=128, token_value_cache_size=128,
+                 max_match_candidates=None, max_token_evaluations=None, match_yield_interval=64):
 
         if not isinstance(grammarset, GrammarSpecification):
             raise ValueError("GrammarSpecification object expected")
@@ -366,18 +639,33 @@ class CliInterface(StdStreamsHolder):
         self._stderr = stderr
 
         self._tokens = {}
+        self._token_definitions = {}
         self._grammars = grammarset
         self._grammar_stack = []
         self._token_class_map = None
-        self._matched_values = []
         self._parse_tree = None
+        self._parse_trees = {}
+        self._last_match_state = None
 
         self._str_cache = {}
         self._token_value_cache = {}
         self._str_cache_size = str_cache_size
         self._token_value_cache_size = token_value_cache_size
 
-        self._executing = False
+        self._max_match_candidates = max_match_candidates
+        self._max_token_evaluations = max_token_evaluations
+        self._match_yield_interval = match_yield_interval
+
+        # Registry of the phase duration histograms, None to not record them
+        self.metrics = metrics.default_registry
+        # Cumulative counters of this interface, added to the process counters
+        self.counters = metrics.Counters(parent=metrics.process_counters)
+        # TraceWriter of the executed lines, None if tracing is disabled
+        self.trace_writer = None
+        # AllocationTracker of the executed lines, None if allocation tracking is disabled
+        self.allocation_tracker = None
+        # MatchObserver objects called at the end of every match
+        self.match_observers = []
 
     @property
     def loop(self):
@@ -385,7 +673,51 @@ class CliInterface(StdStreamsHolder):
 
     @property
     def executing(self):
-        return self._executing
+        state = _match_state.get()
+        return state.executing if state else False
+
+    @property
+    def match_state(self):
+        """State of the match in progress in the current task, else of the last completed match"""
+        return _match_state.get() or self._last_match_state
+
+    @property
+    def active_match_state(self):
+        """State of the match in progress in the current task, None outside a match"""
+        return _match_state.get()
+
+    def start_line_measures(self, execute=False):
+        """Starts the measures of the input line tokenized and matched next in the current task
+
+        :param execute: The line is executed, its allocations are sampled if allocation tracking is enabled
+        """
+
+        # The measures of a line which was not matched, like an empty line, are dropped
+        self.discard_line_measures()
+        sample = None
+        if execute and self.allocation_tracker is not None:
+            sample = self.allocation_tracker.start()
+        measures = LineMeasures(sample)
+        _line_measures.set(measures)
+        return measures
+
+    @property
+    def line_measures(self):
+        """Measures of the input line to match next in the current task, None if there are none"""
+        return _line_measures.get()
+
+    def take_line_measures(self):
+        """Returns the measures of the line to match in the current task, None if there are none"""
+        measures = _line_measures.get()
+        if measures is not None:
+            _line_measures.set(None)
+        return measures
+
+    def discard_line_measures(self):
+        """Drops the measures of the line to match in the current task, when it is not matched"""
+        measures = self.take_line_measures()
+        if measures is not None and measures.allocations is not None and self.allocation_tracker is not None:
+            self.allocation_tracker.discard(measures.allocations)
 
     @property
     def current_grammar(self):
@@ -396,8 +728,18 @@ class CliInterface(StdStreamsHolder):
         return self._str_cache
 
     def cache_string(self, key, value):
+        self.count_str_cache(False)
         self._str_cache[key] = value
 
+    def count_str_cache(self, hit):
+        state = _match_state.get()
+        if state is None:
+            self.counters.add("str_cache_hits" if hit else "str_cache_misses")
+        elif hit:
+            state.str_cache_hit += 1
+        else:
+            state.str_cache_miss += 1
+
     def clear_str_cache(self):
         if len(self._str_cache) > self._str_cache_size:
             self._str_cache = {}
@@ -410,11 +752,49 @@ class CliInterface(StdStreamsHolder):
         self.clear_str_cache()
         self.clear_token_value_cache()
 
+    def set_match_limits(self, max_match_candidates=None, max_token_evaluations=None, match_yield_interval=None):
+        """Set the per line exploration budgets of the matcher
+
+        :param max_match_candidates: Maximum number of live candidate sequences, None for no limit
+        :param max_token_evaluations: Maximum number of token match/complete/get_value calls, None for no limit
+        :param match_yield_interval: Yield to the event loop after these many token evaluations, None to keep
+        """
+        self._max_match_candidates = max_match_candidates
+        self._max_token_evaluations = max_token_evaluations
+        if match_yield_interval is not None:
+            self._match_yield_interval = match_yield_interval
+
+    async def count_token_evaluation(self):
+        state = _match_state.get()
+        if state is None:
+            return
+
+        state.token_evaluations += 1
+        if self._max_token_evaluations and state.token_evaluations > self._max_token_evaluations:
+            raise MatchLimitExceeded(
+                "Match aborted: more than {} token evaluations for the input".format(self._max_token_evaluations),
+                limit=MATCH_LIMIT_EVALUATIONS)
+
+        if self._match_yield_interval and state.token_evaluations % self._match_yield_interval == 0:
+            await asyncio.sleep(0)
+
+    def check_candidate_count(self, matching_sequences):
+        if self._max_match_candidates and len(matching_sequences) > self._max_match_candidates:
+            raise MatchLimitExceeded(
+                "Match aborted: more than {} candidate sequences for the input".format(self._max_match_candidates),
+                limit=MATCH_LIMIT_CANDIDATES)
+
+    def get_parse_tree(self, grammar):
+        # Walk trees hold no per match state, the nodes memoized by earlier matches are reused
+        if grammar.name not in self._parse_trees:
+            self._parse_trees[grammar.name] = GrammarWalkTree(grammar)
+        return self._parse_trees[grammar.name]
+
     def enter_grammar(self, grammar_name):
         try:
             grammar = self._grammars.get_grammar(grammar_name)
             self._grammar_stack.append(grammar)
-            self._parse_tree = GrammarWalkTree(grammar)
+            self._parse_tree = self.get_parse_tree(grammar)
         except Exception as e:
             raise e
 
@@ -422,7 +802,7 @@ class CliInterface(StdStreamsHolder):
         try:
             self._grammar_stack.pop()
             if self._grammar_stack:
-                self._parse_tree = GrammarWalkTree(self._grammar_stack[-1])
+                self._parse_tree = self.get_parse_tree(self._grammar_stack[-1])
         except Exception as e:
             raise e
 
@@ -439,8 +819,11 @@ class CliInterface(StdStreamsHolder):
         if not (isinstance(name, str) and name):
             raise ValueError("Expected valid token name")
 
+        state = _match_state.get()
+
         if (name, helpstring) not in self._tokens:
-            self._token_miss += 1
+            if state:
+                state.token_miss += 1
             tokendef = self._grammars.get_tokendef(name)
             if tokendef:
                 if self._token_class_map is None:
@@ -451,6 +834,7 @@ class CliInterface(StdStreamsHolder):
                     try:
                         self._tokens[(name, helpstring)] = self._token_class_map[tokendef.classname](
                             name, *tokendef.arglist, cli=self, helpstring=helpstring)
+                        self.add_token_definition(self._tokens[(name, helpstring)], tokendef.arglist, helpstring)
                         return self._tokens[(name, helpstring)]
                     except Exception as e:
                         self.error("Exception creating token object from token def:", e)
@@ -460,15 +844,46 @@ class CliInterface(StdStreamsHolder):
                     try:
                         self._tokens[(name, helpstring)] =  _globals[tokendef.classname](
                             name, *tokendef.arglist, cli=self, helpstring=helpstring)
+                        self.add_token_definition(self._tokens[(name, helpstring)], tokendef.arglist, helpstring)
                         return self._tokens[(name, helpstring)]
                     except Exception as e:
                         self.error("Exception creating token object from token def:", e)
             self._tokens[(name, helpstring)] = self.create_cli_token(name, tokendef=tokendef, helpstring=helpstring)
-        else:
-            self._token_hit += 1
+        elif state:
+            state.token_hit += 1
 
         return self._tokens[(name, helpstring)]
 
+    def add_token_definition(self, token, arglist, helpstring):
+        try:
+            definition = (type(token), token.name, tuple(arglist), helpstring)
+            hash(definition)
+        except TypeError:
+            return
+        self._token_definitions[token] = definition
+
+    def get_token_definition(self, token):
+        """Returns the key of the token definition, shared by the CLI objects creating the same token"""
+        return self._token_definitions.get(token, token)
+
+    def get_single_flight_key(self, token):
+        """Returns the key of the calls to the token shared with the concurrent identical calls
+
+        Only the tokens not depending on the CLI object share the calls with other CLI objects.
+        """
+        if token.shared_across_clis:
+            return self.get_token_definition(token)
+        return (self, token)
+
+    def get_single_flight_stats(self):
+        return token_single_flight.stats
+
+    def get_counters(self):
+        """Returns the cumulative counters of the interface, with the nodes of its walk trees"""
+        counters = self.counters.snapshot()
+        counters["tree_nodes"] = sum(tree.node_count for tree in self._parse_trees.values())
+        return counters
+
     def get_cli_hook(self, func_name):
         return func_name
 
@@ -562,10 +977,20 @@ class CliInterface(StdStreamsHolder):
 
                 fn = getattr(self, self.get_cli_hook(func_name))
 
-                if asyncio.iscoroutinefunction(fn):
-                    res = await fn(*ext_args)
-                else:
-                    res = fn(*ext_args)
+                state = _match_state.get()
+                start = perf_counter_ns()
+                try:
+                    if asyncio.iscoroutinefunction(fn):
+                        res = await fn(*ext_args)
+                    else:
+                        res = fn(*ext_args)
+                finally:
+                    if state:
+                        # The command is the last hook called, the one of the matched rule
+                        state.command = func_name
+                        state.handler_ns = (state.handler_ns or 0) + perf_counter_ns() - start
+                        if state.trace:
+                            state.trace.add_span(func_name, tracing.CATEGORY_HOOK, start)
             else:
                 res = await self.resolve_local_function_call(func_name, *ext_args, **kwarg)
 
@@ -575,7 +1000,12 @@ class CliInterface(StdStreamsHolder):
 
     async def execute_success_sequence(self, matched_sequence, match_values, arglist):
 
-        exec_context = ExecContext(self, self.current_grammar, arglist, self._stop_index)
+        state = _match_state.get()
+        grammar = state.grammar if state else self.current_grammar
+        if state is not None and state.trace is not None:
+            exec_context = TracedExecContext(self, grammar, arglist, self._stop_index, trace=state.trace)
+        else:
+            exec_context = ExecContext(self, grammar, arglist, self._stop_index)
         token_values = match_values.copy()
         sequence_copy = matched_sequence.copy()
 
@@ -645,30 +1075,69 @@ class CliInterface(StdStreamsHolder):
 
     async def get_token_value(self, token, token_input):
 
+        await self.count_token_evaluation()
+        state = _match_state.get()
+        if state:
+            state.add_token(token)
+
         if token.cacheable:
             token_value_key = (token, token_input)
             if token_value_key in self._token_value_cache:
-                self._token_value_hit += 1
+                if state:
+                    state.token_value_hit += 1
                 return self._token_value_cache[token_value_key]
 
+        start = perf_counter_ns()
         try:
-            self._token_value_miss += 1
-            if asyncio.iscoroutinefunction(token.get_value):
-                value = await token.get_value(token_input, cli=self)
+            if state:
+                state.token_value_miss += 1
+            if token.shareable:
+                value = await token_single_flight.call(
+                    (self.get_single_flight_key(token), "get_value", token_input), self._get_token_value, token, token_input)
             else:
-                value =  token.get_value(token_input, cli=self)
+                value = await self._get_token_value(token, token_input)
             if token.cacheable:
                 self._token_value_cache[token_value_key] = value
             return value
         except:
             return NullTokenValue
+        finally:
+            if state:
+                state.token_eval_ns += perf_counter_ns() - start
+                if state.trace:
+                    state.trace.add_span(
+                        "token.get_value", tracing.CATEGORY_TOKEN, start, args={"token": token.name, "input": token_input})
+
+    async def _get_token_value(self, token, token_input):
+        if is_coroutine_method(token, 'get_value'):
+            return await token.get_value(token_input, cli=self)
+        return token.get_value(token_input, cli=self)
 
     def get_matched_values(self):
-        return self._matched_values.copy()
+        state = self.match_state
+        return state.matched_values.copy() if state else []
 
     async def match_token(self, token, token_input):
+        await self.count_token_evaluation()
+        state = _match_state.get()
+        if state:
+            state.add_token(token)
+        start = perf_counter_ns()
         try:
-            if asyncio.iscoroutinefunction(token.match):
+            if token.shareable:
+                return await token_single_flight.call(
+                    (self.get_single_flight_key(token), "match", token_input), self._match_token, token, token_input)
+            return await self._match_token(token, token_input)
+        finally:
+            if state:
+                state.token_eval_ns += perf_counter_ns() - start
+                if state.trace:
+                    state.trace.add_span(
+                        "token.match", tracing.CATEGORY_TOKEN, start, args={"token": token.name, "input": token_input})
+
+    async def _match_token(self, token, token_input):
+        try:
+            if is_coroutine_method(token, 'match'):
                 return await token.match(token_input, cli=self)
             else:
                 return token.match(token_input, cli=self)
@@ -676,8 +1145,26 @@ class CliInterface(StdStreamsHolder):
             return MATCH_FAILURE
 
     async def complete_token(self, token, token_input):
+        await self.count_token_evaluation()
+        state = _match_state.get()
+        if state:
+            state.add_token(token)
+        start = perf_counter_ns()
+        try:
+            if token.shareable:
+                return await token_single_flight.call(
+                    (self.get_single_flight_key(token), "complete", token_input), self._complete_token, token, token_input)
+            return await self._complete_token(token, token_input)
+        finally:
+            if state:
+                state.token_eval_ns += perf_counter_ns() - start
+                if state.trace:
+                    state.trace.add_span(
+                        "token.complete", tracing.CATEGORY_TOKEN, start, args={"token": token.name, "input": token_input})
+
+    async def _complete_token(self, token, token_input):
         try:
-            if asyncio.iscoroutinefunction(token.complete):
+            if is_coroutine_method(token, 'complete'):
                 return await token.complete(token_input, cli=self)
             else:
                 return token.complete(token_input, cli=self)
@@ -686,10 +1173,119 @@ class CliInterface(StdStreamsHolder):
 
     async def match(self, tok_list, dry_run=False, last_token_complete=False, arglist=None):
 
-        self._token_hit = 0
-        self._token_miss = 0
-        self._token_value_hit = 0
-        self._token_value_miss = 0
+        start = perf_counter_ns()
+        state = MatchState(self.current_grammar, self._parse_tree, dry_run)
+        state_token = _match_state.set(state)
+        # Tokenizing the line is the first phase of the match
+        measures = self.take_line_measures()
+        sample = None
+        if measures is not None:
+            state.tokenize_ns = measures.tokenize_ns
+            sample = measures.allocations
+        if self.trace_writer is not None and not dry_run:
+            state.trace = tracing.Trace(state.tokenize_ns)
+        if self.match_observers:
+            state.positions = MatchPositions(state)
+        if self.allocation_tracker is not None and not dry_run:
+            state.allocations = sample or self.allocation_tracker.start()
+
+        res = ParsingResult()
+
+        try:
+            return await self._match_input(state, res, tok_list, dry_run, last_token_complete, arglist)
+        except MatchLimitExceeded as e:
+            position = len(res.matched_sequence)
+            res.result = MATCH_FAILURE
+            res.error = str(e)
+            res.limit_exceeded = e.limit
+            if position < len(tok_list):
+                res.offending_token = tok_list[position]
+                res.offending_token_position = position
+            self.clear_caches()
+            return res
+        finally:
+            _match_state.reset(state_token)
+            self._last_match_state = state
+            state.match_ns = perf_counter_ns() - start
+            self.record_match_metrics(state)
+            if state.trace is not None and self.trace_writer is not None:
+                self.write_trace(state, start)
+            if state.positions is not None:
+                positions = state.positions.finish()
+                for observer in list(self.match_observers):
+                    observer.observe(state, res, positions)
+            # Last, to include the memory released by replacing the last match state
+            if state.allocations is not None and self.allocation_tracker is not None:
+                state.allocations.mark(metrics.PHASE_MATCH)
+                self.allocation_tracker.record(state.command or metrics.UNMATCHED_COMMAND, state.allocations)
+
+    def enable_tracing(self, directory, max_files=100):
+        """Write a trace of the spans of every executed line to a file in the directory
+
+        :param directory: Directory of the trace files, created if missing
+        :param max_files: Number of the latest trace files kept in the directory
+        """
+        self.trace_writer = tracing.TraceWriter(directory, max_files=max_files)
+
+    def disable_tracing(self):
+        self.trace_writer = None
+
+    def add_match_observer(self, observer):
+        """Call the MatchObserver at the end of every match, with the matcher figures of each input token"""
+        self.match_observers.append(observer)
+
+    def remove_match_observer(self, observer):
+        if observer in self.match_observers:
+            self.match_observers.remove(observer)
+
+    def enable_allocation_tracking(self, size=256, snapshots=False):
+        """Attribute the memory allocated by every executed line to its command, using tracemalloc
+
+        :param size: Number of the latest executed lines kept
+        :param snapshots: Take tracemalloc snapshots around the lines to find the source lines retaining memory
+        """
+        from nessaid_cli.allocations import AllocationTracker
+
+        self.disable_allocation_tracking()
+        self.allocation_tracker = AllocationTracker(size=size, snapshots=snapshots)
+
+    def disable_allocation_tracking(self):
+        if self.allocation_tracker is not None:
+            self.allocation_tracker.close()
+        self.allocation_tracker = None
+
+    def write_trace(self, state, start):
+        state.trace.finish(metrics.PHASE_MATCH, start, state.command)
+        try:
+            return self.trace_writer.write(state.trace)
+        except OSError as e:
+            self.error("Failed writing trace:", e)
+
+    def record_match_metrics(self, state):
+        counters = self.counters
+        counters.add("dry_run_matches" if state.dry_run else "matches")
+        counters.add("token_cache_hits", state.token_hit)
+        counters.add("token_cache_misses", state.token_miss)
+        counters.add("token_value_cache_hits", state.token_value_hit)
+        counters.add("token_value_cache_misses", state.token_value_miss)
+        counters.add("str_cache_hits", state.str_cache_hit)
+        counters.add("str_cache_misses", state.str_cache_miss)
+        counters.add("token_evaluations", state.token_evaluations)
+        counters.add("candidate_sequences", state.candidate_sequences)
+        counters.add("ambiguity_resolutions", state.ambiguity_resolutions)
+        tree = state.parse_tree
+        if tree is not None:
+            counters.add("tree_nodes_created", tree.node_count - tree.counted_nodes)
+            tree.counted_nodes = tree.node_count
+
+        if self.metrics is None:
+            return
+        command = state.command
+        if command is None:
+            command = metrics.COMPLETION_COMMAND if state.dry_run else metrics.UNMATCHED_COMMAND
+        self.metrics.observe_phases(command, state.phase_durations)
+
+    async def _match_input(self, state, res, tok_list, dry_run, last_token_complete, arglist):
 
         if not arglist:
             args = []
@@ -704,9 +1300,7 @@ class CliInterface(StdStreamsHolder):
         cur_token_input = None
         token_list = tok_list.copy()
 
-        prompt_choices = set(self._parse_tree.first())
-
-        res = ParsingResult()
+        prompt_choices = set(state.parse_tree.first())
 
         if not prompt_choices:
             res.result = MATCH_FAILURE
@@ -721,7 +1315,9 @@ class CliInterface(StdStreamsHolder):
                 if not c:
                     add_EOT = True
                     continue
-                next_tokens.add(self.get_token(c.name, c.helpstring))
+                token = self.get_token(c.name, c.helpstring)
+                state.add_token(token)
+                next_tokens.add(token)
             if add_EOT:
                 next_tokens.add(EndOfInpuToken)
             return await res.set_next_tokens(self, None if last_token_complete else cur_token_input, next_tokens)
@@ -743,13 +1339,13 @@ class CliInterface(StdStreamsHolder):
                 choices = matching_seq_choices.pop(0)
 
                 try:
-                    self._matched_values = []
+                    state.matched_values = []
                     i = 0
                     for t in sequence:
                         token = self.get_token(t.name)
                         value = await self.get_token_value(token, tok_list[i])
                         if value is not NullTokenValue:
-                            self._matched_values.append(value)
+                            state.matched_values.append(value)
                         i += 1
                 except Exception as e:
                     print("Exception getting matched values:", type(e), e, file=self._stderr)
@@ -830,13 +1426,13 @@ class CliInterface(StdStreamsHolder):
                 for matching_sequence in matching_sequences:
                     choices = set()
                     try:
-                        self._matched_values = []
+                        state.matched_values = []
                         i = 0
                         for t in matching_sequence:
                             token = self.get_token(t.name)
                             value = await self.get_token_value(token, tok_list[i])
                             if value is not NullTokenValue:
-                                self._matched_values.append(value)
+                                state.matched_values.append(value)
                             i += 1
                     except Exception as e:
                         print("Exception getting matched values:", type(e), e, file=self._stderr)
@@ -856,6 +1452,9 @@ class CliInterface(StdStreamsHolder):
                     matching_seq_choices.append(choices)
                     prompt_choices = prompt_choices.union(choices)
 
+            if not initial and state.positions is not None:
+                state.positions.end(len(matching_sequences), len(prompt_choices))
+
             initial = False
 
             if not token_list:
@@ -876,25 +1475,36 @@ class CliInterface(StdStreamsHolder):
                     res.matched_sequence.append(cur_token_input)
                     if not dry_run:
                         if seq_complete and len(matching_sequences) > 1:
+                            state.ambiguity_resolutions += 1
                             matching_sequences = await self.fix_sequences(matching_sequences, tok_list)
 
                         if seq_complete:
                             if len(matching_sequences) == 1:
                                 tok_index = 0
                                 match_values = []
-                                self._matched_values = []
+                                state.matched_values = []
                                 for t in matching_sequences[0]:
                                     token = self.get_token(t.name)
                                     match_value = await self.get_token_value(token, tok_list[tok_index])
                                     match_values.append(match_value)
-                                    self._matched_values.append(match_value)
+                                    state.matched_values.append(match_value)
                                     tok_index += 1
                                 res.matched_values = match_values
+                                binding_start = perf_counter_ns()
+                                if state.trace:
+                                    state.trace.end_step()
+                                if state.allocations:
+                                    state.allocations.mark(metrics.PHASE_MATCH)
                                 try:
-                                    self._executing = True
+                                    state.executing = True
                                     root_arglist = await self.execute_success_sequence(matching_sequences[0], match_values, args)
                                 finally:
-                                    self._executing = False
+                                    state.executing = False
+                                    state.binding_ns = perf_counter_ns() - binding_start
+                                    if state.trace:
+                                        state.trace.add_span(metrics.PHASE_BINDING, tracing.CATEGORY_BINDING, binding_start)
+                                    if state.allocations:
+                                        state.allocations.mark(metrics.PHASE_BINDING)
                                 arglen = len(arglist)
                                 for i in range(arglen):
                                     arglist[i] = root_arglist.pop(0)
@@ -925,6 +1535,10 @@ class CliInterface(StdStreamsHolder):
                     seq_copy = [[]]
                     matching_seq_choices = [prompt_choices]
                 matching_sequences = []
+                if state.trace:
+                    state.trace.step(cur_token_input, len(seq_copy))
+                if state.positions is not None:
+                    state.positions.begin(cur_token_input)
 
     def check_orderless_set_elements(self, tokens):
         elements = set([t.node.element for t in tokens])
@@ -937,6 +1551,10 @@ class CliInterface(StdStreamsHolder):
                     # return
                     pass
         matching_sequences.append(match)
+        state = _match_state.get()
+        if state:
+            state.candidate_sequences += 1
+        self.check_candidate_count(matching_sequences)
 
     async def fix_sequences(self, matching_sequences, tok_list):
         if len(set(len(seq) for seq in matching_sequences)) == 1:
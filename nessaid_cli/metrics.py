@@ -0,0 +1,436 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import os
+import time
+import collections
+
+
+# Phases of matching an input line. The phases nest: match includes the token evaluations and
+# the binding execution, the binding execution includes the handler.
+PHASE_TOKENIZE = "tokenize"
+PHASE_MATCH = "match"
+PHASE_DRY_RUN = "dry_run"
+PHASE_TOKEN_EVAL = "token_eval"
+PHASE_BINDING = "binding"
+PHASE_HANDLER = "handler"
+
+PHASES = (PHASE_TOKENIZE, PHASE_MATCH, PHASE_DRY_RUN, PHASE_TOKEN_EVAL, PHASE_BINDING, PHASE_HANDLER)
+
+# Command names of the lines not executing a handler
+COMPLETION_COMMAND = "(completion)"
+UNMATCHED_COMMAND = "(unmatched)"
+
+# Figures of the matcher at each input token position
+POSITION_FIELDS = ("candidates", "prompt_choices", "lookup_tokens", "tree_nodes", "token_calls", "duration_ns")
+
+TokenPosition = collections.namedtuple("TokenPosition", ("position", "token") + POSITION_FIELDS)
+TokenPosition.__doc__ = """Work done by the matcher for one input token
+
+candidates: Matching sequences left after the token
+prompt_choices: Tokens which can follow
+lookup_tokens, tree_nodes: Lookup tokens and walk tree nodes created
+token_calls: Token match, complete and get_value calls
+duration_ns: Time spent on the token
+"""
+
+# Significant bits kept of the recorded values, the buckets are within 1/16 of the values
+_HISTOGRAM_PRECISION_BITS = 5
+
+
+class Histogram():
+    """Histogram of nanosecond durations in logarithmic buckets
+
+    The memory used is bounded by the range of the values, not by their number.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        value = int(value)
+        shift = max(value.bit_length() - _HISTOGRAM_PRECISION_BITS, 0)
+        bucket = (value >> shift) << shift
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, percent):
+        """Returns the value below which percent of the values fall, within the bucket precision
+
+        The values are taken as spread evenly over their bucket, so the result is interpolated
+        between the lower and the upper bound of the bucket holding the rank.
+        """
+        if not self.count:
+            return 0
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            count = self._buckets[bucket]
+            if seen + count >= rank:
+                # The values of the first and the last buckets are within the min and the max
+                low = max(bucket, self.min)
+                high = min(bucket + (1 << max(bucket.bit_length() - _HISTOGRAM_PRECISION_BITS, 0)), self.max + 1)
+                return min(low + int((high - low) * max(rank - seen, 0) / count), self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min or 0,
+            "max": self.max or 0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class MetricsRegistry():
+    """Duration histograms of the input line phases, for each command name"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._position_histograms = {}
+        self._export_task = None
+
+    def observe(self, command, phase, duration_ns):
+        key = (command, phase)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(duration_ns)
+
+    def observe_phases(self, command, phase_durations):
+        for phase, duration_ns in phase_durations.items():
+            if duration_ns is not None:
+                self.observe(command, phase, duration_ns)
+
+    def get_histogram(self, command, phase):
+        return self._histograms.get((command, phase))
+
+    def observe_positions(self, command, positions):
+        """Records the TokenPosition figures of a matched line, one value per position"""
+        for position in positions:
+            for field in POSITION_FIELDS:
+                key = (command, field)
+                histogram = self._position_histograms.get(key)
+                if histogram is None:
+                    histogram = self._position_histograms[key] = Histogram()
+                histogram.observe(getattr(position, field))
+
+    def position_snapshot(self):
+        """Returns the position figures as a dict of command names to dicts of field to the summary"""
+        snapshot = {}
+        for (command, field), histogram in sorted(self._position_histograms.items()):
+            snapshot.setdefault(command, {})[field] = histogram.to_dict()
+        return snapshot
+
+    @property
+    def commands(self):
+        return sorted(set(command for command, _ in self._histograms))
+
+    def reset(self):
+        self._histograms = {}
+        self._position_histograms = {}
+
+    def snapshot(self):
+        """Returns the histograms as a dict of command names to dicts of phase to the summary"""
+        snapshot = {}
+        for (command, phase), histogram in sorted(self._histograms.items()):
+            snapshot.setdefault(command, {})[phase] = histogram.to_dict()
+        return snapshot
+
+    def export(self, filename):
+        """Write the snapshot to the JSON file, replacing it atomically"""
+        import json
+
+        data = {"time": time.time(), "unit": "ns", "commands": self.snapshot()}
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmpname, "w") as fd:
+            json.dump(data, fd, indent=2, sort_keys=True)
+        os.replace(tmpname, filename)
+
+    def start_export(self, filename, interval=60.0, loop=None):
+        """Export the snapshot to the file every interval seconds in an asyncio task
+
+        :param filename: Path of the JSON file
+        :param interval: Seconds between the exports
+        :param loop: The event loop to run the task in. The running loop if None
+        :returns: The export task, also stopped by stop_export
+        :rtype: asyncio.Task
+        """
+
+        import asyncio
+
+        async def export_loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    self.export(filename)
+                except OSError:
+                    pass
+
+        self.stop_export()
+        loop = loop or asyncio.get_event_loop()
+        self._export_task = loop.create_task(export_loop())
+        return self._export_task
+
+    def stop_export(self):
+        if self._export_task is not None:
+            self._export_task.cancel()
+            self._export_task = None
+
+
+# Shared by the CLI objects of the process unless they are given their own registry
+default_registry = MetricsRegistry()
+
+
+class MatchObserver():
+    """Base of the match instrumentation hooks, added to a CLI object with add_match_observer
+
+    The matcher records the TokenPosition figures only while the CLI object has observers.
+    """
+
+    def observe(self, state, result, positions):
+        """Called at the end of every match
+
+        :param state: The MatchState of the match, state.command is the executed handler if any
+        :param result: The ParsingResult of the match
+        :param positions: list of TokenPosition objects, one for each input token matched
+        """
+        raise NotImplementedError
+
+
+class PositionCollector(MatchObserver):
+    """Keeps the TokenPosition figures of the last match"""
+
+    def __init__(self):
+        self.state = None
+        self.result = None
+        self.positions = []
+
+    def observe(self, state, result, positions):
+        self.state = state
+        self.result = result
+        self.positions = positions
+
+
+class PositionMetrics(MatchObserver):
+    """Feeds the TokenPosition figures of the executed lines to a MetricsRegistry"""
+
+    def __init__(self, registry=None):
+        self.registry = default_registry if registry is None else registry
+
+    def observe(self, state, result, positions):
+        if state.dry_run:
+            return
+        command = state.command or UNMATCHED_COMMAND
+        self.registry.observe_positions(command, positions)
+
+
+def format_duration(duration_ns):
+    return "{:.3f}".format(duration_ns / 1e6)
+
+
+# Cumulative counters, name and help
+COUNTERS = (
+    ("matches", "Input lines matched for execution"),
+    ("dry_run_matches", "Input lines matched for completion"),
+    ("token_cache_hits", "Token object lookups served from the token cache"),
+    ("token_cache_misses", "Token objects created"),
+    ("token_value_cache_hits", "Token values served from the token value cache"),
+    ("token_value_cache_misses", "Token values evaluated"),
+    ("str_cache_hits", "CLI string conversions served from the string cache"),
+    ("str_cache_misses", "CLI string conversions done"),
+    ("token_evaluations", "Token match, complete and get_value calls"),
+    ("candidate_sequences", "Candidate sequences considered by the matcher"),
+    ("ambiguity_resolutions", "Multiple matching sequences resolved to one"),
+    ("tree_nodes_created", "Grammar walk tree nodes created"),
+)
+
+
+class Counters():
+    """Cumulative counters, also added to the parent counters if given"""
+
+    def __init__(self, parent=None):
+        self._parent = parent
+        self.values = {name: 0 for name, _ in COUNTERS}
+
+    def add(self, name, value=1):
+        if value:
+            self.values[name] = self.values.get(name, 0) + value
+            if self._parent is not None:
+                self._parent.add(name, value)
+
+    def reset(self):
+        self.values = {name: 0 for name, _ in COUNTERS}
+
+    def snapshot(self):
+        return dict(self.values)
+
+
+# Sum of the counters of all the CLI objects of the process
+process_counters = Counters()
+
+
+class MetricsExporter():
+    """Base of the metrics exporters, the subclasses render the metrics as text"""
+
+    content_type = "text/plain; charset=utf-8"
+
+    def __init__(self, registry=None):
+        """Creates the exporter of the process counters and the registry histograms
+
+        :param registry: The MetricsRegistry of the phase durations, the default registry if None
+        """
+
+        self.registry = default_registry if registry is None else registry
+        # The process counters add up those of all the CLI objects, they are exported under their own
+        # names so that summing the per CLI series does not count the matches twice
+        self.process_counters = process_counters
+        self._counters = []
+        self._export_task = None
+
+    def add_counters(self, counters, **labels):
+        """Export the counters, like those of a CLI object, with the labels identifying them"""
+        self._counters.append((labels, counters))
+
+    def remove_counters(self, counters):
+        self._counters = [(labels, c) for labels, c in self._counters if c is not counters]
+
+    def render(self):
+        raise NotImplementedError
+
+    def write(self, filename):
+        """Write the metrics to the file, replacing it atomically"""
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmpname, "w") as fd:
+            fd.write(self.render())
+        os.replace(tmpname, filename)
+
+    def start_file_export(self, filename, interval=15.0, loop=None):
+        """Write the metrics to the file every interval seconds in an asyncio task"""
+
+        import asyncio
+
+        async def export_loop():
+            while True:
+                try:
+                    self.write(filename)
+                except OSError:
+                    pass
+                await asyncio.sleep(interval)
+
+        self.stop_file_export()
+        loop = loop or asyncio.get_event_loop()
+        self._export_task = loop.create_task(export_loop())
+        return self._export_task
+
+    def stop_file_export(self):
+        if self._export_task is not None:
+            self._export_task.cancel()
+            self._export_task = None
+
+    async def serve(self, host="127.0.0.1", port=9464):
+        """Serve the metrics over HTTP on the local address
+
+        :returns: The asyncio server, closed by the caller
+        :rtype: asyncio.Server
+        """
+
+        import asyncio
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line or line in (b"\r\n", b"\n"):
+                        break
+                body = self.render().encode("utf-8")
+                writer.write(b"HTTP/1.0 200 OK\r\n")
+                writer.write("Content-Type: {}\r\n".format(self.content_type).encode("utf-8"))
+                writer.write("Content-Length: {}\r\n\r\n".format(len(body)).encode("utf-8"))
+                writer.write(body)
+                await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(escaped) + "}"
+
+
+class PrometheusExporter(MetricsExporter):
+    """Metrics in the Prometheus text exposition format"""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry=None, prefix="nessaid_cli"):
+        super().__init__(registry)
+        self.prefix = prefix
+
+    def _render_summaries(self, lines, metric, description, label, snapshot, scale=1):
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} summary".format(metric))
+        for command, summaries in snapshot.items():
+            for name, summary in summaries.items():
+                labels = {"command": command, label: name}
+                for quantile in ("50", "95", "99"):
+                    quantile_labels = dict(labels, quantile="0." + quantile)
+                    lines.append("{}{} {}".format(metric, _format_labels(quantile_labels), summary["p" + quantile] * scale))
+                lines.append("{}_sum{} {}".format(metric, _format_labels(labels), summary["sum"] * scale))
+                lines.append("{}_count{} {}".format(metric, _format_labels(labels), summary["count"]))
+
+    def render(self):
+        lines = []
+
+        for name, description in COUNTERS:
+            if self.process_counters is not None:
+                metric = "{}_process_{}_total".format(self.prefix, name)
+                lines.append("# HELP {} {}, all the CLI objects of the process".format(metric, description))
+                lines.append("# TYPE {} counter".format(metric))
+                lines.append("{} {}".format(metric, self.process_counters.values.get(name, 0)))
+            if self._counters:
+                metric = "{}_{}_total".format(self.prefix, name)
+                lines.append("# HELP {} {}".format(metric, description))
+                lines.append("# TYPE {} counter".format(metric))
+                for labels, counters in self._counters:
+                    lines.append("{}{} {}".format(metric, _format_labels(labels), counters.values.get(name, 0)))
+
+        if self.registry is not None:
+            self._render_summaries(
+                lines, "{}_phase_duration_seconds".format(self.prefix),
+                "Duration of the input line phases by command", "phase", self.registry.snapshot(), 1e-9)
+            self._render_summaries(
+                lines, "{}_match_position".format(self.prefix),
+                "Matcher figures for each input token by command", "field", self.registry.position_snapshot())
+
+        return "\n".join(lines) + "\n"
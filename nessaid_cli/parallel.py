@@ -0,0 +1,299 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import io
+import os
+import sys
+import time
+import asyncio
+import argparse
+import importlib
+import contextlib
+import collections
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from nessaid_cli.elements import EndOfInpuToken
+from nessaid_cli.tokens import MATCH_SUCCESS, MATCH_FAILURE
+from nessaid_cli.utils import iter_logical_lines, MappedFileReader
+
+
+_worker_cli = None
+_worker_loop = None
+
+
+class ScriptLineStatus():
+
+    def __init__(self, line_result):
+        res = line_result.result
+        self.line_number = line_result.line_number
+        self.line = line_result.line
+        self.result = res.result
+        self.error = res.error
+        self.offending_token = None if res.offending_token is None else str(res.offending_token)
+        self.offending_token_position = res.offending_token_position
+
+    @property
+    def success(self):
+        return self.result == MATCH_SUCCESS
+
+    def __repr__(self):
+        return "{}: {}: {}".format(self.line_number, self.line, self.result)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ScriptResult():
+
+    def __init__(self, index, script):
+        self.index = index
+        self.script = script if isinstance(script, (str, os.PathLike)) else None
+        self.lines = []
+        self.output = ""
+        self.error_output = ""
+        self.exception = None
+
+    @property
+    def success(self):
+        return self.exception is None and all(line.success for line in self.lines)
+
+    @property
+    def errors(self):
+        return [line for line in self.lines if not line.success]
+
+    @property
+    def returncode(self):
+        """Exit code of the script, 0 if every line succeeded, 1 otherwise"""
+        return 0 if self.success else 1
+
+    def __repr__(self):
+        return "Script {}: {}".format(self.index, "success" if self.success else "failure")
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ValidationError():
+
+    def __init__(self, line_number, line, error, offending_token=None, offending_token_position=None):
+        self.line_number = line_number
+        self.line = line
+        self.error = error
+        self.offending_token = offending_token
+        self.offending_token_position = offending_token_position
+
+    def __repr__(self):
+        return "{}: {}".format(self.line_number, self.error)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ValidationReport():
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.errors = []
+        self.line_count = 0
+        self.elapsed = 0.0
+
+    @property
+    def success(self):
+        return not self.errors
+
+    @property
+    def lines_per_second(self):
+        return self.line_count / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return "{}: {} lines, {} errors, {:.1f} lines/s".format(
+            self.filename, self.line_count, len(self.errors), self.lines_per_second)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def _init_worker(cmd_class, cmd_kwargs):
+    global _worker_cli, _worker_loop
+
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_cli = cmd_class(loop=_worker_loop, **cmd_kwargs)
+
+
+def _execute_script(index, script, stop_on_error):
+    result = ScriptResult(index, script)
+    stdout, stderr = io.StringIO(), io.StringIO()
+
+    def on_result(line_result):
+        result.lines.append(ScriptLineStatus(line_result))
+
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            if isinstance(script, (str, os.PathLike)):
+                coro = _worker_cli.execute_file(script, stop_on_error=stop_on_error, on_result=on_result)
+            else:
+                coro = _worker_cli.execute_script(script, stop_on_error=stop_on_error, on_result=on_result)
+            _worker_loop.run_until_complete(coro)
+    except Exception as e:
+        result.exception = "{}: {}".format(type(e).__name__, e)
+
+    result.output = stdout.getvalue()
+    result.error_output = stderr.getvalue()
+    return result
+
+
+async def _validate_lines(cli, lines):
+    errors = []
+    for line_number, line in lines:
+        success, error, tokens = cli.tokenize(line)
+        if not success:
+            errors.append(ValidationError(line_number, line, error))
+            continue
+        if not tokens:
+            continue
+
+        input_tokens = [str(t) for t in tokens]
+        res = await cli.match(input_tokens, dry_run=True, last_token_complete=True)
+        if res.result == MATCH_FAILURE:
+            errors.append(ValidationError(
+                line_number, line, res.error, None if res.offending_token is None else str(res.offending_token),
+                res.offending_token_position))
+        elif EndOfInpuToken not in res.next_tokens:
+            errors.append(ValidationError(line_number, line, "Input sequence is not complete"))
+    return errors
+
+
+def _validate_chunk(lines):
+    if not _worker_cli.current_grammar:
+        _worker_cli.enter_grammar(_worker_cli.generate_root_grammar_name())
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return _worker_loop.run_until_complete(_validate_lines(_worker_cli, lines))
+
+
+def _chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_file(cmd_class, filename, workers=None, chunk_size=1000, **cmd_kwargs):
+    """Validate the syntax of every line of a command file with dry run matches in worker processes
+
+    The logical lines of the file, after joining the continuation lines, are split in chunks
+    and matched against the root grammar of the Cmd class in a pool of worker processes.
+    No command is executed.
+
+    :param cmd_class: NessaidCmd subclass whose grammar is used for validation
+    :param filename: The file with the command lines
+    :param workers: Number of worker processes, defaults to the CPU count
+    :param chunk_size: Number of lines sent to a worker at a time
+    :param cmd_kwargs: Keyword arguments to create the Cmd instances in the workers
+    :returns: ValidationReport with the errors in line order
+    :rtype: ValidationReport
+    """
+
+    report = ValidationReport(filename)
+    workers = workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cmd_class, cmd_kwargs)) as executor:
+        with MappedFileReader(filename) as reader:
+            # Keep a bounded number of chunks in flight so that the file is not loaded as a whole
+            pending = collections.deque()
+            for chunk in _chunks(iter_logical_lines(reader), chunk_size):
+                report.line_count += len(chunk)
+                pending.append(executor.submit(_validate_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    report.errors += pending.popleft().result()
+            while pending:
+                report.errors += pending.popleft().result()
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nessaid_cli.parallel",
+        description="Validate the syntax of a command file against the grammar of a Cmd class")
+    parser.add_argument("cmd_class", help="The Cmd class as module:ClassName")
+    parser.add_argument("filename", help="The command file to validate")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Number of lines sent to a worker at a time")
+    args = parser.parse_args(argv)
+
+    module_name, _, class_name = args.cmd_class.partition(":")
+    cmd_class = getattr(importlib.import_module(module_name), class_name)
+
+    report = validate_file(cmd_class, args.filename, workers=args.workers, chunk_size=args.chunk_size)
+    for error in report.errors:
+        print("{}:{}: {}".format(args.filename, error.line_number, error.error))
+        print("    {}".format(error.line))
+    print("{} lines validated in {:.3f}s ({:.1f} lines/s), {} errors".format(
+        report.line_count, report.elapsed, report.lines_per_second, len(report.errors)))
+    return 0 if report.success else 1
+
+
+class ScriptPool():
+    """Execute independent command scripts in parallel worker processes
+
+    Every worker process creates one instance of the Cmd class when it starts, so the
+    grammar is compiled once per worker and reused for all the scripts it runs.
+    The Cmd class should be importable from a module for the workers to create it.
+    """
+
+    def __init__(self, cmd_class, workers=None, stop_on_error=False, **cmd_kwargs):
+        """Creates the worker pool
+
+        :param cmd_class: NessaidCmd subclass used to execute the scripts
+        :param workers: Number of worker processes, defaults to the CPU count
+        :param stop_on_error: Stop executing a script at its first failing line
+        :param cmd_kwargs: Keyword arguments to create the Cmd instances in the workers
+        """
+
+        self._stop_on_error = stop_on_error
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(cmd_class, cmd_kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def map(self, scripts, ordered=True):
+        """Execute the scripts and yield a ScriptResult for each of them
+
+        :param scripts: Iterable of scripts. A script is a filename or a list of lines
+        :param ordered: Yield the results in the order of the scripts. Else as they complete
+        :returns: A generator of ScriptResult objects
+        """
+
+        futures = [
+            self._executor.submit(_execute_script, index, script, self._stop_on_error)
+            for index, script in enumerate(scripts)
+        ]
+
+        if ordered:
+            for future in futures:
+                yield future.result()
+        else:
+            for future in as_completed(futures):
+                yield future.result()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
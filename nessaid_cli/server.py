@@ -0,0 +1,268 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import sys
+import asyncio
+import argparse
+import importlib
+import tracemalloc
+
+from nessaid_readline.async_readline import NessaidReadlineEOF
+
+
+class SessionStream():
+    """File like object writing to the stream of a client session"""
+
+    def __init__(self, writer, encoding="utf-8"):
+        self._writer = writer
+        self._encoding = encoding
+
+    def write(self, s):
+        if not self._writer.is_closing():
+            self._writer.write(s.encode(self._encoding, errors="replace"))
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class SessionReadline():
+    """Line mode replacement of NessaidAsyncReadline for a client session
+
+    The client sends complete lines. A line ending with '?' or TAB runs the completer
+    for the text before it, lists the completions and keeps the text as the start of
+    the next line.
+    """
+
+    COMPLETION_CHARS = ("?", "\t")
+
+    def __init__(self, reader, stdout, on_eof=None, encoding="utf-8"):
+        self._reader = reader
+        self._stdout = stdout
+        self._on_eof = on_eof
+        self._encoding = encoding
+        self._completer = None
+        self._line_buffer = ""
+        self._input_prompt = None
+        self._enable_bell = False
+        self._history = []
+        self._history_size = 100
+        self._prepare_history_entry = lambda entry: entry
+
+    def set_completer(self, completer):
+        self._completer = completer
+
+    def parse_and_bind(self, config):
+        pass
+
+    def set_prepare_history_entry(self, func):
+        self._prepare_history_entry = func
+
+    def set_history_size(self, hsize):
+        self._history_size = hsize
+
+    def enable_bell(self, enable=True):
+        self._enable_bell = enable
+
+    def play_bell(self):
+        if self._enable_bell:
+            self._stdout.write("\a")
+
+    def handle_external_keyboard_interrupt(self):
+        pass
+
+    def get_line_buffer(self):
+        return self._line_buffer
+
+    async def insert_text(self, text):
+        self._line_buffer += text
+
+    async def _read_line(self):
+        data = await self._reader.readline()
+        if not data:
+            if self._on_eof:
+                self._on_eof()
+            raise NessaidReadlineEOF()
+        return data.decode(self._encoding, errors="replace").rstrip("\r\n")
+
+    async def _complete(self):
+        options = []
+        state = 0
+        while self._completer:
+            c = await self._completer(self._line_buffer, state)
+            if c is None:
+                break
+            options.append(c)
+            state += 1
+        if options:
+            self._stdout.write("\n" + "\n".join(options) + "\n\n")
+
+    async def _input(self, prompt, complete):
+        self._input_prompt = prompt
+        self._line_buffer = ""
+        try:
+            while True:
+                self._stdout.write(self._input_prompt + self._line_buffer)
+                self._line_buffer += await self._read_line()
+                if not (complete and self._line_buffer.endswith(self.COMPLETION_CHARS)):
+                    return self._line_buffer
+                self._line_buffer = self._line_buffer[:-1]
+                await self._complete()
+        finally:
+            self._input_prompt = None
+
+    async def readline(self, prompt=None):
+        line = await self._input(prompt or "", complete=True)
+        entry = self._prepare_history_entry(line)
+        if entry:
+            self._history.append(entry)
+            del self._history[:-self._history_size]
+        return line
+
+    async def input(self, prompt=None, mask_input=False): # noqa
+        return await self._input(prompt or "", complete=False)
+
+
+class CliSession():
+
+    def __init__(self, session_id, peer, cli, memory=None):
+        self.session_id = session_id
+        self.peer = peer
+        self.cli = cli
+        self.memory = memory
+
+    def __repr__(self):
+        memory = "n/a" if self.memory is None else "{:.1f} KiB".format(self.memory / 1024)
+        return "Session {}: {}: memory overhead: {}".format(self.session_id, self.peer, memory)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class CliServer():
+    """Serve a Cmd class to many concurrent client sessions from one process
+
+    Every session gets its own Cmd instance with its own interface state and streams.
+    The compiled grammar is shared by all the sessions, so it is built once for the process.
+    """
+
+    def __init__(self, cmd_class, unix_path=None, host=None, port=None, intro=None,
+                 trace_memory=False, **cmd_kwargs):
+        """Creates the server
+
+        :param cmd_class: NessaidCmd subclass served to the clients
+        :param unix_path: Path of the Unix socket to listen on
+        :param host: Host address of the TCP listener
+        :param port: Port of the TCP listener
+        :param intro: Intro text sent to the clients on connect
+        :param trace_memory: Trace the allocations with tracemalloc to report the per session memory
+        :param cmd_kwargs: Keyword arguments to create the Cmd instances
+        """
+
+        if unix_path is None and port is None:
+            raise ValueError("Expected a Unix socket path or TCP port to listen on")
+
+        self._cmd_class = cmd_class
+        self._unix_path = unix_path
+        self._host = host
+        self._port = port
+        self._intro = intro
+        self._cmd_kwargs = cmd_kwargs
+        self._servers = []
+        self._sessions = {}
+        self._session_count = 0
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def sessions(self):
+        return list(self._sessions.values())
+
+    def log(self, *args):
+        print(*args, file=sys.stderr)
+
+    def create_cli(self, loop, stdout, readline):
+        return self._cmd_class(loop=loop, stdout=stdout, stderr=stdout, readline=readline, **self._cmd_kwargs)
+
+    async def handle_session(self, reader, writer):
+        self._session_count += 1
+        session_id = self._session_count
+        peer = writer.get_extra_info("peername") or self._unix_path
+        stream = SessionStream(writer)
+        session = None
+
+        def on_eof():
+            for cli in session.cli._cli_stack:
+                cli.exit_loop()
+
+        try:
+            memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+            readline = SessionReadline(reader, stream, on_eof=on_eof)
+            cli = self.create_cli(asyncio.get_running_loop(), stream, readline)
+            if memory is not None:
+                memory = tracemalloc.get_traced_memory()[0] - memory
+
+            session = CliSession(session_id, peer, cli, memory)
+            self._sessions[session_id] = session
+            self.log("Started:", session)
+
+            await cli.cmdloop(intro=self._intro)
+        except Exception as e:
+            self.log("Session {}: Exception: {}: {}".format(session_id, type(e), e))
+        finally:
+            self._sessions.pop(session_id, None)
+            self.log("Closed: Session {}".format(session_id))
+            writer.close()
+
+    async def start(self):
+        if self._unix_path is not None:
+            self._servers.append(await asyncio.start_unix_server(self.handle_session, path=self._unix_path))
+        if self._port is not None:
+            self._servers.append(await asyncio.start_server(self.handle_session, host=self._host, port=self._port))
+
+    async def serve_forever(self):
+        if not self._servers:
+            await self.start()
+        await asyncio.gather(*[server.serve_forever() for server in self._servers])
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nessaid_cli.server",
+        description="Serve a Cmd class to multiple client sessions over Unix or TCP sockets")
+    parser.add_argument("cmd_class", help="The Cmd class as module:ClassName")
+    parser.add_argument("--unix", default=None, help="Path of the Unix socket to listen on")
+    parser.add_argument("--host", default="127.0.0.1", help="Host address of the TCP listener")
+    parser.add_argument("--port", type=int, default=None, help="Port of the TCP listener")
+    parser.add_argument("--prompt", default="# ", help="The prompt of the sessions")
+    parser.add_argument("--trace-memory", action="store_true", help="Report the memory overhead of each session")
+    args = parser.parse_args(argv)
+
+    module_name, _, class_name = args.cmd_class.partition(":")
+    cmd_class = getattr(importlib.import_module(module_name), class_name)
+
+    server = CliServer(cmd_class, unix_path=args.unix, host=args.host, port=args.port,
+                       trace_memory=args.trace_memory, prompt=args.prompt)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,10 +6,13 @@
 #
 
 import os
-import string
-import fnmatch
-import platform
-from pathlib import Path
+import sys
+import time
+import bisect
+import asyncio
+import itertools
+import threading
+import collections
 
 from nessaid_cli.utils import (
     convert_to_cli_string,
@@ -97,6 +100,31 @@ class CliToken():
     def cacheable(self):
         return True
 
+    @property
+    def shareable(self):
+        """Whether the results depend only on the token, the CLI object and the input
+
+        Concurrent identical calls to shareable tokens share one in flight call.
+        """
+        return False
+
+    @property
+    def shared_across_clis(self):
+        """Whether the results of a shareable token do not depend on the CLI object either
+
+        The calls are then shared also by different CLI objects with the same token definition.
+        """
+        return False
+
+    @property
+    def completion_ttl(self):
+        """Seconds for which the completions of an input line with this token can be reused
+
+        None means the completions are reused until the cache is invalidated by executing a command.
+        Tokens which are not cacheable never have their completions reused.
+        """
+        return None
+
     async def get_value(self, match_string=None, cli=None):
         if self.completable:
             _, completions = await self.complete(match_string, cli=cli)
@@ -167,9 +195,67 @@ class CliToken():
             return MATCH_PARTIAL
 
 
+class PrefixIndex():
+    """Sorted array of strings answering the prefix queries with bisect
+
+    Counting and membership are O(log n), the strings with a prefix are yielded lazily in order.
+    """
+
+    def __init__(self, strings):
+        self._strings = sorted(set(strings))
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __contains__(self, string):
+        i = bisect.bisect_left(self._strings, string)
+        return i < len(self._strings) and self._strings[i] == string
+
+    def prefix_range(self, prefix):
+        """Returns the start and end index of the strings starting with prefix"""
+        start = bisect.bisect_left(self._strings, prefix)
+        if not prefix:
+            return start, len(self._strings)
+        end = start
+        # The strings with the prefix sort before prefix with its last character incremented
+        if ord(prefix[-1]) < sys.maxunicode:
+            end = bisect.bisect_left(self._strings, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        else:
+            while end < len(self._strings) and self._strings[end].startswith(prefix):
+                end += 1
+        return start, end
+
+    def count(self, prefix):
+        start, end = self.prefix_range(prefix)
+        return end - start
+
+    def iter_prefix(self, prefix):
+        start, end = self.prefix_range(prefix)
+        for i in range(start, end):
+            yield self._strings[i]
+
+
 class AlternativeStringsToken(CliToken):
+    """Any one of the alternative strings, looked up by prefix in a sorted index
+
+    All the alternatives matching the input are completed unless max_suggestions is given. With
+    it, an input matching more alternatives completes as TOO_MANY_COMPLETIONS, like the tokens
+    whose values are not listed. The matcher then has no completions to report the input as
+    ambiguous, so an input prefixing more than max_suggestions alternatives fails to execute with
+    "Could not match any rule" instead of "Ambiguous options".
+    """
+
+    # Completions of more alternatives are reported as too many to list, None to list all of them
+    MAX_SUGGESTIONS = None
+    # Alternatives listed in the help string
+    HELP_ITEMS = 10
+
+    def __init__(self, name, alternatives, *args, cli=None, helpstring=None, max_suggestions=None):
+        """Creates the token
+
+        :param max_suggestions: Most alternatives completed for an input, all of them if None
+        """
 
-    def __init__(self, name, alternatives, *args, cli=None, helpstring=None):
         super().__init__(name, cli=cli, helpstring=helpstring)
         if (isinstance(alternatives, list) or
             isinstance(alternatives, set) or
@@ -180,24 +266,42 @@ class AlternativeStringsToken(CliToken):
         else:
             self._alternatives = [alternatives]
         self._cli_strings = [convert_to_cli_string(s) for s in self._alternatives]
+        self._index = PrefixIndex(self._cli_strings)
+        self._max_suggestions = self.MAX_SUGGESTIONS if max_suggestions is None else max_suggestions
+
+    def format_alternatives(self, alternatives, count):
+        if count <= self.HELP_ITEMS:
+            return "Any one of: {}".format(set(alternatives))
+        shown = ", ".join(repr(a) for a in itertools.islice(alternatives, self.HELP_ITEMS))
+        return "Any one of: {{{}, ...}} ({} alternatives)".format(shown, count)
 
     @property
     def helpstring(self):
-        return self._helpstring or "Any one of: {}".format(set(self._cli_strings))
+        return self._helpstring or self.format_alternatives(self._index.iter_prefix(""), len(self._index))
 
     @property
     def completable(self):
         return True
 
+    def _too_many(self, count):
+        return self._max_suggestions is not None and count > self._max_suggestions
+
     async def complete(self, token_input, cli=None):
-        return await CliToken.complete_from_multiple(self._cli_strings, token_input, cli=cli)
+        if not token_input:
+            if self._too_many(len(self._cli_strings)):
+                return TOO_MANY_COMPLETIONS, []
+            return len(self._cli_strings), list(self._cli_strings)
+        n = self._index.count(token_input)
+        if self._too_many(n):
+            return TOO_MANY_COMPLETIONS, []
+        return n, list(self._index.iter_prefix(token_input))
 
     async def get_helpstring(self, match_string=None, cli=None):
-        _, matches = await self.complete(match_string, cli)
-        if matches:
-            if len(matches) == 1:
-                return matches[0]
-            return "Any one of: {}".format(set(matches))
+        n = self._index.count(match_string or "")
+        if n == 1:
+            return next(self._index.iter_prefix(match_string or ""))
+        elif n:
+            return self.format_alternatives(self._index.iter_prefix(match_string or ""), n)
         return self.helpstring
 
     async def get_value(self, match_string=None, cli=None):
@@ -205,7 +309,113 @@ class AlternativeStringsToken(CliToken):
         return v
 
     async def match(self, token_input, cli=None):
-        return await CliToken.match_from_multiple(self._cli_strings, token_input, cli=cli)
+        if token_input and token_input in self._index:
+            return MATCH_SUCCESS
+        n = len(self._cli_strings) if not token_input else self._index.count(token_input)
+        if n == 0:
+            return MATCH_FAILURE
+        elif n == 1:
+            return MATCH_SUCCESS
+        return MATCH_PARTIAL
+
+
+class DynamicValuesToken(AlternativeStringsToken):
+    """Alternatives fetched from an async value provider, cached for a time to live
+
+    The provider is a callable, or the name of a method of the CLI object, returning the values
+    or an awaitable of them. Subclasses may override get_values instead. Expired values are still
+    used while they are refreshed in the background. A call waits for the provider at most timeout
+    seconds and falls back to the last known values, which are empty before the first refresh.
+    """
+
+    TTL = 5.0
+    TIMEOUT = 0.5
+
+    def __init__(self, name, provider=None, ttl=None, timeout=None, cli=None, helpstring=None, max_suggestions=None):
+        """Creates the token
+
+        :param provider: Callable returning the values, or the name of a method of the CLI object
+        :param ttl: Seconds the values are used without refreshing them
+        :param timeout: Seconds a match or completion waits for the provider
+        """
+
+        super().__init__(name, [], cli=cli, helpstring=helpstring, max_suggestions=max_suggestions)
+        self._provider = provider
+        self._ttl = self.TTL if ttl is None else float(ttl)
+        self._timeout = self.TIMEOUT if timeout is None else float(timeout)
+        self._expires = None
+        self._refresh_task = None
+        self.last_error = None
+
+    @property
+    def cacheable(self):
+        # The values change over time, the matcher should not keep the results
+        return False
+
+    @property
+    def shareable(self):
+        # The completions running at the same time share one refresh of the provider
+        return True
+
+    @property
+    def shared_across_clis(self):
+        # A provider named by a CLI method, or an overridden get_values, can depend on the session
+        return callable(self._provider) and type(self).get_values is DynamicValuesToken.get_values
+
+    @property
+    def helpstring(self):
+        if self._helpstring or self._cli_strings:
+            return super().helpstring
+        return "Any value of {}".format(self._name)
+
+    async def get_values(self, cli=None):
+        provider = self._provider
+        if isinstance(provider, str):
+            provider = getattr(cli, provider)
+        values = provider()
+        if asyncio.iscoroutine(values) or asyncio.isfuture(values):
+            values = await values
+        return values
+
+    async def refresh(self, cli=None):
+        try:
+            values = await self.get_values(cli=cli)
+            self._alternatives = list(values)
+            self._cli_strings = [convert_to_cli_string(str(v)) for v in self._alternatives]
+            self._index = PrefixIndex(self._cli_strings)
+            self.last_error = None
+        except Exception as e:
+            # The last known values are kept
+            self.last_error = e
+        self._expires = time.monotonic() + self._ttl
+
+    async def load_values(self, cli=None):
+        if self._expires is not None and time.monotonic() < self._expires:
+            return
+
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self.refresh(cli=cli))
+
+        if self._expires is not None:
+            # Stale values are used while refreshing
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._refresh_task), self._timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def complete(self, token_input, cli=None):
+        await self.load_values(cli=cli)
+        return await super().complete(token_input, cli=cli)
+
+    async def match(self, token_input, cli=None):
+        await self.load_values(cli=cli)
+        return await super().match(token_input, cli=cli)
+
+    async def get_helpstring(self, match_string=None, cli=None):
+        await self.load_values(cli=cli)
+        return await super().get_helpstring(match_string, cli=cli)
 
 
 class StringToken(CliToken):
@@ -274,6 +484,19 @@ class RangedStringToken(StringToken):
         return MATCH_PARTIAL
 
 
+# Limits and number of the prefix range lookup of a RangedIntToken input. The inputs resolved
+# without a lookup have their (count, completions) as the result, None otherwise.
+_RangedIntLimits = collections.namedtuple("_RangedIntLimits", ["negative", "min_limit", "max_limit", "number", "result"])
+
+
+def _lookup_limits(negative, min_limit, max_limit, number):
+    return _RangedIntLimits(negative, min_limit, max_limit, number, None)
+
+
+def _resolved_limits(count, completions):
+    return _RangedIntLimits(False, 0, 0, 0, (count, completions))
+
+
 class RangedIntToken(CliToken):
 
     def __init__(self, name, start, end, max_suggestions=10, cli=None, helpstring=None):
@@ -302,77 +525,106 @@ class RangedIntToken(CliToken):
     def completable(self):
         return True
 
-    async def _complete(self, min_limit, max_limit, number):
+    def _prefix_ranges(self, min_limit, max_limit, number):
+        """Yield the ranges of integers between the limits whose decimal form starts with number
+
+        The ranges are yielded in increasing order, one for each number of digits.
+        Limits and number are non negative, an input of 0 stands for the whole range.
+        """
 
         if number == 0:
-            if (max_limit - min_limit + 1) > self._max_suggestions:
-                return max_limit - min_limit + 1, []
-            return max_limit - min_limit + 1, list(range(min_limit, max_limit + 1))
+            yield range(min_limit, max_limit + 1)
+            return
 
-        if number > max_limit:
-            return 0, []
+        low = number
+        span = 1
+        while low <= max_limit:
+            lower = max(low, min_limit)
+            upper = min(low + span - 1, max_limit)
+            if lower <= upper:
+                yield range(lower, upper + 1)
+            low *= 10
+            span *= 10
 
-        min_len = len(str(min_limit))
-        max_len = len(str(max_limit))
-        number_len = len(str(number))
+    def _count(self, min_limit, max_limit, number, limit=None):
+        """Count the integers between the limits whose decimal form starts with number
+
+        The count stops once it exceeds limit, callers only tell a single match from many.
+        """
+
+        if number == 0:
+            return max_limit - min_limit + 1
 
         count = 0
+        low = number
+        span = 1
+        while low <= max_limit:
+            upper = low + span - 1
+            if upper >= min_limit:
+                count += min(upper, max_limit) - max(low, min_limit) + 1
+                if limit is not None and count > limit:
+                    break
+            low *= 10
+            span *= 10
+        return count
+
+    def _complete(self, min_limit, max_limit, number):
+        count = self._count(min_limit, max_limit, number, self._max_suggestions)
+        if count > self._max_suggestions:
+            return count, []
         completions = []
-        min_num = number
-        max_num = number
-        num_len = number_len
-        power = 10
-
-        if num_len < min_len:
-            while num_len < min_len:
-                min_num = min_num * 10
-                max_num = min_num + power - 1
-                num_len += 1
-                power *= 10
-
-        if num_len == min_len:
-            if num_len == max_len and (max_num < min_limit or min_num > max_limit):
-                return 0, []
-            else:
-                lower_limit = max(min_limit, min_num)
-                upper_limit = min(max_limit, max_num)
-                count = len(range(lower_limit, upper_limit + 1))
-                if count > self._max_suggestions:
-                    return count, []
-                completions = list(range(lower_limit, upper_limit + 1))
-                if num_len == max_len or count > self._max_suggestions:
-                    return count, completions
-        else:
-            count = 1
-            completions = [number]
-
-        num_len = num_len + 1
-        min_num = min_num * 10
-        max_num = min_num + power - 1
-
-        while num_len < max_len:
-            count += power
-            if count > self._max_suggestions:
-                return count, []
-
-            completions += list(range(min_num, max_num + 1))
-            num_len += 1
-            power = 10 ** (num_len - number_len)
-            min_num = min_num * 10
-            max_num = min_num + power - 1
-
-        if min_num <= max_limit and num_len == max_len:
-            count += len(range(min_num, min(max_num, max_limit) + 1))
-            if count > self._max_suggestions:
-                return count, []
-            completions += list(range(min_num, min(max_num, max_limit) + 1))
-
+        for r in self._prefix_ranges(min_limit, max_limit, number):
+            completions.extend(r)
         return count, completions
 
+    def _limits(self, token_input):
+        """Map the input to the non negative limits and number used to look up the prefix ranges
+
+        Returns a _RangedIntLimits tuple, whose result is the (count, completions) of the inputs resolved
+        without a lookup, else None.
+        """
+
+        if token_input == '-':
+            if self._start >= 0:
+                return _resolved_limits(0, [])
+            if self._end >= 0:
+                return _lookup_limits(True, 0, -self._start, 0)
+            return _lookup_limits(True, -self._end, -self._start, 0)
+
+        try:
+            if token_input.isnumeric():
+                number = int(token_input)
+            else:
+                return _resolved_limits(0, [])
+        except Exception:
+            return _resolved_limits(0, [])
+
+        if number < 0 or token_input.startswith("-"):
+            if number == 0 and self._start == 0:
+                return _resolved_limits(1, ["0"])
+            if self._start >= 0:
+                return _resolved_limits(0, [])
+            if self._end >= 0:
+                return _lookup_limits(True, 0, -self._start, -number)
+            return _lookup_limits(True, -self._end, -self._start, -number)
+
+        if self._end < 0:
+            return _resolved_limits(0, [])
+        if self._start <= 0:
+            return _lookup_limits(False, 0, self._end, number)
+        return _lookup_limits(False, self._start, self._end, number)
+
     async def match(self, token_input, cli=None):
         if isinstance(token_input, str):
-            n, _comps = await self.complete(token_input, cli=cli) # noqa
-            if n > 1 or n == TOO_MANY_COMPLETIONS:
+            if token_input == '':
+                n = self._end - self._start + 1
+            else:
+                limits = self._limits(token_input)
+                if limits.result is not None:
+                    n = limits.result[0]
+                else:
+                    n = self._count(limits.min_limit, limits.max_limit, limits.number, limit=1)
+            if n > 1:
                 return MATCH_PARTIAL
             elif n == 1:
                 return MATCH_SUCCESS
@@ -380,21 +632,7 @@ class RangedIntToken(CliToken):
 
     async def complete(self, token_input, cli=None): # noqa
         if isinstance(token_input, str) and str:
-            count = 0
-            comps = []
-
-            if token_input == '-':
-                if self._start >= 0:
-                    return 0, []
-                if self._end >= 0:
-                    comp_args = [0, -self._start, 0]
-                else:
-                    comp_args = [-self._end, -self._start, 0]
-                n, comps = await self._complete(*comp_args)
-                if n > 0 and not comps:
-                    return TOO_MANY_COMPLETIONS, []
-                return n, [-c for c in comps]
-            elif token_input == '':
+            if token_input == '':
                 count = self._end - self._start + 1
                 if count > 10:
                     return count, []
@@ -408,41 +646,18 @@ class RangedIntToken(CliToken):
                     comps = list(range(self._start, self._end + 1))
                 return count, comps
 
-            else:
-                try:
-                    if token_input.isnumeric():
-                        number = int(token_input)
-                    else:
-                        return 0, []
-                except Exception:
-                    return 0, []
-
-                if number < 0 or token_input.startswith("-"):
-                    if number == 0 and self._start == 0:
-                        return 1, ["0"]
-                    if self._start >= 0:
-                        return 0, []
-                    if self._end >= 0:
-                        comp_args = [0, -self._start, -number]
-                    else:
-                        comp_args = [-self._end, -self._start, -number]
-
-                    n, comps = await self._complete(*comp_args)
-                    if n > 0 and not comps:
-                        return TOO_MANY_COMPLETIONS, []
-                    return n, [str(-c) for c in comps]
-                else:
-                    if self._end < 0:
-                        return 0, []
+            limits = self._limits(token_input)
+            if limits.result is not None:
+                return limits.result
 
-                    if self._start <= 0:
-                        comp_args = [0, self._end, number]
-                    else:
-                        comp_args = [self._start, self._end, number]
-                    n, comps = await self._complete(*comp_args)
-                    if n > 0 and not comps:
-                        return TOO_MANY_COMPLETIONS, []
-                    return n,  [str(c) for c in comps]
+            n, comps = self._complete(limits.min_limit, limits.max_limit, limits.number)
+            if n > 0 and not comps:
+                return TOO_MANY_COMPLETIONS, []
+            if token_input == '-':
+                return n, [-c for c in comps]
+            if limits.negative:
+                return n, [str(-c) for c in comps]
+            return n, [str(c) for c in comps]
 
 
 class RangedDecimalToken(CliToken):
@@ -494,16 +709,133 @@ class RangedDecimalToken(CliToken):
         return NullTokenValue
 
 
+class DirectoryListingCache():
+    """LRU of directory listings, revalidated against the directory mtime
+
+    A listing maps the names in the directory to whether they are directories, as reported by
+    os.scandir without a stat for each entry. A cached listing is used as long as the mtime and
+    the ctime of the directory are unchanged. Directories modified within MTIME_GRANULARITY seconds of the
+    listing are not cached, their mtime may not change on the next modification.
+    """
+
+    MTIME_GRANULARITY = 2.0
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._listings = collections.OrderedDict()
+        # The listings are done in the path scan threads
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+    def listing(self, path, cancelled=None):
+        path = os.fspath(path)
+        st = os.stat(path)
+        mtime = st.st_mtime_ns
+        # The listings are keyed on the directory itself and its absolute path, a relative path names
+        # another directory after a chdir and an inode can be reused by a new directory
+        key = (st.st_dev, st.st_ino, os.path.abspath(path))
+        stamp = (mtime, st.st_ctime_ns)
+
+        with self._lock:
+            entry = self._listings.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._listings.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        listed_at = time.time_ns()
+        content = {}
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                if cancelled is not None and cancelled.is_set():
+                    raise PathScanCancelled(path)
+                try:
+                    content[dir_entry.name] = dir_entry.is_dir()
+                except OSError:
+                    content[dir_entry.name] = False
+
+        with self._lock:
+            if listed_at - mtime >= self.MTIME_GRANULARITY * 1e9 and self.maxsize > 0:
+                self._listings[key] = (stamp, content)
+                self._listings.move_to_end(key)
+                while len(self._listings) > self.maxsize:
+                    self._listings.popitem(last=False)
+            else:
+                self._listings.pop(key, None)
+        return content
+
+
+class PathScanCancelled(Exception):
+    """Raised in a path scan thread when the scan is no longer needed"""
+    pass
+
+
+PATH_SCAN_WORKERS = 2
+
+_path_scan_executor = None
+
+
+def get_path_scan_executor():
+    """Returns the thread pool shared by the path tokens for the filesystem work"""
+    global _path_scan_executor
+
+    if _path_scan_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _path_scan_executor = ThreadPoolExecutor(max_workers=PATH_SCAN_WORKERS, thread_name_prefix="nessaid-path-scan")
+    return _path_scan_executor
+
+
+class _PathScan():
+
+    def __init__(self, loop, scan_func, str_input):
+        self.cancelled = threading.Event()
+        self.waiters = 0
+        self.future = loop.run_in_executor(get_path_scan_executor(), scan_func, str_input, self.cancelled)
+        # Nobody waits for a cancelled scan, its exception is consumed here
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
 class PathTokenPath():
 
-    def __init__(self, path, path_string, partial=False):
-        self.path = path
+    def __init__(self, path, path_string, partial=False, is_dir=None):
+        """Path object for the PathToken lookups
+
+        :param path: The Path object, created from path_string when needed if None
+        :param path_string: The path as typed
+        :param partial: Whether path_string is a prefix of the path
+        :param is_dir: Whether the path is a directory, as seen in the directory listing. Checked if None
+        """
+
+        self._path = path
         self.path_string = path_string
         self.partial = partial
-        self.is_dir = path.is_dir()
-        self.exists = path.exists()
+        self.is_dir = self.path.is_dir() if is_dir is None else is_dir
+        self._exists = None
         self.has_dir_completion = False
 
+    @property
+    def path(self):
+        if self._path is None:
+            from pathlib import Path
+            self._path = Path(self.path_string)
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        self._path = path
+
+    @property
+    def exists(self):
+        if self._exists is None:
+            self._exists = self.path.exists()
+        return self._exists
+
     def __repr__(self):
         return "{}: {}".format(self.path, self.path_string)
 
@@ -563,14 +895,24 @@ class PathToken(StringToken):
     FILE = 'file'
     DIRECTORY = 'directory'
 
+    # Shared by the path tokens, match, complete and get_value of an input list a directory once
+    directory_cache = DirectoryListingCache()
+
+    # Seconds a completion waits for the filesystem before answering that the scan is in progress.
+    # Matching a line to execute always waits for the scan. None to always wait.
+    scan_timeout = 0.5
+
     def __init__(self, name, pathtype=ANY, cli=None, helpstring=None):
         self._pathtype = pathtype
         self._is_windows = None
+        # (scan function name, input) to the _PathScan running in the executor
+        self._scans = {}
         super().__init__(name, cli=cli, helpstring=helpstring)
 
     def get_drives(self):
         drives = []
         if self.is_windows:
+            import string
             for c in string.ascii_lowercase:
                 if os.path.isdir(c + ':'):
                     drives.append(c + ':')
@@ -580,9 +922,15 @@ class PathToken(StringToken):
     def completable(self):
         return True
 
+    @property
+    def completion_ttl(self):
+        # The directory contents can change while the input line is edited
+        return 1.0
+
     @property
     def is_windows(self):
         if self._is_windows is None:
+            import platform
             os_system = platform.system()
             if os_system.lower() == 'windows':
                 self._is_windows = True
@@ -604,19 +952,66 @@ class PathToken(StringToken):
             path_sep = "/"
         return "A {}.".format(self._pathtype) + ' Start the input with quote (") and use {} as separator'.format(path_sep)
 
-    def children(self, path):
+    def listing(self, path, cancelled=None):
+        """Returns a dict of the names in the directory to whether they are directories"""
         try:
-            content = os.listdir(path)
-            if "." in content:
-                content.remove(".")
-            if ".." in content:
-                content.remove("..")
-            return content
+            return self.directory_cache.listing(path, cancelled)
         except PermissionError:
             print("\nPermissionError on {}\n".format(path))
-            return []
+            return {}
+
+    def children(self, path, cancelled=None):
+        return list(self.listing(path, cancelled))
+
+    def is_scanning(self, str_input):
+        return any(key[1] == str_input and not scan.future.done() for key, scan in self._scans.items())
+
+    async def get_helpstring(self, match_string=None, cli=None): # noqa
+        if match_string and self.is_scanning(match_string):
+            return "Still scanning {}...".format(match_string)
+        return self.helpstring
+
+    async def run_scan(self, scan_func, str_input, timeout_result, cli=None):
+        """Run the filesystem work for the input in the path scan threads
+
+        The scans of the other inputs left running by a timeout are cancelled, the user has moved
+        on from them. A scan of the same input left running by a timeout is waited for again.
+
+        :param scan_func: Function doing the filesystem work, called with the input and a cancel event
+        :param str_input: The token input
+        :param timeout_result: Result returned if the scan does not finish in scan_timeout
+        :param cli: The CliInterface matching the input. Only the completions of a match in progress time out
+        """
+
+        key = (scan_func.__name__, str_input)
+        for other_key, scan in list(self._scans.items()):
+            if other_key[1] != str_input and not scan.waiters:
+                scan.cancelled.set()
+                del self._scans[other_key]
+
+        scan = self._scans.get(key)
+        if scan is None:
+            scan = _PathScan(asyncio.get_running_loop(), scan_func, str_input)
+            self._scans[key] = scan
+
+        # The last match of the cli is not the caller's outside a match, no deadline applies then
+        state = getattr(cli, "active_match_state", None)
+        timeout = self.scan_timeout if (state is not None and state.dry_run) else None
+        scan.waiters += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(scan.future), timeout)
+        except asyncio.TimeoutError:
+            # The partial answer must not be reused from the completion cache
+            state.cacheable = False
+            return timeout_result
+        finally:
+            scan.waiters -= 1
+        if self._scans.get(key) is scan:
+            del self._scans[key]
+        return result
 
     async def get_value(self, str_input, cli=None): # noqa
+        # The value is never guessed, a pending scan is waited for
         _m, n, l, _ = await self.lookup(str_input) # noqa
         if n == 0:
             return NullTokenValue
@@ -628,14 +1023,19 @@ class PathToken(StringToken):
     async def complete(self, str_input, cli=None): # noqa
         if str_input == "":
             return TOO_MANY_COMPLETIONS, []
-        elif str_input == '"':
+        return await self.run_scan(self.scan_completions, str_input, (TOO_MANY_COMPLETIONS, []), cli=cli)
+
+    def scan_completions(self, str_input, cancelled=None):
+        from pathlib import Path
+
+        if str_input == '"':
             if self.is_windows:
                 path_sep = "\\\\"
             else:
                 path_sep = "/"
 
             options = ['".', '"..', '"' + path_sep]
-            children = self.children(os.path.curdir)
+            children = self.children(os.path.curdir, cancelled)
             options += ['"' + c for c in children]
             return len(options), options
         else:
@@ -643,19 +1043,17 @@ class PathToken(StringToken):
                 path_complete = True
             else:
                 path_complete = False
-            m, n, l, path_sep = await self.lookup(str_input)
+            m, n, l, path_sep = self.scan(str_input, cancelled)
 
             if not path_complete:
                 for elem in l.copy():
                     if elem.is_dir and elem.has_dir_completion:
-                        children = self.children(elem.path)
-                        for c in children:
-                            path_string = elem.path_string + c
-                            l += [PathTokenPath(Path(path_string), path_string)]
+                        for c, is_dir in self.listing(elem.path, cancelled).items():
+                            l.append(PathTokenPath(None, elem.path_string + c, is_dir=is_dir))
 
             if m == MATCH_PARTIAL and len(l) == 1:
                 if l[0].is_dir and not l[0].has_dir_completion:
-                    l.append(PathTokenPath(l[0].path, l[0].path_string + path_sep, partial=True))
+                    l.append(PathTokenPath(l[0].path, l[0].path_string + path_sep, partial=True, is_dir=l[0].is_dir))
                 if not l[0].is_dir:
                     path_complete = True
                 else:
@@ -664,7 +1062,7 @@ class PathToken(StringToken):
                             p = l[0].path_string + os.path.curdir
                             l.append(PathTokenPath(Path(p), p, partial=True))
                     else:
-                        if not self.children(l[0].path):
+                        if not self.listing(l[0].path, cancelled):
                             path_complete = True
 
             return n, ['"' + str(elem.path_string) + ('"' if path_complete else "") for elem in l]
@@ -675,7 +1073,7 @@ class PathToken(StringToken):
             path_complete = True
         else:
             path_complete = False
-        m, _n, l, _ = await self.lookup(str_input) # noqa
+        m, _n, l, _ = await self.lookup(str_input, cli=cli) # noqa
         if m == MATCH_PARTIAL and len(l) == 1:
             if path_complete:
                 return MATCH_SUCCESS
@@ -683,7 +1081,17 @@ class PathToken(StringToken):
                 return MATCH_SUCCESS
         return m
 
-    async def lookup(self, str_input):
+    async def lookup(self, str_input, cli=None):
+        if str_input == "":
+            return MATCH_PARTIAL, TOO_MANY_COMPLETIONS, [], os.path.pathsep
+        return await self.run_scan(
+            self.scan, str_input, (MATCH_PARTIAL, TOO_MANY_COMPLETIONS, [], os.path.sep), cli=cli)
+
+    def scan(self, str_input, cancelled=None):
+        # Path completion support is loaded only when a path token is used
+        import fnmatch
+        from pathlib import Path
+
         path_complete = False
         if str_input == "":
             return MATCH_PARTIAL, TOO_MANY_COMPLETIONS, [], os.path.pathsep
@@ -738,6 +1146,8 @@ class PathToken(StringToken):
                     partial_drive_str = segments[0] + ":"
 
         while segments:
+            if cancelled is not None and cancelled.is_set():
+                raise PathScanCancelled(str_input)
             path_objects = [p for p in path_objects if p.is_dir and not p.partial]
             for p in path_objects:
                 if p.path_string and not p.path_string.endswith(path_sep):
@@ -761,30 +1171,29 @@ class PathToken(StringToken):
             elif segment == "*":
                 opts = []
                 for p in path_objects:
-                    children = self.children(p.path)
-                    for c in children:
-                        path_string = p.path_string + c
-                        opts.append(PathTokenPath(Path(path_string), path_string))
+                    for c, is_dir in self.listing(p.path, cancelled).items():
+                        opts.append(PathTokenPath(None, p.path_string + c, is_dir=is_dir))
                 path_objects = opts
             else:
                 opts = []
                 for p in path_objects:
-                    children = self.children(p.path)
+                    children = self.listing(p.path, cancelled)
                     if self.case_insensitive:
-                        exacts = [p.path_string + c for c in children if c.lower() == segment.lower()]
+                        exacts = [c for c in children if c.lower() == segment.lower()]
                     else:
-                        exacts = [p.path_string + c for c in children if c == segment]
+                        exacts = [segment] if segment in children else []
 
-                    matches = [p.path_string + c for c in children if fnmatch.fnmatch(c, segment) and p.path_string + c not in exacts]
-                    matches = list(set(matches + exacts))
-                    opts += [PathTokenPath(Path(m), m) for m in matches]
+                    matches = set(fnmatch.filter(children, segment))
+                    matches.update(exacts)
+                    opts += [PathTokenPath(None, p.path_string + c, is_dir=children[c]) for c in matches]
                     if not path_complete:
                         if not self.case_insensitive:
-                            path_strings = matches
-                            partial_matches = [PathTokenPath(Path(p.path_string + c), p.path_string + c, partial=True) for c in children if c.startswith(segment) and p.path_string + c not in path_strings]
+                            partial_matches = [PathTokenPath(None, p.path_string + c, partial=True, is_dir=is_dir)
+                                               for c, is_dir in children.items() if c.startswith(segment) and c not in matches]
                         else:
-                            path_strings = [m.lower() for m in matches]
-                            partial_matches = [PathTokenPath(Path(p.path_string + c), p.path_string + c, partial=True) for c in children if c.lower().startswith(segment.lower()) and p.path_string.lower() + c.lower() not in path_strings]
+                            path_strings = set(m.lower() for m in matches)
+                            partial_matches = [PathTokenPath(None, p.path_string + c, partial=True, is_dir=is_dir)
+                                               for c, is_dir in children.items() if c.lower().startswith(segment.lower()) and c.lower() not in path_strings]
                         opts += partial_matches
 
                 if partial_drive:
@@ -0,0 +1,140 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import os
+import re
+import time
+import itertools
+from time import perf_counter_ns
+
+
+# Categories of the trace spans
+CATEGORY_CLI = "cli"
+CATEGORY_MATCHER = "matcher"
+CATEGORY_TOKEN = "token"
+CATEGORY_EXEC = "exec"
+CATEGORY_BINDING = "binding"
+CATEGORY_HOOK = "hook"
+
+
+class Trace():
+    """Spans of matching one input line, in the Chrome trace event format
+
+    The trace can be viewed in Perfetto or chrome://tracing. The spans of a match are sequential
+    or nested, so they are all recorded on one thread as complete events.
+    """
+
+    def __init__(self, tokenize_ns=None):
+        """Starts the trace of a match
+
+        :param tokenize_ns: Duration of tokenizing the line, done just before the match
+        """
+
+        start = perf_counter_ns()
+        self._origin = start - (tokenize_ns or 0)
+        self._step = None
+        self.events = []
+        self.command = None
+        if tokenize_ns is not None:
+            self.add_span("tokenize", CATEGORY_CLI, self._origin, start)
+
+    def add_span(self, name, category, start_ns, end_ns=None, args=None):
+        """Records a span which started at start_ns and ended at end_ns, now if None"""
+
+        if end_ns is None:
+            end_ns = perf_counter_ns()
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": 0,
+            "ts": (start_ns - self._origin) / 1000.0, "dur": (end_ns - start_ns) / 1000.0,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def step(self, token_input, frontier):
+        """Ends the running matcher step and starts the one matching the next input token
+
+        :param token_input: The input token matched in the step
+        :param frontier: Number of the candidate sequences extended in the step
+        """
+
+        now = perf_counter_ns()
+        self.end_step(now)
+        self._step = (now, {"input": token_input, "frontier": frontier})
+
+    def end_step(self, end_ns=None):
+        if self._step is not None:
+            start, args = self._step
+            self._step = None
+            self.add_span("match step", CATEGORY_MATCHER, start, end_ns, args)
+
+    def finish(self, name, start_ns, command=None):
+        """Ends the trace with the span of the whole match"""
+
+        self.end_step()
+        self.command = command
+        self.add_span(name, CATEGORY_CLI, start_ns, args={"command": command} if command else None)
+
+    def to_dict(self):
+        events = sorted(self.events, key=lambda e: (e["ts"], -e["dur"]))
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"command": self.command},
+        }
+
+
+class TraceWriter():
+    """Writes the traces to a directory, keeping only the latest max_files of them
+
+    The directory can be shared by the writers of many processes. The file names carry the
+    process id, and the oldest files of all the writers are removed.
+    """
+
+    def __init__(self, directory, max_files=100):
+        self.directory = directory
+        self.max_files = max_files
+        self._sequence = itertools.count()
+
+    def _existing_files(self):
+        try:
+            names = [n for n in os.listdir(self.directory) if n.startswith("trace-") and n.endswith(".json")]
+        except OSError:
+            return []
+        # The names start with the time, so they sort by creation
+        return [os.path.join(self.directory, n) for n in sorted(names)]
+
+    def write(self, trace):
+        """Writes the trace to a new file and removes the oldest files beyond max_files
+
+        :returns: The path of the trace file
+        :rtype: str
+        """
+
+        import json
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        now = time.time()
+        command = re.sub(r"[^A-Za-z0-9_.-]+", "_", trace.command or "unmatched").strip("_")
+        filename = os.path.join(self.directory, "trace-{}.{:03d}-{}-{:06d}-{}.json".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000,
+            os.getpid(), next(self._sequence) % 1000000, command))
+
+        tmpname = "{}.tmp".format(filename)
+        with open(tmpname, "w") as fd:
+            json.dump(trace.to_dict(), fd)
+        os.replace(tmpname, filename)
+
+        # Listed every time, the other processes writing to the directory add files too
+        files = self._existing_files()
+        for name in files[:max(len(files) - self.max_files, 0)]:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        return filename
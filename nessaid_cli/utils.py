@@ -6,7 +6,10 @@
 # file included as part of this package.
 #
 
+import os
 import sys
+import mmap
+import locale
 
 
 ESCAPED_CHAR_INPUTS = [
@@ -40,6 +43,7 @@ class ExtendedString(str):
 def convert_to_python_string(cli_string, cli=None):
 
     if cli and cli_string in cli.str_cache:
+        cli.count_str_cache(True)
         return cli.str_cache[cli_string]
 
     converted_str = cli_string
@@ -99,6 +103,96 @@ def convert_to_cli_string(python_string):
     return python_string
 
 
+def iter_logical_lines(lines):
+    """Join continuation lines and skip comments in a sequence of input lines
+
+    A line ending with a backslash is continued in the next line and lines starting
+    with # are comments, as in the interactive Cli loop. The parts of a continued line
+    are collected and joined once.
+
+    :param lines: An iterable of lines, like a list of str or a file object opened in text mode
+    :returns: A generator of (line_number, line) tuples. line_number is the number of the
+              first physical line of the logical line, counting from 1
+    """
+
+    parts = []
+    first_line_number = None
+
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip()
+        if first_line_number is None:
+            first_line_number = line_number
+
+        if line.endswith("\\"):
+            parts.append(line[:-1])
+            continue
+
+        if parts:
+            parts.append(line)
+            line = "".join(parts)
+            parts = []
+
+        start, first_line_number = first_line_number, None
+
+        if line.lstrip().startswith("#"):
+            continue
+
+        yield start, line
+
+    if parts:
+        line = "".join(parts)
+        if not line.lstrip().startswith("#"):
+            yield first_line_number, line
+
+
+class MappedFileReader():
+    """Lazily iterate the lines of a file through a read only memory map
+
+    The file content is not read into memory. The mapped pages are backed by the file
+    and can be dropped by the OS once consumed, so the resident memory stays the same
+    whatever the size of the file is. The lines are returned with the line endings.
+    The lines are decoded with the locale encoding, like a file opened in text mode,
+    unless the encoding is given.
+    """
+
+    def __init__(self, filename, encoding=None):
+        self._encoding = encoding or locale.getpreferredencoding(False)
+        self._map = None
+        self._fd = open(filename, "rb")
+        try:
+            if os.fstat(self._fd.fileno()).st_size:
+                self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(self._map, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    self._map.madvise(mmap.MADV_SEQUENTIAL)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._map.readline() if self._map is not None else b""
+        if not line:
+            self.close()
+            raise StopIteration
+        return line.decode(self._encoding)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
 class StdStreamsHolder():
 
     def init_streams(self, stdin=None, stdout=None, stderr=None):
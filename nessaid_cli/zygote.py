@@ -0,0 +1,335 @@
+# Copyright 2021 by Saithalavi M, saithalavi@gmail.com
+# All rights reserved.
+# This file is part of the Nessaid CLI Framework, nessaid_cli python package
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file included as part of this package.
+#
+
+import gc
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import struct
+import argparse
+import importlib
+
+
+# The client sends one request with its stdin, stdout and stderr attached.
+# The session replies with {"pid": <pid>} once forked and {"status": <exit code>} when it ends.
+STDIO_FD_COUNT = 3
+MAX_MESSAGE_SIZE = 65536
+
+# Cmd arguments of the sessions executing a command line, same as NessaidCmd.execute_args
+EXEC_CMD_KWARGS = {"disable_default_hooks": True, "use_base_grammar": False, "interactive": False}
+
+# Imported lazily by the interactive sessions, the zygote loads them before forking
+INTERACTIVE_MODULES = ["nessaid_readline.async_readline", "nessaid_readline.key"]
+
+
+def _send_message(sock, message, fds=None):
+    data = json.dumps(message).encode("utf-8") + b"\n"
+    if fds:
+        socket.send_fds(sock, [data], fds)
+    else:
+        sock.sendall(data)
+
+
+class _MessageReader():
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = b""
+
+    def read(self):
+        while b"\n" not in self._buffer:
+            data = self._sock.recv(MAX_MESSAGE_SIZE)
+            if not data:
+                return None
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line.decode("utf-8"))
+
+
+def load_class(class_path):
+    module_name, _, class_name = class_path.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ZygoteServer():
+    """Resident process which forks ready Cmd sessions for the clients
+
+    The Cmd class, the modules to preload and the compiled grammar are loaded once in the
+    zygote. The objects are then frozen with gc.freeze so that the forked sessions share
+    their pages with the zygote instead of copying them on the first garbage collection.
+    Every connection is served by a forked child using the terminal passed by the client.
+    """
+
+    def __init__(self, cmd_class, socket_path, preload=None, intro=None, **cmd_kwargs):
+        """Creates the zygote
+
+        :param cmd_class: NessaidCmd subclass served to the clients
+        :param socket_path: Path of the Unix socket to listen on
+        :param preload: Names of additional modules to import before forking
+        :param intro: Intro text printed when an interactive session starts
+        :param cmd_kwargs: Keyword arguments to create the Cmd instances
+        """
+
+        self._cmd_class = cmd_class
+        self._socket_path = socket_path
+        self._preload = preload or []
+        self._intro = intro
+        self._cmd_kwargs = cmd_kwargs
+        self._sock = None
+        self._children = set()
+
+    def preload(self):
+        for module in INTERACTIVE_MODULES + self._preload:
+            importlib.import_module(module)
+
+        import asyncio
+
+        # Creating the instances generates and compiles the grammars into the class level caches
+        loop = asyncio.new_event_loop()
+        try:
+            self._cmd_class(loop=loop, **dict(self._cmd_kwargs, interactive=False))
+            self._cmd_class(loop=loop, **dict(self._cmd_kwargs, **EXEC_CMD_KWARGS))
+        finally:
+            loop.close()
+
+        gc.collect()
+        gc.freeze()
+
+    def start(self):
+        self.preload()
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The sessions run as the owner of the zygote, only the owner may connect
+        umask = os.umask(0o077)
+        try:
+            self._sock.bind(self._socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self._socket_path, 0o600)
+        self._sock.listen()
+
+        signal.signal(signal.SIGCHLD, lambda signum, frame: self.reap_children())
+
+    def reap_children(self):
+        # A child can exit before its pid is added, so reap until no child is left to wait for
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if not pid:
+                return
+            self._children.discard(pid)
+
+    def is_peer_allowed(self, conn):
+        """Whether the peer of the connection runs as the owner of the zygote
+
+        The peer credentials are checked where SO_PEERCRED is available, the socket is accessible
+        only to the owner on all the platforms.
+        """
+
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _pid, uid, _gid = struct.unpack("3i", creds)
+        return uid == os.geteuid()
+
+    def serve_forever(self):
+        if self._sock is None:
+            self.start()
+
+        try:
+            while True:
+                try:
+                    conn, _ = self._sock.accept()
+                except InterruptedError:
+                    continue
+                try:
+                    if not self.is_peer_allowed(conn):
+                        print("Rejected connection from another user", file=sys.stderr)
+                        continue
+                    self.fork_session(conn)
+                except Exception as e:
+                    print("Exception starting session:", type(e), e, file=sys.stderr)
+                finally:
+                    conn.close()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._socket_path)
+            except OSError:
+                pass
+
+    def fork_session(self, conn):
+        msg, fds, _flags, _addr = socket.recv_fds(conn, MAX_MESSAGE_SIZE, STDIO_FD_COUNT)
+        try:
+            if len(fds) != STDIO_FD_COUNT:
+                raise ValueError("Expected stdin, stdout and stderr from the client")
+            request = json.loads(msg.decode("utf-8"))
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self._sock.close()
+                    status = self.run_session(conn, fds, request)
+                except BaseException as e:
+                    print("Exception in session:", type(e), e, file=sys.stderr)
+                finally:
+                    os._exit(status)
+
+            self._children.add(pid)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def run_session(self, conn, fds, request):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setsid()
+
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        # The streams of the zygote may not be on the standard descriptors, like when it is embedded
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+        os.environ.update(request.get("env", {}))
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+
+        _send_message(conn, {"pid": os.getpid()})
+
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        args = request.get("args")
+        if args:
+            cmd = self._cmd_class(loop=loop, **dict(self._cmd_kwargs, **EXEC_CMD_KWARGS))
+            status = cmd.exec_args(*args)
+        else:
+            cmd = self._cmd_class(loop=loop, **self._cmd_kwargs)
+            loop.run_until_complete(cmd.cmdloop(intro=self._intro))
+            status = 0
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_message(conn, {"status": status})
+        return status
+
+
+# Environment passed from the client to the session
+CLIENT_ENVIRONMENT = ("TERM", "LANG", "LC_ALL", "COLUMNS", "LINES")
+
+
+def connect(socket_path, args=None, stdio=None):
+    """Attach the terminal of the calling process to a new session of the zygote
+
+    The client imports nothing of the Cmd, it only passes its stdin, stdout and stderr.
+    The interactive sessions need a terminal as stdin.
+
+    :param socket_path: Path of the Unix socket of the zygote
+    :param args: Command line to execute. An interactive session is started if empty
+    :param stdio: The stdin, stdout and stderr file descriptors for the session, those of the process if None
+    :returns: The exit status of the session
+    :rtype: int
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+
+    request = {
+        "args": list(args or []),
+        "cwd": os.getcwd(),
+        "env": {k: os.environ[k] for k in CLIENT_ENVIRONMENT if k in os.environ},
+    }
+
+    if stdio is None:
+        stdio = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+    _send_message(sock, request, fds=list(stdio))
+
+    reader = _MessageReader(sock)
+    pid = None
+
+    def forward_signal(signum, frame):
+        if pid:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    # Keys reach the session through the terminal, signals sent to the client are forwarded
+    handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        handlers[signum] = signal.signal(signum, forward_signal)
+
+    try:
+        while True:
+            try:
+                message = reader.read()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if message is None:
+                return 1
+            if "pid" in message:
+                pid = message["pid"]
+            elif "status" in message:
+                return message["status"]
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nessaid_cli.zygote",
+        description="Fork ready Cmd sessions from a resident process with the grammar preloaded")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Start the zygote")
+    serve_parser.add_argument("cmd_class", help="The Cmd class as module:ClassName")
+    serve_parser.add_argument("socket_path", help="Path of the Unix socket to listen on")
+    serve_parser.add_argument("--preload", action="append", default=[], help="Additional module to import")
+    serve_parser.add_argument("--prompt", default="# ", help="The prompt of the sessions")
+
+    connect_parser = subparsers.add_parser("connect", help="Start a session in the zygote")
+    connect_parser.add_argument("socket_path", help="Path of the Unix socket of the zygote")
+    connect_parser.add_argument("args", nargs=argparse.REMAINDER, help="Command to execute, interactive if not given")
+
+    args = parser.parse_args(argv)
+
+    if args.action == "connect":
+        return connect(args.socket_path, args.args)
+
+    server = ZygoteServer(load_class(args.cmd_class), args.socket_path, preload=args.preload, prompt=args.prompt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,17 +5,46 @@
 # file included as part of this package.
 #
 
+import io
+import os
+import sys
+import pickle
+import json
+import time
+import stat
+import subprocess
+import signal
+import socket
 import inspect
+import collections
 import asyncio
+import tempfile
 import unittest
+import threading
 
 from nessaid_cli.cmd import NessaidCmd
+from nessaid_cli.cli import CliScriptError
+from nessaid_cli.server import CliServer
+from nessaid_cli.parallel import ScriptPool, validate_file
+from nessaid_cli.interface import MatchState, TokenCompletion
+from nessaid_cli.elements import GrammarSpecification
+from nessaid_cli.metrics import Histogram, MetricsRegistry, PrometheusExporter, PositionMetrics, PositionCollector, process_counters
+from nessaid_cli.analyzer import analyze_grammar, main as analyzer_main
+from nessaid_cli.allocations import AllocationTracker
+from nessaid_cli.zygote import ZygoteServer, connect
 
 from nessaid_cli.tokens import (
+    MATCH_SUCCESS,
+    MATCH_FAILURE,
+    MATCH_PARTIAL,
+    TOO_MANY_COMPLETIONS,
     StringToken,
     RangedIntToken,
     BooleanToken,
     RangedStringToken,
+    PathToken,
+    AlternativeStringsToken,
+    DynamicValuesToken,
 )
 
 from nessaid_cli_tests.test_utils import captured_output
@@ -105,6 +134,53 @@ class Cmd1(NessaidCmd):
         print("Type:", type(cli_output))
         print("Output:", cli_output)
 
+class TouchCmd(NessaidCmd):
+    """
+    token FILE_NAME StringToken();
+    """
+
+    def do_touch(self, filename):
+        """
+        "touch" FILE_NAME << $filename = $2; >>
+        """
+        open(filename, "w").close()
+
+
+class LineBufferReadline():
+    """Readline stub for the completion tests, the completer reads the line buffer set by the test"""
+
+    def __init__(self):
+        self.line_buffer = ""
+        self._enable_bell = False
+
+    def set_completer(self, completer):
+        pass
+
+    def parse_and_bind(self, config):
+        pass
+
+    def set_prepare_history_entry(self, func):
+        pass
+
+    def set_history_size(self, hsize):
+        pass
+
+    def enable_bell(self, enable=True):
+        pass
+
+    def play_bell(self):
+        pass
+
+    def get_line_buffer(self):
+        return self.line_buffer
+
+    async def insert_text(self, text):
+        self.line_buffer += text
+
+    async def readline(self, prompt):
+        return self.line_buffer
+
+
 class CmdTest1(unittest.TestCase):
 
     def test_basic_1(self):
@@ -233,6 +309,820 @@ class CmdTest1(unittest.TestCase):
                     assert out == stdout, "Failure: stdout mismatch:\n\n" + info + stdout_info + stderr_info
                     assert err == stderr, "Failure: stderr mismatch:\n\n" + info + stdout_info + stderr_info
 
+    def test_match_limits(self):
+        loop = asyncio.get_event_loop()
+        inp = "type int 5"
+
+        cmd = Cmd1(prompt="# ", max_token_evaluations=3)
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.execute_line(inp))
+
+        out = ""
+        err = "Result: failure\nError: Match aborted: more than 3 token evaluations for the input"
+        stdout = stdout.getvalue().strip()
+        stderr = stderr.getvalue().strip()
+        assert out == stdout, "\nstdout: Expected: {}\nstdout: Actual  : {}".format(out, stdout)
+        assert err == stderr, "\nstderr: Expected: {}\nstderr: Actual  : {}".format(err, stderr)
+
+        cmd = Cmd1(prompt="# ", max_token_evaluations=1000, max_match_candidates=10)
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.execute_line(inp))
+
+        out = "Input: int\nType: <class 'int'>\nOutput: 5"
+        stdout = stdout.getvalue().strip()
+        assert out == stdout, "\nstdout: Expected: {}\nstdout: Actual  : {}".format(out, stdout)
+
+    def test_script_pool(self):
+        scripts = [["input", "type int 5"], ["type int 500", "input"], ["type string abc"]]
+        with ScriptPool(Cmd1, workers=2, prompt="# ", interactive=False) as pool:
+            results = list(pool.map(scripts))
+            unordered = sorted(pool.map(scripts, ordered=False), key=lambda r: r.index)
+
+        assert [r.index for r in results] == [r.index for r in unordered] == [0, 1, 2]
+        assert [r.returncode for r in results] == [r.returncode for r in unordered] == [0, 1, 0]
+        assert "input: input" in results[0].output and "Output: 5" in results[0].output
+        # The script goes on after the failing line
+        assert [(e.line_number, e.result) for e in results[1].errors] == [(1, MATCH_FAILURE)]
+        assert "input: input" in results[1].output
+        assert [l.line for l in results[2].lines] == ["type string abc"]
+
+        # The workers are shut down when the pool is closed
+        with self.assertRaises(RuntimeError):
+            list(pool.map(scripts))
+
+    def test_validate_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "commands.txt")
+            markers = [os.path.join(tmpdir, "marker-{}".format(n)) for n in range(5)]
+            lines = ['touch "{}"'.format(m) for m in markers]
+            # The invalid line starts the second chunk, after a continuation line and a comment
+            lines[1] = 'touch \\\n    "{}"'.format(markers[1])
+            lines[2] = "# comment\nunknown-command"
+            with open(filename, "w") as fd:
+                fd.write("\n".join(lines) + "\n")
+
+            report = validate_file(TouchCmd, filename, workers=2, chunk_size=2, prompt="# ", interactive=False)
+
+            assert report.line_count == 5 and not report.success
+            assert [(e.line_number, e.line) for e in report.errors] == [(5, "unknown-command")], report.errors
+            assert report.errors[0].offending_token == "unknown-command"
+            # The lines are only matched, no handler is run
+            assert not any(os.path.exists(m) for m in markers)
+
+    @unittest.skipUnless(hasattr(os, "fork") and hasattr(socket, "send_fds"), "Needs fork and fd passing")
+    def test_zygote_session(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "zygote.sock")
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    ZygoteServer(Cmd1, socket_path, prompt="# ").serve_forever()
+                finally:
+                    os._exit(status)
+
+            try:
+                deadline = time.monotonic() + 30
+                while not os.path.exists(socket_path):
+                    assert time.monotonic() < deadline, "The zygote did not start"
+                    time.sleep(0.05)
+                assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+                with open(os.devnull) as stdin, tempfile.TemporaryFile("w+") as stdout:
+                    stdio = [stdin.fileno(), stdout.fileno(), stdout.fileno()]
+                    assert connect(socket_path, ["input"], stdio=stdio) == 0
+                    assert connect(socket_path, ["unknown-command"], stdio=stdio) != 0
+                    stdout.seek(0)
+                    assert "output: output" in stdout.read()
+            finally:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+
+        # The readline modules of the interactive sessions are loaded before forking
+        code = ("import sys; from nessaid_cli.cmd import NessaidCmd; from nessaid_cli.zygote import ZygoteServer; "
+                "ZygoteServer(NessaidCmd, None).preload(); print('nessaid_readline.async_readline' in sys.modules)")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        assert output.strip() == "True"
+
+    def test_server_session(self):
+        loop = asyncio.get_event_loop()
+
+        class EchoCmd(NessaidCmd):
+            """
+            token TEXT StringToken();
+            """
+
+            def do_echo(self, text):
+                """
+                "echo" TEXT << $text = $2; >>
+                """
+                self.print("echo:", text)
+
+        async def read_prompt(reader):
+            return (await asyncio.wait_for(reader.readuntil(b"# "), 10)).decode()
+
+        async def run(socket_path):
+            server = CliServer(EchoCmd, unix_path=socket_path, prompt="# ")
+            server.log = lambda *args: None
+            await server.start()
+            try:
+                clients = [await asyncio.open_unix_connection(socket_path) for _ in range(2)]
+                for reader, _ in clients:
+                    await read_prompt(reader)
+                assert len(server.sessions) == 2
+                assert server.sessions[0].cli is not server.sessions[1].cli
+
+                outputs = []
+                for n, (reader, writer) in enumerate(clients):
+                    writer.write("echo session-{}\n".format(n).encode())
+                    outputs.append(await read_prompt(reader))
+                    # A line ending with ? lists the completions and keeps the text
+                    writer.write(b"ec?\n")
+                    outputs.append(await read_prompt(reader) + (await reader.readexactly(2)).decode())
+
+                for _, writer in clients:
+                    writer.close()
+                for _ in range(100):
+                    if not server.sessions:
+                        break
+                    await asyncio.sleep(0.05)
+                return outputs, server.sessions
+            finally:
+                await server.close()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outputs, sessions = loop.run_until_complete(run(os.path.join(tmpdir, "server.sock")))
+
+        assert "echo: session-0" in outputs[0] and "echo: session-1" in outputs[2], outputs
+        assert "session-1" not in outputs[0] and "session-0" not in outputs[2], outputs
+        assert "echo :" in outputs[1] and outputs[1].endswith("# ec"), outputs
+        assert not sessions
+
+    def test_concurrent_matches(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ", match_yield_interval=1)
+
+        async def check_values(line, values):
+            for _ in range(3):
+                _, _, tokens = cmd.tokenize(line)
+                # The other tasks tokenize their lines before this one is matched
+                await asyncio.sleep(0)
+                res = await cmd.match([str(t) for t in tokens], dry_run=True, last_token_complete=True)
+                assert res.result != MATCH_FAILURE, res.error
+                assert cmd.get_matched_values() == values, cmd.get_matched_values()
+                assert cmd.match_state.tokenize_ns is not None
+
+        async def run():
+            cmd.enter_grammar(cmd.generate_root_grammar_name())
+            try:
+                return await asyncio.gather(
+                    cmd.execute_script(["type int 5", "type string abc"] * 3),
+                    check_values("type int 7", ["type", "int", 7]),
+                    check_values("type boolean true", ["type", "boolean", True]))
+            finally:
+                cmd.exit_grammar()
+
+        with captured_output() as (stdout, stderr):
+            results, _, _ = loop.run_until_complete(run())
+
+        assert all(r.result.result == MATCH_SUCCESS for r in results)
+        stdout = stdout.getvalue()
+        assert stdout.count("Output: 5\n") == 3 and stdout.count("Output: abc\n") == 3, stdout
+
+    def test_ranged_int_boundaries(self):
+        loop = asyncio.get_event_loop()
+        cases = [
+            ((0, 100), "", MATCH_PARTIAL, (101, [])),
+            ((0, 100), "10", MATCH_PARTIAL, (2, ["10", "100"])),
+            ((0, 100), "100", MATCH_SUCCESS, (1, ["100"])),
+            ((0, 100), "101", MATCH_FAILURE, (0, [])),
+            ((1, 1000), "1", MATCH_PARTIAL, (TOO_MANY_COMPLETIONS, [])),
+            ((1, 1000), "1000", MATCH_SUCCESS, (1, ["1000"])),
+            ((1, 1000), "1001", MATCH_FAILURE, (0, [])),
+            ((5, 5), "", MATCH_SUCCESS, (1, ["5"])),
+            ((5, 5), "6", MATCH_FAILURE, (0, [])),
+            ((-100, -1), "-", MATCH_PARTIAL, (TOO_MANY_COMPLETIONS, [])),
+            ((-100, -1), "1", MATCH_FAILURE, (0, [])),
+            ((10, 19), "1", MATCH_PARTIAL, (10, [str(n) for n in range(10, 20)])),
+            ((10, 19), "19", MATCH_SUCCESS, (1, ["19"])),
+            ((10, 19), "20", MATCH_FAILURE, (0, [])),
+        ]
+        for (start, end), token_input, match, completions in cases:
+            with self.subTest(start=start, end=end, token_input=token_input):
+                token = RangedIntToken("NUM", start, end)
+                assert loop.run_until_complete(token.match(token_input)) == match
+                assert loop.run_until_complete(token.complete(token_input)) == completions
+
+    def test_non_interactive(self):
+        loop = asyncio.get_event_loop()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for _ in range(2):
+                NessaidCmd._compiled_grammars.clear()
+                cmd = Cmd1(prompt="# ", interactive=False, grammar_cache_dir=tmpdir)
+                assert cmd.readline is None
+                assert len(os.listdir(tmpdir)) == 1
+
+                with captured_output() as (stdout, stderr):
+                    assert loop.run_until_complete(cmd.execute_line("type int 5")) == 0
+                    assert loop.run_until_complete(cmd.execute_line("type int 500")) != 0
+
+                out = "Input: int\nType: <class 'int'>\nOutput: 5"
+                stdout = stdout.getvalue().strip()
+                assert out == stdout, "\nstdout: Expected: {}\nstdout: Actual  : {}".format(out, stdout)
+
+            # Cached files which are not private to the user or hold other classes are not loaded
+            filename = os.path.join(tmpdir, os.listdir(tmpdir)[0])
+            for mode, payload in [(0o700, ["not a grammar"]), (0o700, collections.OrderedDict()), (0o777, [])]:
+                os.chmod(tmpdir, mode)
+                with open(filename, "wb") as fd:
+                    pickle.dump(payload, fd)
+                NessaidCmd._compiled_grammars.clear()
+                cmd = Cmd1(prompt="# ", interactive=False, grammar_cache_dir=tmpdir)
+                os.chmod(tmpdir, 0o700)
+                assert isinstance(cmd._grammars, GrammarSpecification)
+
+    def test_parse_tree_reuse(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ", interactive=False)
+
+        # The tree of each line is the one the matcher used, seen through the match state
+        trees, node_counts = [], []
+        for inp in ["type int 5", "type int 6", "type string abc", "type string def"]:
+            with captured_output() as (stdout, stderr):
+                assert loop.run_until_complete(cmd.exec_line(inp)) == 0
+            trees.append(cmd.match_state.parse_tree)
+            node_counts.append(trees[-1].node_count)
+
+        assert trees[0] is trees[1] is trees[2] is trees[3]
+        # Repeating a line walks the nodes memoized by the first one
+        assert node_counts[0] == node_counts[1] and node_counts[2] == node_counts[3]
+        assert "Output: def" in stdout.getvalue()
+
+    def test_completion_cache(self):
+        loop = asyncio.get_event_loop()
+        readline = LineBufferReadline()
+        cmd = Cmd1(prompt="# ", readline=readline)
+        cmd.enter_grammar(cmd.generate_root_grammar_name())
+
+        readline.line_buffer = "type "
+        loop.run_until_complete(cmd.complete("", 0))
+        state, matches = cmd.match_state, cmd._completion_matches
+        assert any(m.startswith("string") for m in matches), matches
+
+        loop.run_until_complete(cmd.complete("", 0))
+        assert cmd.match_state is state and cmd._completion_matches == matches
+
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.execute_script(["type int 5"]))
+        loop.run_until_complete(cmd.complete("", 0))
+        assert cmd.match_state.matched_values == ["type"] and cmd._completion_matches == matches
+
+    def test_completion_pages(self):
+        loop = asyncio.get_event_loop()
+        readline = LineBufferReadline()
+        cmd = Cmd1(prompt="# ", readline=readline, completion_page_size=2)
+        cmd.enter_grammar(cmd.generate_root_grammar_name())
+
+        pages = []
+        readline.line_buffer = ""
+        while not pages or pages[-1][-1].startswith("..."):
+            loop.run_until_complete(cmd.complete("", 0))
+            pages.append(cmd._completion_matches)
+        loop.run_until_complete(cmd.complete("", 0))
+        assert cmd._completion_matches == pages[0]
+
+        # A new line with the same text starts from the first page
+        loop.run_until_complete(cmd.complete("", 0))
+        assert cmd._completion_matches == pages[1]
+        loop.run_until_complete(cmd.get_next_line("# "))
+        loop.run_until_complete(cmd.complete("", 0))
+        assert cmd._completion_matches == pages[0]
+
+        names = [c.split()[0] for p in pages for c in p if not c.startswith("...")]
+        assert all(len(p) == 3 for p in pages[:-1]) and len(pages[-1]) <= 2
+        assert pages[0][-1] == "... {} more, complete again for the next page".format(len(names) - 2)
+        assert names == sorted(names) and "type" in names
+
+        # The pages follow the unpaged order, which sorts the completions and then the help strings
+        class CustomCmd(Cmd1):
+            def process_completion_tokens(self, tokens, page=0):
+                return ["page {}".format(page)] + super().process_completion_tokens(tokens, page)
+
+        tokens = [TokenCompletion("b", "x"), TokenCompletion(None, "<zz>"), TokenCompletion("a", "y")]
+        cmd = CustomCmd(prompt="# ", completion_page_size=0)
+        cmd.set_completion_tokens(list(tokens))
+        unpaged = cmd._completion_matches
+        cmd._completion_page_size = 2
+        paged = []
+        for page in range(2):
+            cmd.set_completion_tokens(list(tokens), page)
+            paged.append(cmd._completion_matches)
+        assert [p[0] for p in [unpaged] + paged] == ["page 0", "page 0", "page 1"]
+        helps = [c.split()[-1] for p in [unpaged] + paged for c in p[1:] if not c.startswith("...")]
+        assert helps == ["<zz>", "y", "x"] * 2, helps
+
+        # The processors taking the tokens only display the first page
+        class TokensOnlyCmd(Cmd1):
+            def process_completion_tokens(self, tokens):
+                return super().process_completion_tokens(tokens)
+
+        cmd = TokensOnlyCmd(prompt="# ", completion_page_size=2)
+        cmd.set_completion_tokens(list(tokens), 1)
+        assert cmd._completion_matches == paged[0][1:]
+
+    def test_phase_metrics(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+        cmd.metrics = MetricsRegistry()
+
+        with captured_output() as (stdout, stderr):
+            for _ in range(3):
+                assert loop.run_until_complete(cmd.exec_line("input")) == 0
+            assert loop.run_until_complete(cmd.exec_line("unknown")) != 0
+
+        snapshot = cmd.metrics.snapshot()
+        phases = snapshot["do_basic_1"]
+        assert set(phases) == {"tokenize", "match", "token_eval", "binding", "handler"}
+        assert all(p["count"] == 3 for p in phases.values())
+        assert phases["match"]["p50"] >= phases["binding"]["p50"] >= phases["handler"]["p50"] > 0
+        assert snapshot["(unmatched)"]["match"]["count"] == 1
+
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.exec_line("cmd-stats"))
+        assert "do_basic_1" in stdout.getvalue() and "p99 ms" in stdout.getvalue()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "metrics.json")
+            cmd.metrics.export(filename)
+            with open(filename) as fd:
+                assert "do_basic_1" in json.load(fd)["commands"]
+
+        # The percentiles of evenly spread values are interpolated within their buckets
+        histogram = Histogram()
+        for value in range(1, 10001):
+            histogram.observe(value)
+        for percent in (50, 95, 99):
+            assert abs(histogram.percentile(percent) - percent * 100) <= percent, (percent, histogram.percentile(percent))
+        assert histogram.percentile(100) == 10000
+
+        histogram = Histogram()
+        for _ in range(10):
+            histogram.observe(1000)
+        assert histogram.to_dict()["p99"] == histogram.to_dict()["p50"] == 1000
+
+    def test_prometheus_counters(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+        cmd.metrics = MetricsRegistry()
+        process_matches = process_counters.values["matches"]
+
+        with captured_output() as (stdout, stderr):
+            for _ in range(2):
+                assert loop.run_until_complete(cmd.exec_line("input")) == 0
+
+        counters = cmd.get_counters()
+        assert counters["matches"] == 2
+        assert counters["candidate_sequences"] >= 2
+        assert counters["token_cache_hits"] > 0 and counters["tree_nodes"] > 0
+        assert process_counters.values["matches"] == process_matches + 2
+
+        exporter = PrometheusExporter(registry=cmd.metrics)
+        exporter.add_counters(cmd.counters, cli="cmd1")
+        text = exporter.render()
+        assert 'nessaid_cli_matches_total{cli="cmd1"} 2' in text
+        # The process totals have their own name, summing the per CLI series counts each match once
+        assert "nessaid_cli_process_matches_total {}".format(process_counters.values["matches"]) in text
+        assert [line for line in text.splitlines() if line.startswith("nessaid_cli_matches_total")] == [
+            'nessaid_cli_matches_total{cli="cmd1"} 2']
+        assert "# TYPE nessaid_cli_phase_duration_seconds summary" in text
+        assert 'command="do_basic_1",phase="handler",quantile="0.99"' in text
+
+        async def scrape():
+            server = await exporter.serve(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response.decode()
+
+        response = loop.run_until_complete(scrape())
+        assert response.startswith("HTTP/1.0 200 OK") and "nessaid_cli_matches_total" in response
+
+    def test_trace_export(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # An older trace of another process sharing the directory is rotated out too
+            open(os.path.join(tmpdir, "trace-20000101-000000.000-1-000000-do_basic_1.json"), "w").close()
+            cmd.enable_tracing(tmpdir, max_files=2)
+            with captured_output() as (stdout, stderr):
+                for _ in range(3):
+                    assert loop.run_until_complete(cmd.exec_line("input")) == 0
+                loop.run_until_complete(cmd.exec_line("cmd-tracing off"))
+                assert loop.run_until_complete(cmd.exec_line("input")) == 0
+
+            names = sorted(os.listdir(tmpdir))
+            assert len(names) == 2 and all(n.endswith("do_basic_1.json") for n in names)
+            assert all("-{}-".format(os.getpid()) in n for n in names), names
+            with open(os.path.join(tmpdir, names[-1])) as fd:
+                trace = json.load(fd)
+
+        spans = {e["name"]: e for e in trace["traceEvents"]}
+        assert trace["otherData"]["command"] == "do_basic_1"
+        assert {"tokenize", "match step", "match", "token.match", "enter", "exit", "binding", "do_basic_1"} <= set(spans)
+        assert spans["match step"]["args"] == {"input": "input", "frontier": 1}
+        assert spans["match"]["dur"] >= spans["binding"]["dur"] >= spans["do_basic_1"]["dur"]
+
+    def test_allocation_tracking(self):
+        loop = asyncio.get_event_loop()
+        leaked = []
+
+        class LeakCmd(NessaidCmd):
+            def do_leak(self):
+                r"""
+                "leak"
+                """
+                leaked.append(bytearray(100000))
+
+            def do_noop(self):
+                r"""
+                "noop"
+                """
+
+        cmd = LeakCmd(prompt="# ", interactive=False)
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.exec_line("cmd-allocations on"))
+            try:
+                for _ in range(6):
+                    assert loop.run_until_complete(cmd.exec_line("leak")) == 0
+                    assert loop.run_until_complete(cmd.exec_line("noop")) == 0
+                loop.run_until_complete(cmd.exec_line("cmd-allocations"))
+                summary = cmd.allocation_tracker.summary()
+                # Only the executed lines are sampled, not the ones tokenized for completion
+                cmd.tokenize("leak")
+                assert cmd.line_measures.allocations is None
+            finally:
+                loop.run_until_complete(cmd.exec_line("cmd-allocations off"))
+
+        assert summary["do_leak"]["runs"] == 6 and summary["do_leak"]["growing"]
+        assert summary["do_leak"]["net"]["binding"] >= 6 * 100000
+        assert not summary["do_noop"]["growing"]
+        assert "GROWING" in stdout.getvalue()
+        assert cmd.allocation_tracker is None
+
+        # Lines running at the same time share the process counters, they are not recorded
+        tracker = AllocationTracker(size=4)
+        try:
+            first, second = tracker.start(), tracker.start()
+            tracker.record("first", first)
+            tracker.record("second", second)
+            # A line left unmatched does not hold off the next ones
+            tracker.discard(tracker.start())
+            tracker.record("third", tracker.start())
+            tracker.start()
+            assert [r.command for r in tracker.records] == ["third"]
+            assert tracker.overlapped == 2
+        finally:
+            tracker.close()
+
+    def test_grammar_analyzer(self):
+        grammar = r"""
+        token NUM RangedIntToken(1, 10);
+        simple: "show" ("interface" NUM | "ip" "route" | "interface" "all") { "detail" };
+        orderless:
+        (
+            "orderless"
+            (("1", {"2"}, "3"), ("a", {"b"}, "c")) * 2
+            {("1", {"2"}, "3"), ("a", {"b"}, "c")} * 4
+        ) * (1: 50)
+        ;
+        """
+
+        simple, orderless = analyze_grammar(grammar)
+        assert simple.expanded_nodes == 15 and simple.max_frontier == 2 and simple.orderless_depth == 0
+        assert simple.overlaps[0][:2] == ("Alternative", [("keyword", "interface")])
+
+        assert orderless.max_frontier == 49 and orderless.max_repeat == 49 and orderless.orderless_depth == 2
+        assert any("Orderless set with optional members" in w for w in orderless.warnings)
+        assert any("candidate sequences" in w for w in orderless.warnings)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "grammar.txt")
+            with open(filename, "w") as fd:
+                fd.write(grammar)
+            with captured_output() as (stdout, stderr):
+                assert analyzer_main([filename, "simple"]) == 1
+                assert analyzer_main(["nessaid_cli_tests.test_cli:Cmd1"]) == 0
+                with self.assertRaises(SystemExit) as cm:
+                    analyzer_main([])
+        assert stdout.getvalue().startswith("simple:\n    expanded nodes:  15") and "orderless:" not in stdout.getvalue()
+        assert cm.exception.code == 2 and "usage: python -m nessaid_cli.analyzer" in stderr.getvalue()
+
+    def test_match_positions(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+        registry = MetricsRegistry()
+        observer = PositionMetrics(registry)
+
+        cmd.add_match_observer(observer)
+        with captured_output() as (stdout, stderr):
+            assert loop.run_until_complete(cmd.exec_line("input")) == 0
+        cmd.remove_match_observer(observer)
+
+        fields = registry.position_snapshot()["do_basic_1"]
+        assert fields["candidates"]["count"] == 1 and fields["candidates"]["max"] == 1
+        assert fields["token_calls"]["max"] > 0
+
+        with captured_output() as (stdout, stderr):
+            loop.run_until_complete(cmd.exec_line('cmd-explain "input" execute'))
+        output = stdout.getvalue()
+        assert "token calls" in output and "Result: success" in output and "Command: do_basic_1" in output
+        assert not cmd.match_observers
+
+        # The nodes created by a concurrent match of another Cmd are not counted
+        async def run(*others):
+            cmd = Cmd1(prompt="# ", match_yield_interval=1)
+            collector = PositionCollector()
+            cmd.add_match_observer(collector)
+            lines = [cmd.exec_line("type int 5")] + [other.exec_line("type string abc") for other in others]
+            assert await asyncio.gather(*lines) == [0] * len(lines)
+            return [p.tree_nodes for p in collector.positions]
+
+        with captured_output() as (stdout, stderr):
+            alone = loop.run_until_complete(run())
+            concurrent = loop.run_until_complete(run(Cmd1(prompt="# ", match_yield_interval=1)))
+        assert alone == concurrent and sum(alone) > 0, (alone, concurrent)
+
+    def test_path_listing_cache(self):
+        loop = asyncio.get_event_loop()
+        token = PathToken("PATH")
+        cache = token.directory_cache
+        cwd = os.getcwd()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                os.chdir(tmpdir)
+                for name in ["alpha.txt", "alps.txt"]:
+                    open(name, "w").close()
+                os.mkdir("beta")
+                os.utime(".", (1000000000, 1000000000))
+
+                misses = cache.misses
+                assert loop.run_until_complete(token.complete('"al'))[0] == 2
+                assert loop.run_until_complete(token.match('"alpha.txt')) == MATCH_SUCCESS
+                assert loop.run_until_complete(token.get_value('"beta')) == "beta"
+                assert cache.misses == misses + 1
+
+                open("alpine.txt", "w").close()
+                os.utime(".", (1000000010, 1000000010))
+                assert loop.run_until_complete(token.complete('"al'))[0] == 3
+                assert cache.misses == misses + 2
+
+                # Another directory with the same mtime, entered with the same relative path
+                with tempfile.TemporaryDirectory() as otherdir:
+                    os.chdir(otherdir)
+                    open("alder.txt", "w").close()
+                    os.utime(".", (1000000010, 1000000010))
+                    assert loop.run_until_complete(token.complete('"al')) == (1, ['"alder.txt"'])
+                    os.chdir(tmpdir)
+            finally:
+                os.chdir(cwd)
+
+    def test_path_scan_timeout(self):
+        loop = asyncio.get_event_loop()
+        release = threading.Event()
+        scanned = []
+
+        class SlowPathToken(PathToken):
+            scan_timeout = 0.05
+
+            def scan(self, str_input, cancelled=None):
+                release.wait(5)
+                scanned.append((str_input, cancelled.is_set()))
+                return super().scan(str_input, cancelled)
+
+        class Completion():
+            active_match_state = MatchState(None, None, dry_run=True)
+
+        token = SlowPathToken("PATH")
+        cli = Completion()
+        try:
+            assert loop.run_until_complete(token.match('"/tm', cli=cli)) == MATCH_PARTIAL
+            assert not cli.active_match_state.cacheable
+            assert loop.run_until_complete(token.get_helpstring('"/tm')).startswith("Still scanning")
+
+            task = loop.create_task(token.match('"/tmp', cli=cli))
+            loop.run_until_complete(asyncio.sleep(0.01))
+            release.set()
+            assert loop.run_until_complete(task) == MATCH_PARTIAL
+            assert loop.run_until_complete(token.get_value('"/tmp')) == "/tmp"
+
+            # Outside a match, the last completion of the cli puts no deadline on the scan
+            cmd = Cmd1(prompt="# ")
+            cmd.enter_grammar(cmd.generate_root_grammar_name())
+            loop.run_until_complete(cmd.match(["type"], dry_run=True))
+            release.clear()
+            loop.call_later(0.2, release.set)
+            loop.run_until_complete(token.match('"/tmp/', cli=cmd))
+            assert ('"/tmp/', False) in scanned and cmd.match_state.cacheable
+        finally:
+            release.set()
+        assert ('"/tm', True) in scanned and ('"/tmp', False) in scanned
+
+    def test_alternative_strings_index(self):
+        loop = asyncio.get_event_loop()
+        token = AlternativeStringsToken("IFNAME", ["eth{}".format(i) for i in range(1000)] + ["lo"])
+
+        assert loop.run_until_complete(token.match("eth12")) == MATCH_SUCCESS
+        assert loop.run_until_complete(token.match("eth1000")) == MATCH_FAILURE
+        assert loop.run_until_complete(token.match("l")) == MATCH_SUCCESS
+        assert loop.run_until_complete(token.match("eth99")) == MATCH_SUCCESS
+        assert loop.run_until_complete(token.complete("eth99")) == (11, ["eth99"] + ["eth99{}".format(i) for i in range(10)])
+        assert loop.run_until_complete(token.complete("eth")) == (1000, sorted("eth{}".format(i) for i in range(1000)))
+        assert loop.run_until_complete(token.complete("")) == (1001, token._cli_strings)
+        assert "(1000 alternatives)" in loop.run_until_complete(token.get_helpstring("e"))
+
+        capped = AlternativeStringsToken("IFNAME", token._cli_strings, max_suggestions=100)
+        assert loop.run_until_complete(capped.complete("eth")) == (TOO_MANY_COMPLETIONS, [])
+        assert loop.run_until_complete(capped.complete("")) == (TOO_MANY_COMPLETIONS, [])
+        assert loop.run_until_complete(capped.complete("eth99")) == (11, ["eth99"] + ["eth99{}".format(i) for i in range(10)])
+
+        class CappedToken(AlternativeStringsToken):
+            MAX_SUGGESTIONS = 2
+
+        def make_cmd(token_class):
+
+            class IfCmd(NessaidCmd):
+                r"""
+                token IFNAME AlternativeStringsToken("eth0", "eth1", "eth2", "lo");
+                """
+
+                def get_token_classes(self):
+                    return [token_class]
+
+                def do_show(self, ifname):
+                    r"""
+                    "show" IFNAME << $ifname = $2; >>
+                    """
+
+            return IfCmd(prompt="# ", disable_default_hooks=True, use_base_grammar=False)
+
+        CappedToken.__name__ = "AlternativeStringsToken"
+        # Ambiguous prefixes are reported as such, unless the token does not list their completions
+        for token_class, error in ((AlternativeStringsToken, "Ambiguous options matched for the input token: eth"),
+                                   (CappedToken, "Could not match any rule for this sequence")):
+            cmd = make_cmd(token_class)
+            cmd.enter_grammar(cmd.generate_root_grammar_name())
+            res = loop.run_until_complete(cmd.match(["show", "eth"]))
+            assert (res.result, res.error) == (MATCH_FAILURE, error)
+            res = loop.run_until_complete(cmd.match(["show", "l"], last_token_complete=True, arglist=[]))
+            assert res.result == MATCH_SUCCESS, res.error
+
+    def test_dynamic_values_token(self):
+        loop = asyncio.get_event_loop()
+        calls = []
+
+        class Daemon():
+
+            async def get_vrfs(self):
+                calls.append("vrfs")
+                return ["red", "blue"]
+
+            async def get_users(self):
+                calls.append("users")
+                await asyncio.sleep(0.2)
+                return ["admin"]
+
+        daemon = Daemon()
+        token = DynamicValuesToken("VRF", daemon.get_vrfs, ttl=60)
+        assert loop.run_until_complete(token.match("r")) == MATCH_SUCCESS
+        assert loop.run_until_complete(token.complete("")) == (2, ["red", "blue"])
+        assert loop.run_until_complete(token.get_value("bl")) == "blue"
+        assert calls == ["vrfs"] and not token.cacheable
+
+        token = DynamicValuesToken("USER", "get_users", ttl=60, timeout=0.01)
+        assert loop.run_until_complete(token.match("adm", cli=daemon)) == MATCH_FAILURE
+        loop.run_until_complete(asyncio.sleep(0.3))
+        assert loop.run_until_complete(token.match("adm", cli=daemon)) == MATCH_SUCCESS
+        assert calls == ["vrfs", "users"]
+
+    def test_token_single_flight(self):
+        loop = asyncio.get_event_loop()
+        calls = []
+
+        class VrfCmd(NessaidCmd):
+            r"""
+            token VRF DynamicValuesToken("get_vrfs", 60, 1);
+            """
+
+            def get_token_classes(self):
+                return [DynamicValuesToken]
+
+            def __init__(self, vrfs, **kwargs):
+                self.vrfs = vrfs
+                super().__init__(**kwargs)
+
+            async def get_vrfs(self):
+                calls.append(self)
+                await asyncio.sleep(0.05)
+                return self.vrfs
+
+            def do_show(self, vrf):
+                r"""
+                "show" VRF << $vrf = $2; >>
+                """
+
+        cmds = [VrfCmd(vrfs, prompt="# ", disable_default_hooks=True, use_base_grammar=False)
+                for vrfs in (["red", "blue"], ["rose"], ["green"])]
+        stats = cmds[0].get_single_flight_stats().copy()
+        # The sessions get the values of their own provider, the calls of one session are shared
+        results = loop.run_until_complete(asyncio.gather(
+            *[cmd.complete_token(cmd.get_token("VRF"), "r") for cmd in cmds + cmds[:1]]))
+        assert results == [(1, ["red"]), (1, ["rose"]), (0, []), (1, ["red"])]
+        assert sorted(calls, key=cmds.index) == cmds
+        assert cmds[0].get_single_flight_stats()["shared"] == stats["shared"] + 1
+
+    def test_execute_script(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+
+        script = [
+            "# comment line",
+            "type \\",
+            "    int 5",
+            "",
+            "input",
+        ]
+
+        with captured_output() as (stdout, stderr):
+            results = loop.run_until_complete(cmd.execute_script(script))
+
+        out = "Input: int\nType: <class 'int'>\nOutput: 5\ninput: input\noutput: output"
+        stdout = stdout.getvalue().strip()
+        assert out == stdout, "\nstdout: Expected: {}\nstdout: Actual  : {}".format(out, stdout)
+        assert [r.line_number for r in results] == [2, 5]
+        assert all(r.result.result == MATCH_SUCCESS for r in results)
+
+        with captured_output() as (stdout, stderr):
+            results = loop.run_until_complete(cmd.execute_script(["input", "type int 500"], stop_on_error=False))
+        assert [r.result.result for r in results] == [MATCH_SUCCESS, MATCH_FAILURE]
+
+        with captured_output() as (stdout, stderr):
+            try:
+                loop.run_until_complete(cmd.execute_script(["type int 500", "input"]))
+                assert False, "CliScriptError expected"
+            except CliScriptError as e:
+                assert e.line_number == 1
+        assert stdout.getvalue().strip() == ""
+
+    def test_execute_file(self):
+        loop = asyncio.get_event_loop()
+        cmd = Cmd1(prompt="# ")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "script.cfg")
+            with open(filename, "w") as fd:
+                fd.write("# comment line\ntype \\\n    int 5\n\ninput")
+
+            results = []
+            with captured_output() as (stdout, stderr):
+                collected = loop.run_until_complete(cmd.execute_file(filename, on_result=results.append))
+
+        out = "Input: int\nType: <class 'int'>\nOutput: 5\ninput: input\noutput: output"
+        stdout = stdout.getvalue().strip()
+        assert out == stdout, "\nstdout: Expected: {}\nstdout: Actual  : {}".format(out, stdout)
+        assert collected == []
+        assert [r.line_number for r in results] == [2, 5]
+
+        class FileCmd(Cmd1):
+
+            def do_basic_1(self, cli_input, cli_output):
+                """
+                "input" << $cli_input = $1; $cli_output = "output"; >>
+                """
+                readers.extend(reader for reader, _ in self.file_data)
+                self.exit_loop()
+
+        readers = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "script.cfg")
+            with open(filename, "w") as fd:
+                fd.write("# comment line\ntype \\\n    int 5\ninput\ntype int 6\n")
+
+            # The file is left unread when the loop exits, its reader is closed anyway
+            cmd = FileCmd(prompt="# ", filename=filename)
+            with captured_output() as (stdout, stderr):
+                loop.run_until_complete(cmd.cmdloop())
+
+        assert stdout.getvalue().splitlines()[:2] == ["# type     int 5", "Input: int"]
+        assert "6" not in stdout.getvalue() and not cmd.file_data
+        assert len(readers) == 1 and readers[0]._fd is None
+
     def test_type_string_positive(self):
         self.do_test_type_positive(
             "str",